@@ -1,7 +1,7 @@
-import multiprocessing
+import argparse
 import os
-import sys
 import signal
+import time
 import logging
 
 # Configure logging
@@ -16,46 +16,77 @@ def run_main():
     from src.main import main
     main()
 
+def run_coordinator():
+    """Run the fetcher that feeds the shared job queue"""
+    from src.main import run_coordinator
+    run_coordinator()
+
+def run_worker(worker_id: str):
+    """Run one queue worker"""
+    from src.main import run_worker
+    run_worker(worker_id)
+
 def run_web():
     """Run the web interface"""
     from src.web_interface import app
     app.run(debug=False, port=5050)
 
-def signal_handler(signum, frame):
-    """Handle Ctrl+C gracefully"""
-    logger.info("Shutting down all processes...")
-    sys.exit(0)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the email processor and web interface")
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help="Run a fetch coordinator plus this many worker processes (default: one combined processor)"
+    )
+    parser.add_argument(
+        '--drain-timeout',
+        type=float,
+        default=120.0,
+        help="Seconds to let processes finish in-flight emails on shutdown"
+    )
+    return parser.parse_args()
 
 if __name__ == "__main__":
+    from src.metrics import DEFAULT_SNAPSHOT_PATH, clear_snapshots
+    from src.workers import Supervisor
+
+    args = parse_args()
+    stopping = False
+
+    def signal_handler(signum, frame):
+        """Handle Ctrl+C gracefully by draining every process"""
+        global stopping
+        stopping = True
+
     # Set up signal handler for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
-    
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # Create processes
+    if args.workers > 0:
+        # Per-process metric snapshots from an earlier run would be summed in
+        clear_snapshots(os.getenv('METRICS_PATH', DEFAULT_SNAPSHOT_PATH))
+        targets = {'Coordinator': (run_coordinator, ())}
+        for i in range(1, args.workers + 1):
+            targets[f"Worker-{i}"] = (run_worker, (f"worker-{i}",))
+    else:
+        targets = {'EmailProcessor': (run_main, ())}
+    targets['WebInterface'] = (run_web, ())
+    supervisor = Supervisor(targets)
+
     try:
-        # Create processes
-        main_process = multiprocessing.Process(target=run_main, name="EmailProcessor")
-        web_process = multiprocessing.Process(target=run_web, name="WebInterface")
-        
         logger.info("Starting Email Manager System...")
-        
-        # Start processes
-        main_process.start()
-        logger.info("Started Email Processor")
-        
-        web_process.start()
-        logger.info("Started Web Interface")
-        
-        # Wait for processes to complete
-        main_process.join()
-        web_process.join()
-        
-    except KeyboardInterrupt:
-        logger.info("Received shutdown signal...")
+        supervisor.start()
+
+        # Restart anything that dies until asked to stop
+        while not stopping:
+            supervisor.poll()
+            time.sleep(1)
+
+        logger.info("Received shutdown signal, draining processes...")
     except Exception as e:
         logger.error(f"Error: {str(e)}")
     finally:
-        # Ensure processes are terminated
-        if 'main_process' in locals() and main_process.is_alive():
-            main_process.terminate()
-        if 'web_process' in locals() and web_process.is_alive():
-            web_process.terminate()
+        supervisor.drain(args.drain_timeout)
         logger.info("System shutdown complete.")
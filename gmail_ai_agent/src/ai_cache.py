@@ -0,0 +1,114 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+class AICache:
+    """Disk-backed cache of model outputs keyed by a hash of the model, prompt version and email"""
+
+    def __init__(
+        self,
+        db_path: str = "ai_cache.db",
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 10000,
+        busy_timeout: float = 5.0
+    ):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # One connection for the process; lookups are short, so AI threads just take turns on it
+        self._conn = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False)
+        # WAL so worker processes sharing the file read while another writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._db_lock = threading.Lock()
+        self._create_tables()
+
+    @contextmanager
+    def _connect(self):
+        """Yield the shared connection inside a transaction, one thread at a time"""
+        with self._db_lock, self._conn:
+            yield self._conn
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
+
+    def _create_tables(self):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ai_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_last_used ON ai_cache (last_used)")
+            conn.commit()
+
+    @staticmethod
+    def make_key(kind: str, model: str, prompt_version: str, subject: str, body: str) -> str:
+        """Hash the inputs that determine a model output; whitespace differences are ignored"""
+        normalized = "\n".join(" ".join(part.split()) for part in (subject, body))
+        digest = hashlib.sha256()
+        for part in (kind, model, prompt_version, normalized):
+            digest.update(part.encode('utf-8'))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value, created_at FROM ai_cache WHERE key = ?", (key,))
+            row = cursor.fetchone()
+            if row and now - row[1] <= self.ttl:
+                cursor.execute("UPDATE ai_cache SET last_used = ? WHERE key = ?", (now, key))
+                conn.commit()
+                self._count(hit=True)
+                return row[0]
+            if row:
+                cursor.execute("DELETE FROM ai_cache WHERE key = ?", (key,))
+                conn.commit()
+        self._count(hit=False)
+        return None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO ai_cache (key, value, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            # Drop expired rows, then the least recently used ones beyond max_entries
+            cursor.execute("DELETE FROM ai_cache WHERE created_at < ?", (now - self.ttl,))
+            cursor.execute("""
+                DELETE FROM ai_cache WHERE key IN (
+                    SELECT key FROM ai_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            conn.commit()
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
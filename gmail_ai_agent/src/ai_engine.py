@@ -1,12 +1,24 @@
 import openai
-from typing import Dict, Tuple, Optional, Union
+from typing import Dict, Iterable, List, Tuple, Optional, Union
 import os
 import base64
+import tempfile
+import uuid
 from datetime import datetime
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+import json
 import logging
 from enum import Enum
+from src.ai_cache import AICache
+from src.image_library import ImageLibrary
+from src.metrics import metrics
+from src.keyword_matcher import KeywordMatcher, KeywordMatch
+from src.response_guard import ResponseGuard
+from src.prompt_templates import InstructionFile, TokenCounter, fit_body
 
 # Configure logging
 logging.basicConfig(
@@ -15,231 +27,661 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class AIEngineError(Exception):
+    """The model could not be reached or answered unusably; the email should be retried, not skipped"""
+
+class ReplyAborted(Exception):
+    """A streamed reply failed the response guard and was cut off mid-generation"""
+
 class EmailAction(Enum):
     NEGOTIATION = "Negotiation"
     REJECTED = "Rejected"
     ASSET_PROVIDED = "Asset Provided"
 
+# Expected keys and types of the single-call analysis JSON
+ANALYSIS_SCHEMA = {
+    'is_car': bool,
+    'action': str,
+    'car_details': (str, type(None)),
+    'reply': str,
+}
+
+# Bump whenever a classification or extraction prompt changes so cached answers are not reused
+PROMPT_VERSION = "1"
+
+# (connect, read) seconds for image downloads; a stalled download must not hold a pipeline worker forever
+IMAGE_DOWNLOAD_TIMEOUT = (5, 60)
+# Bytes written per chunk when saving an image; base64 is decoded in matching 4-character groups
+IMAGE_CHUNK_SIZE = 64 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+@lru_cache(maxsize=None)
+def _image_session() -> requests.Session:
+    """Pooled session shared by every image download, retrying transient failures"""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=['GET'])
+    session.mount('https://', HTTPAdapter(pool_maxsize=10, max_retries=retry))
+    session.mount('http://', HTTPAdapter(pool_maxsize=10, max_retries=retry))
+    return session
+
 class AIEngine:
-    def __init__(self, api_key: str, instructions_path: str):
-        """Initialize the AI Engine with OpenAI API key and instructions"""
-        self.client = openai.OpenAI(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str,
+        instructions_path: str,
+        single_call: bool = True,
+        cache: Optional[AICache] = None,
+        image_library: Optional[ImageLibrary] = None,
+        stream_replies: bool = True,
+        body_token_budget: int = 2000,
+        sender_instructions: Optional[Dict[str, str]] = None,
+        client=None
+    ):
+        """Initialize the AI Engine with OpenAI API key and instructions
+
+        client replaces the plain openai.OpenAI transport, e.g. with a RateLimitedOpenAI.
+        """
+        self.client = client or openai.OpenAI(api_key=api_key)
+        self.single_call = single_call
+        # Streams the reply (or, with single_call, the analysis JSON) so a bad one is cut off early
+        self.stream_replies = stream_replies
+        self.cache = cache
+        self.image_library = image_library
         self.instructions_path = instructions_path
         self.image_instructions_path = os.path.join(
             os.path.dirname(instructions_path),
             'instruction_image.txt'
         )
-        with open(instructions_path, 'r') as f:
-            self.instructions = f.read()
+        # Both files are re-read only when they change on disk
+        self.instruction_file = InstructionFile(instructions_path)
+        self.image_instruction_file = InstructionFile(self.image_instructions_path)
+        self.instruction_file.text  # Fail fast if the instructions are missing
+        # Monitored sender address -> that brand's own instruction set
+        self.sender_instruction_files = {
+            sender.lower(): InstructionFile(path) for sender, path in (sender_instructions or {}).items()
+        }
+        self.token_counter = TokenCounter()
+        self.body_token_budget = body_token_budget
+        self.car_keyword_matcher = KeywordMatcher.from_file(
+            os.path.join(os.path.dirname(instructions_path), 'car_keywords.txt')
+        )
+        self.response_guard = ResponseGuard.from_file(
+            os.path.join(os.path.dirname(instructions_path), 'banned_phrases.txt')
+        )
+
+    @property
+    def instructions(self) -> str:
+        return self.instruction_file.text
+
+    @property
+    def instructions_hash(self) -> str:
+        return self.instruction_file.hash
+
+    def _instruction_file(self, email_content: Dict) -> InstructionFile:
+        """Instructions for the monitored sender the email was routed to, else the default set"""
+        sender = email_content.get('monitored_sender')
+        if not sender:
+            return self.instruction_file
+        return self.sender_instruction_files.get(sender.lower(), self.instruction_file)
+
+    @staticmethod
+    def _thread_context(email_content: Dict) -> str:
+        """Summary of the earlier messages in the email's thread, if there are any"""
+        summary = email_content.get('thread_summary')
+        if not summary:
+            return ""
+        return f"Summary of the conversation so far in this thread:\n        {summary}\n"
+
+    def _summary_request(self, previous_summary: str, messages: List[Dict]) -> Dict:
+        transcript = "\n\n".join(
+            f"From: {m['from']}\n{fit_body(m['body'], self.token_counter, self.body_token_budget // 2)}"
+            for m in messages
+        )
+        prompt = f"""
+        Update the summary of this sponsorship email thread with the new messages.
+        Keep every agreed or proposed price, deliverable, deadline and product detail.
+        Keep it under 150 words.
+
+        Current summary: {previous_summary or "None, this is the start of the thread."}
+
+        New messages:
+        {transcript}
+        """
+        return dict(
+            model="gpt-4-0125-preview",
+            messages=[
+                {"role": "system", "content": "You summarize email negotiations. Only output the updated summary."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0,
+            max_tokens=250
+        )
+
+    def summarize_thread(self, previous_summary: str, messages: List[Dict]) -> str:
+        """Fold new thread messages into a running conversation summary"""
+        try:
+            request = self._summary_request(previous_summary, messages)
+            with metrics.timer('thread_summary'):
+                response = self.client.chat.completions.create(**request)
+            metrics.record_usage(request['model'], getattr(response, 'usage', None))
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.error(f"Error summarizing thread: {str(e)}")
+            return previous_summary
+
+    def _body(self, email_content: Dict) -> str:
+        """Email body cut down to the per-call token budget"""
+        return fit_body(email_content['body'], self.token_counter, self.body_token_budget)
+
+    def _cache_key(self, kind: str, email_content: Dict, model: str) -> str:
+        return AICache.make_key(
+            kind,
+            model,
+            f"{PROMPT_VERSION}:{self._instruction_file(email_content).hash}",
+            email_content['subject'],
+            # Earlier thread context changes the answer, so it is part of the key
+            (email_content.get('thread_summary') or '') + "\n" + email_content['body']
+        )
+
+    def _cache_get(self, kind: str, key: str) -> Optional[str]:
+        """Cached output for key; a cache failure (e.g. a locked database) counts as a miss"""
+        try:
+            cached = self.cache.get(key)
+        except Exception as e:
+            logger.warning(f"AI cache lookup failed, calling the model instead: {str(e)}")
+            cached = None
+        metrics.inc('cache_requests_total', cache='ai', kind=kind, result='miss' if cached is None else 'hit')
+        return cached
+
+    def _cache_set(self, key: str, content: str):
+        try:
+            self.cache.set(key, content)
+        except Exception as e:
+            logger.warning(f"Could not store AI output in the cache: {str(e)}")
+
+    def _complete(self, kind: str, email_content: Dict, request: Dict, is_cacheable=None, stream_check=None) -> str:
+        """Run a chat completion about an email, served from the cache when possible
+
+        With stream_check, the completion is streamed through it and raises ReplyAborted if it fails.
+        """
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(kind, email_content, request['model'])
+            cached = self._cache_get(kind, key)
+            if cached is not None:
+                return cached
+        
+        with metrics.timer(kind):
+            if stream_check is None:
+                response = self.client.chat.completions.create(**request)
+                metrics.record_usage(request['model'], getattr(response, 'usage', None))
+                content = response.choices[0].message.content
+            else:
+                content = self._stream_completion(request, stream_check)
+        if key is not None and (is_cacheable is None or is_cacheable(content)):
+            self._cache_set(key, content)
+        return content
+
+    def _car_details_request(self, email_content: Dict) -> Dict:
+        # First, try to extract using GPT-4 for accurate parsing
+        prompt = f"""
+        Extract the car details (brand, model, and color if available) from this email content.
+        If multiple cars are mentioned, focus on the main one being sponsored.
+        Format the response as a single line with just the car details, e.g., "Red Tesla Model 3" or "BMW M4 Competition".
+        If no specific car details are found, respond with "None".
+
+        Email subject: {email_content['subject']}
+        Email content: {self._body(email_content)}
+        """
+        return dict(
+            model="gpt-4-0125-preview",
+            messages=[
+                {"role": "system", "content": "You are a car detail extractor. Only output the car details in the format specified, nothing else."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0,
+            max_tokens=50
+        )
+
+    @staticmethod
+    def _parse_car_details(content: str) -> Optional[str]:
+        car_details = content.strip()
+        if car_details.lower() != "none":
+            logger.info(f"Extracted car details: {car_details}")
+        return None if car_details.lower() == "none" else car_details
 
     def extract_car_details(self, email_content: Dict) -> Optional[str]:
         """Extract car brand, model, and color from email content"""
         try:
-            # First, try to extract using GPT-4 for accurate parsing
-            prompt = f"""
-            Extract the car details (brand, model, and color if available) from this email content.
-            If multiple cars are mentioned, focus on the main one being sponsored.
-            Format the response as a single line with just the car details, e.g., "Red Tesla Model 3" or "BMW M4 Competition".
-            If no specific car details are found, respond with "None".
-
-            Email subject: {email_content['subject']}
-            Email content: {email_content['body']}
-            """
-
-            response = self.client.chat.completions.create(
-                model="gpt-4-0125-preview",
-                messages=[
-                    {"role": "system", "content": "You are a car detail extractor. Only output the car details in the format specified, nothing else."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0,
-                max_tokens=50
-            )
-
-            car_details = response.choices[0].message.content.strip()
-            if car_details.lower() != "none":
-                logger.info(f"Extracted car details: {car_details}")
-            return None if car_details.lower() == "none" else car_details
+            content = self._complete('car_details', email_content, self._car_details_request(email_content))
+            return self._parse_car_details(content)
 
         except Exception as e:
             logger.error(f"Error extracting car details: {str(e)}")
             return None
 
+    def find_car_keywords(self, email_content: Dict) -> List[KeywordMatch]:
+        """Return the car keywords found in the subject and body, with their positions"""
+        return (
+            self.car_keyword_matcher.find(email_content['subject'], 'subject')
+            + self.car_keyword_matcher.find(email_content['body'], 'body')
+        )
+
+    def _has_car_keywords(self, email_content: Dict) -> bool:
+        # Quick whole-word keyword check before paying for a model call
+        matches = self.find_car_keywords(email_content)
+        if matches:
+            logger.info(f"Car keywords matched: {', '.join(sorted({m.keyword for m in matches}))}")
+        return bool(matches)
+
+    def _is_car_request(self, email_content: Dict) -> Dict:
+        # If keywords found, use GPT for more accurate analysis
+        prompt = f"""
+        Analyze if this email is specifically about car sponsorship or automotive promotion.
+        Consider both the subject and content carefully.
+        
+        Email Subject: {email_content['subject']}
+        Email Content: {self._body(email_content)}
+        
+        Response format: Only respond with 'true' if it's definitely about car sponsorship/promotion, or 'false' otherwise.
+        """
+        return dict(
+            model="gpt-4-0125-preview",
+            messages=[
+                {"role": "system", "content": "You are a car sponsorship email analyzer. Only respond with 'true' or 'false'."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0,
+            max_tokens=10
+        )
+
+    @staticmethod
+    def _parse_is_car(content: str, email_content: Dict) -> bool:
+        is_car = content.strip().lower() == 'true'
+        
+        if is_car:
+            logger.info("\n=== Car Sponsorship Email Detected ===")
+            logger.info(f"Subject: {email_content['subject']}")
+            logger.info(f"From: {email_content['from']}")
+            logger.info("Analysis: This email is specifically about car sponsorship")
+            logger.info("=====================================")
+        
+        return is_car
+
     def is_car_related(self, email_content: Dict) -> bool:
         """Check if the email is related to car sponsorship"""
         try:
-            # First do a quick keyword check
-            subject = email_content['subject'].lower()
-            body = email_content['body'].lower()
-            car_keywords = {'car', 'automotive', 'vehicle', 'auto', 'motors', 'toyota', 'honda', 'ford', 'bmw', 'mercedes', 'tesla', 'porsche', 'audi', 'lexus', 'mustang','sponsorship car'}
-            
             # If no car-related keywords found at all, return False quickly
-            if not any(keyword in subject or keyword in body for keyword in car_keywords):
+            if not self._has_car_keywords(email_content):
                 return False
             
-            # If keywords found, use GPT for more accurate analysis
-            prompt = f"""
-            Analyze if this email is specifically about car sponsorship or automotive promotion.
-            Consider both the subject and content carefully.
-            
-            Email Subject: {email_content['subject']}
-            Email Content: {email_content['body']}
-            
-            Response format: Only respond with 'true' if it's definitely about car sponsorship/promotion, or 'false' otherwise.
-            """
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4-0125-preview",
-                messages=[
-                    {"role": "system", "content": "You are a car sponsorship email analyzer. Only respond with 'true' or 'false'."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0,
-                max_tokens=10
-            )
-            
-            is_car = response.choices[0].message.content.strip().lower() == 'true'
-            
-            if is_car:
-                logger.info("\n=== Car Sponsorship Email Detected ===")
-                logger.info(f"Subject: {email_content['subject']}")
-                logger.info(f"From: {email_content['from']}")
-                logger.info("Analysis: This email is specifically about car sponsorship")
-                logger.info("=====================================")
-            
-            return is_car
+            content = self._complete('is_car', email_content, self._is_car_request(email_content))
+            return self._parse_is_car(content, email_content)
             
         except Exception as e:
             logger.error(f"Error checking car relation: {str(e)}")
             return False
 
+    def _analysis_request(self, email_content: Dict) -> Dict:
+        prompt = f"""
+        Based on these instructions:
+        {self._instruction_file(email_content).text}
+
+        Analyze this email and respond with a JSON object containing exactly these keys:
+        - "is_car": true only if the email is specifically about car sponsorship or automotive promotion, otherwise false
+        - "action": ONE of "NEGOTIATION" (the email requires price negotiation), "REJECTED" (we should decline because it is about gun or knife) or "ASSET_PROVIDED" (we are providing assets or it is about car sponsorship)
+        - "car_details": the main sponsored car as a single line with brand, model and color if available, e.g. "Red Tesla Model 3", or null if no specific car is mentioned
+        - "reply": a professional and appropriate response following the instructions, ready to be sent as an email
+
+        {self._thread_context(email_content)}
+        From: {email_content['from']}
+        Subject: {email_content['subject']}
+        Content: {self._body(email_content)}
+        """
+        return dict(
+            model="gpt-4-0125-preview",
+            messages=[
+                {"role": "system", "content": "You are a professional email assistant. Only output a JSON object with the keys requested."},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.7,
+            max_tokens=600
+        )
+
+    @classmethod
+    def _parse_analysis(cls, content: str) -> Optional[Dict]:
+        analysis = cls._parse_json(content)
+        if not cls._is_valid_analysis(analysis):
+            logger.warning("Single-call analysis did not match the expected schema")
+            return None
+        return analysis
+
+    @classmethod
+    def _is_cacheable_analysis(cls, content: str) -> bool:
+        return cls._is_valid_analysis(cls._parse_json(content))
+
+    def analyze_email(self, email_content: Dict) -> Optional[Dict]:
+        """Classify the email, extract car details and draft the reply in a single call"""
+        try:
+            content = self._complete(
+                'analysis',
+                email_content,
+                self._analysis_request(email_content),
+                is_cacheable=self._is_cacheable_analysis,
+                stream_check=self.response_guard.stream_json_field('reply') if self.stream_replies else None
+            )
+            return self._parse_analysis(content)
+
+        except ReplyAborted:
+            raise
+        except Exception as e:
+            logger.error(f"Error in single-call analysis: {str(e)}")
+            return None
+
+    @staticmethod
+    def _parse_json(content: str):
+        try:
+            return json.loads(content)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _is_valid_analysis(analysis) -> bool:
+        """Check a single-call analysis result against ANALYSIS_SCHEMA"""
+        if not isinstance(analysis, dict):
+            return False
+        for key, expected_type in ANALYSIS_SCHEMA.items():
+            if key not in analysis or not isinstance(analysis[key], expected_type):
+                return False
+        return analysis['action'] in EmailAction.__members__ and bool(analysis['reply'].strip())
+
+    def _action_request(self, email_content: Dict) -> Dict:
+        action_prompt = f"""
+        Analyze this email and determine the appropriate action to take:
+        
+        Email Subject: {email_content['subject']}
+        Email Content: {self._body(email_content)}
+        
+        Choose ONE action from these options:
+        1. NEGOTIATION - If the email requires price negotiation
+        2. REJECTED - If we should decline the opportunity because it is about gun or knife
+        3. ASSET_PROVIDED - If we are providing assets or it is about car sponsorship
+        
+        Respond with ONLY the action name, nothing else.
+        """
+        return dict(
+            model="gpt-4-0125-preview",
+            messages=[
+                {"role": "system", "content": "You are an email action classifier. Only respond with one of: NEGOTIATION, REJECTED, or ASSET_PROVIDED"},
+                {"role": "user", "content": action_prompt}
+            ],
+            temperature=0,
+            max_tokens=20
+        )
+
+    @staticmethod
+    def _is_cacheable_action(content: str) -> bool:
+        return content.strip() in EmailAction.__members__
+
+    @staticmethod
+    def _parse_action(content: str, email_content: Dict) -> EmailAction:
+        action_str = content.strip()
+        logger.info(f"Decision: AI classified email as {action_str}")
+        logger.info(f"Email content analyzed for decision: {email_content['body'][:200]}...")
+        return EmailAction[action_str]
+
+    def _classify_action(self, email_content: Dict) -> EmailAction:
+        """Ask the model which action to take for the email"""
+        content = self._complete(
+            'action',
+            email_content,
+            self._action_request(email_content),
+            is_cacheable=self._is_cacheable_action
+        )
+        return self._parse_action(content, email_content)
+
+    def _reply_request(self, email_content: Dict) -> Dict:
+        prompt = self._create_prompt(email_content)
+        return dict(
+            model="gpt-4-0125-preview",
+            messages=[
+                {"role": "system", "content": "You are a professional email assistant. Your responses should be clear, concise, and appropriate for business communication."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.7,
+            max_tokens=500
+        )
+
+    def _generate_reply(self, email_content: Dict) -> str:
+        """Ask the model for the reply text"""
+        request = self._reply_request(email_content)
+        with metrics.timer('generate'):
+            if not self.stream_replies:
+                response = self.client.chat.completions.create(**request)
+                metrics.record_usage(request['model'], getattr(response, 'usage', None))
+                return response.choices[0].message.content
+            return self._stream_reply(request)
+
+    def _stream_reply(self, request: Dict) -> str:
+        # Stream the reply so a bad generation is cut off as soon as it shows up
+        try:
+            return self._stream_completion(request, self.response_guard.stream())
+        except ReplyAborted as e:
+            logger.warning(f"Aborted reply generation early: {str(e)}")
+            return ""
+
+    def _stream_completion(self, request: Dict, check) -> str:
+        """Stream a completion through check (a StreamCheck), raising ReplyAborted as soon as it fails"""
+        stream = self.client.chat.completions.create(
+            stream=True,
+            stream_options={"include_usage": True},  # Usage arrives in a final chunk without choices
+            **request
+        )
+        try:
+            for chunk in stream:
+                metrics.record_usage(request['model'], getattr(chunk, 'usage', None))
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                reason = check.feed(delta)
+                if reason:
+                    raise ReplyAborted(reason)
+        finally:
+            stream.close()
+        return check.text
+
+    @staticmethod
+    def _log_decision(email_content: Dict, analysis: Optional[Dict]):
+        logger.info("\n=== Email Action Decision ===")
+        logger.info(f"Subject: {email_content['subject']}")
+        logger.info(f"From: {email_content['from']}")
+        if analysis is not None:
+            logger.info("Decision: single-call analysis")
+        
+        # Check if email has attachments
+        if email_content.get('attachments'):
+            logger.info("Decision: Email contains attachments - categorizing as ASSET_PROVIDED")
+            logger.info(f"Attachments found: {len(email_content['attachments'])} files")
+        logger.info("===========================\n")
+
     def generate_response(self, email_content: Dict) -> Tuple[str, Optional[str], EmailAction]:
         """Generate an AI response and optionally an image for car-related content"""
         try:
-            is_car = self.is_car_related(email_content)
-            prompt = self._create_prompt(email_content)
+            analysis = self.analyze_email(email_content) if self.single_call else None
+            has_attachments = bool(email_content.get('attachments'))
             
-            logger.info("\n=== Email Action Decision ===")
-            logger.info(f"Subject: {email_content['subject']}")
-            logger.info(f"From: {email_content['from']}")
-            
-            # Check if email has attachments
-            if 'attachments' in email_content and email_content['attachments']:
-                logger.info("Decision: Email contains attachments - categorizing as ASSET_PROVIDED")
-                logger.info(f"Attachments found: {len(email_content['attachments'])} files")
-                action = EmailAction.ASSET_PROVIDED
+            if analysis is not None:
+                is_car = analysis['is_car']
+                car_details = analysis['car_details']
+                reply = analysis['reply']
+                action = EmailAction[analysis['action']]
             else:
-                # First, determine the action to take
-                action_prompt = f"""
-                Analyze this email and determine the appropriate action to take:
-                
-                Email Subject: {email_content['subject']}
-                Email Content: {email_content['body']}
-                
-                Choose ONE action from these options:
-                1. NEGOTIATION - If the email requires price negotiation
-                2. REJECTED - If we should decline the opportunity because it is about gun or knife
-                3. ASSET_PROVIDED - If we are providing assets or it is about car sponsorship
-                
-                Respond with ONLY the action name, nothing else.
-                """
-                
-                action_response = self.client.chat.completions.create(
-                    model="gpt-4-0125-preview",
-                    messages=[
-                        {"role": "system", "content": "You are an email action classifier. Only respond with one of: NEGOTIATION, REJECTED, or ASSET_PROVIDED"},
-                        {"role": "user", "content": action_prompt}
-                    ],
-                    temperature=0,
-                    max_tokens=20
-                )
-                
-                action_str = action_response.choices[0].message.content.strip()
-                action = EmailAction[action_str]
-                logger.info(f"Decision: AI classified email as {action_str}")
-                logger.info(f"Email content analyzed for decision: {email_content['body'][:200]}...")
+                # Fall back to one call per question
+                is_car = self.is_car_related(email_content)
+                car_details = None
+                reply = None
+                action = None if has_attachments else self._classify_action(email_content)
             
-            logger.info("===========================\n")
+            if has_attachments:
+                action = EmailAction.ASSET_PROVIDED
+            self._log_decision(email_content, analysis)
             
             # Generate the actual response
-            response = self.client.chat.completions.create(
-                model="gpt-4-0125-preview",
-                messages=[
-                    {"role": "system", "content": "You are a professional email assistant. Your responses should be clear, concise, and appropriate for business communication."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
+            if reply is None:
+                reply = self._generate_reply(email_content)
             
             # If car-related, generate an image
             image_path = None
             if is_car:
                 # Extract car details
-                car_details = self.extract_car_details(email_content)
+                if car_details is None and analysis is None:
+                    car_details = self.extract_car_details(email_content)
                 image_path = self.generate_image(car_details)
                 if image_path:
                     logger.info(f"Generated car image: {image_path}")
             
-            return response.choices[0].message.content, image_path, action
+            return reply, image_path, action
+        except ReplyAborted as e:
+            # The single-call analysis was cut off along with its reply; there is nothing to send
+            logger.warning(f"Aborted reply generation early: {str(e)}")
+            return "", None, None
         except Exception as e:
             logger.error(f"Error generating AI response: {str(e)}")
-            return "", None, EmailAction.NEGOTIATION
+            raise AIEngineError(str(e)) from e
+
+    def _image_prompt(self, car_details: Optional[str]) -> Tuple[str, str]:
+        """Return the raw image instructions and the prompt with [car] filled in"""
+        # Read image instructions
+        instructions = self.image_instruction_file.text.strip()
+
+        # Replace [car] placeholder with actual car details if available
+        if car_details:
+            return instructions, instructions.replace("[car]", car_details)
+        return instructions, instructions.replace("[car]", "luxury car")
+
+    @staticmethod
+    def _new_image_path() -> str:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        
+        # Create directory if it doesn't exist
+        os.makedirs("generated_images", exist_ok=True)
+        # Concurrent AI workers render within the same second; the suffix keeps their files apart
+        return f"generated_images/car_image_{timestamp}_{uuid.uuid4().hex[:8]}.png"
 
     def generate_image(self, car_details: Optional[str] = None) -> str:
         """Generate an image using DALL-E based on instructions"""
         try:
-            # Read image instructions
-            with open(self.image_instructions_path, 'r') as f:
-                image_prompt = f.read().strip()
+            instructions, image_prompt = self._image_prompt(car_details)
 
-            # Replace [car] placeholder with actual car details if available
-            if car_details:
-                image_prompt = image_prompt.replace("[car]", car_details)
-            else:
-                image_prompt = image_prompt.replace("[car]", "luxury car")
+            if self.image_library is not None:
+                key = self.image_library.make_key(car_details, instructions)
+                return self.image_library.get_or_create(
+                    key,
+                    lambda image_path: self._render_image(image_prompt, image_path)
+                )
+
+            image_path = self._new_image_path()
+            return image_path if self._render_image(image_prompt, image_path) else None
+        except Exception as e:
+            logger.error(f"Error generating image: {str(e)}")
+            return None
 
-            logger.info(f"Generating image with prompt: {image_prompt}")
+    def _render_image(self, image_prompt: str, image_path: str) -> bool:
+        """Call DALL-E for image_prompt and save the result to image_path"""
+        logger.info(f"Generating image with prompt: {image_prompt}")
 
-            # Generate image using DALL-E
+        # Generate image using DALL-E
+        with metrics.timer('image'):
             response = self.client.images.generate(
                 model="dall-e-3",
                 prompt=image_prompt,
                 size="1024x1024",
                 quality="standard",
                 n=1,
+                response_format="b64_json",
             )
+            metrics.record_image("dall-e-3", "1024x1024", "standard")
+            return self._store_image(response.data[0], image_path)
 
-            # Download and save the image
-            image_url = response.data[0].url
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            image_path = f"generated_images/car_image_{timestamp}.png"
-            
-            # Create directory if it doesn't exist
-            os.makedirs("generated_images", exist_ok=True)
-            
-            # Download and save the image
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                with open(image_path, 'wb') as f:
-                    f.write(response.content)
-                return image_path
-            
-            return None
-        except Exception as e:
-            logger.error(f"Error generating image: {str(e)}")
-            return None
+    @classmethod
+    def _store_image(cls, image, image_path: str) -> bool:
+        """Save a DALL-E result, decoding inline base64 or falling back to downloading its URL"""
+        if getattr(image, 'b64_json', None):
+            data = image.b64_json
+            step = IMAGE_CHUNK_SIZE // 3 * 4
+            return cls._save_image(
+                (base64.b64decode(data[i:i + step]) for i in range(0, len(data), step)),
+                image_path,
+                expected_size=None
+            )
+        return cls._download_image(image.url, image_path)
+
+    @classmethod
+    def _download_image(cls, image_url: str, image_path: str) -> bool:
+        """Stream image_url to image_path over the pooled session"""
+        with _image_session().get(image_url, stream=True, timeout=IMAGE_DOWNLOAD_TIMEOUT) as response:
+            if response.status_code != 200:
+                logger.error(f"Image download failed with status {response.status_code}")
+                return False
+            # Content-Length counts encoded bytes, so it can only be checked for identity-encoded bodies
+            length = response.headers.get('Content-Length')
+            encoded = response.headers.get('Content-Encoding', 'identity') != 'identity'
+            return cls._save_image(
+                response.iter_content(IMAGE_CHUNK_SIZE),
+                image_path,
+                expected_size=int(length) if length and not encoded else None
+            )
+
+    @staticmethod
+    def _save_image(chunks: Iterable[bytes], image_path: str, expected_size: Optional[int]) -> bool:
+        """Write chunks to a temp file and rename it into place only if the result is a complete PNG"""
+        # Unique per writer: other processes may be rendering the same library image right now
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(image_path) or '.',
+            prefix=f"{os.path.basename(image_path)}.",
+            suffix='.part'
+        )
+        try:
+            size = 0
+            with os.fdopen(fd, 'w+b') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                f.seek(0)
+                signature = f.read(len(PNG_SIGNATURE))
+            if expected_size is not None and size != expected_size:
+                logger.error(f"Image is truncated: got {size} bytes, expected {expected_size}")
+                return False
+            if signature != PNG_SIGNATURE:
+                logger.error("Image data is not a PNG")
+                return False
+            os.replace(tmp_path, image_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def release_image(self, image_path: Optional[str]):
+        """Delete a generated image once it has been sent, unless the library keeps it"""
+        if not image_path or not os.path.exists(image_path):
+            return
+        if self.image_library is not None and self.image_library.contains(image_path):
+            return
+        os.remove(image_path)
+        logger.info(f"Cleaned up generated image: {image_path}")
 
     def _create_prompt(self, email_content: Dict) -> str:
         """Create a prompt for the AI model"""
         return f"""
         Based on these instructions:
-        {self.instructions}
+        {self._instruction_file(email_content).text}
 
+        {self._thread_context(email_content)}
         Please analyze this email and generate an appropriate response:
         From: {email_content['from']}
         Subject: {email_content['subject']}
-        Content: {email_content['body']}
+        Content: {self._body(email_content)}
 
         Generate a professional and appropriate response following the instructions.
         The response should be in a format ready to be sent as an email.
@@ -247,8 +689,8 @@ class AIEngine:
 
     def validate_response(self, response: str) -> bool:
         """Validate the AI-generated response"""
-        if not response:
-            return False
-        if len(response) < 10:  # Arbitrary minimum length
+        reason = self.response_guard.check(response)
+        if reason:
+            logger.warning(f"Response failed validation: {reason}")
             return False
         return True
@@ -1,7 +1,12 @@
+import json
 import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Set
 
 class EmailAction(str, Enum):
     NEGOTIATION = "Negotiation"
@@ -15,45 +20,205 @@ class EmailAction(str, Enum):
         except ValueError:
             return cls.NEGOTIATION
 
+# Schema migrations; entry N brings a database from user_version N-1 to N. Only ever append.
+MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS emails (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            timestamp DATETIME NOT NULL,
+            action TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """,
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_emails_timestamp ON emails (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_emails_action_timestamp ON emails (action, timestamp)",
+    ],
+    [
+        "ALTER TABLE emails ADD COLUMN gmail_id TEXT",
+        "ALTER TABLE emails ADD COLUMN thread_id TEXT",
+        "ALTER TABLE emails ADD COLUMN sender TEXT",
+        "ALTER TABLE emails ADD COLUMN latency_ms REAL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_gmail_id ON emails (gmail_id)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            gmail_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_processed_messages_updated_at ON processed_messages (updated_at)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS thread_summaries (
+            thread_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            gmail_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            reply TEXT,
+            image_path TEXT,
+            action TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires REAL,
+            last_error TEXT,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_state_updated_at ON jobs (state, updated_at)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS worker_status (
+            worker_id TEXT PRIMARY KEY,
+            role TEXT NOT NULL,
+            pid INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            started_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+    ],
+    [
+        # JSON list of messages sent or answered since the summary was last brought up to date
+        "ALTER TABLE thread_summaries ADD COLUMN pending TEXT",
+    ],
+]
+
+# Job columns a stage may record alongside its state change
+JOB_FIELDS = ('reply', 'image_path', 'action', 'last_error')
+
+class _ThreadConnection:
+    """Holds a thread's connection in thread-local storage, so it is collected when the thread exits"""
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
 class EmailDatabase:
-    def __init__(self, db_path: str = "emails.db"):
+    def __init__(self, db_path: str = "emails.db", busy_timeout: float = 5.0):
         self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections = set()
+        self._connections_lock = threading.Lock()
         self._create_tables()
 
+    @contextmanager
+    def _connect(self):
+        """Yield this thread's long-lived connection inside a transaction"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            # check_same_thread is off only so close() can run from another thread;
+            # each connection is otherwise used by the thread that opened it
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.busy_timeout,
+                cached_statements=256,
+                check_same_thread=False
+            )
+            # WAL lets the dashboard read while the processor writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+            holder = self._local.holder = _ThreadConnection(conn)
+            with self._connections_lock:
+                self._connections.add(conn)
+            # Short-lived threads (one per Flask request) must not leak a connection and its WAL handles
+            weakref.finalize(holder, self._release, conn)
+        with holder.conn:
+            yield holder.conn
+
+    def _release(self, conn: sqlite3.Connection):
+        with self._connections_lock:
+            self._connections.discard(conn)
+        conn.close()
+
+    def close(self):
+        """Close every connection opened by this instance"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
     def _create_tables(self):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS emails (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    title TEXT NOT NULL,
-                    timestamp DATETIME NOT NULL,
-                    action TEXT NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.commit()
+        """Apply every schema migration newer than the database's user_version"""
+        for version, statements in enumerate(MIGRATIONS, start=1):
+            with self._connect() as conn:
+                # Take the write lock before checking so concurrent processes migrate once
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
 
-    def add_email(self, title: str, action: EmailAction, timestamp: Optional[datetime] = None):
+    def add_email(
+        self,
+        title: str,
+        action: EmailAction,
+        timestamp: Optional[datetime] = None,
+        gmail_id: Optional[str] = None,
+        thread_id: Optional[str] = None,
+        sender: Optional[str] = None,
+        latency_ms: Optional[float] = None
+    ):
         if timestamp is None:
             timestamp = datetime.now()
             
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
+            # A Gmail message is recorded once; reprocessing only refreshes its outcome
             cursor.execute(
-                "INSERT INTO emails (title, timestamp, action) VALUES (?, ?, ?)",
-                (title, timestamp.isoformat(), action.value)
+                """
+                INSERT INTO emails (title, timestamp, action, gmail_id, thread_id, sender, latency_ms)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(gmail_id) DO UPDATE SET
+                    action = excluded.action,
+                    latency_ms = excluded.latency_ms
+                """,
+                (title, timestamp.isoformat(), action.value, gmail_id, thread_id, sender, latency_ms)
             )
             conn.commit()
 
+    def has_email(self, gmail_id: str) -> bool:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM emails WHERE gmail_id = ?", (gmail_id,))
+            return cursor.fetchone() is not None
+
     def get_all_emails(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM emails ORDER BY timestamp DESC")
             return cursor.fetchall()
 
     def get_latest_emails(self, limit: int = 3):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT id, title, timestamp, action FROM emails ORDER BY timestamp DESC LIMIT ?",
@@ -70,7 +235,7 @@ class EmailDatabase:
             ]
 
     def get_emails_by_action(self, action: EmailAction):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM emails WHERE action = ? ORDER BY timestamp DESC",
@@ -79,10 +244,243 @@ class EmailDatabase:
             return cursor.fetchall()
 
     def update_email_action(self, email_id: int, new_action: EmailAction):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE emails SET action = ? WHERE id = ?",
                 (new_action.value, email_id)
             )
             conn.commit()
+
+    def get_sync_state(self, key: str) -> Optional[str]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def set_sync_state(self, key: str, value: str):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                (key, value)
+            )
+            conn.commit()
+
+    def set_processed_state(self, gmail_id: str, state: str):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO processed_messages (gmail_id, state, updated_at) VALUES (?, ?, ?)",
+                (gmail_id, state, time.time())
+            )
+            conn.commit()
+
+    def get_processed_state(self, gmail_id: str) -> Optional[str]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state FROM processed_messages WHERE gmail_id = ?", (gmail_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def get_processed_ids(self, gmail_ids: List[str]) -> Set[str]:
+        """Return the subset of gmail_ids that are in the processed ledger"""
+        found = set()
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(gmail_ids), 500):
+                chunk = gmail_ids[start:start + 500]
+                cursor.execute(
+                    f"SELECT gmail_id FROM processed_messages WHERE gmail_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                found.update(row[0] for row in cursor.fetchall())
+        return found
+
+    def compact_processed(self, older_than: float) -> int:
+        """Drop ledger entries last updated before the older_than epoch timestamp"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM processed_messages WHERE updated_at < ?", (older_than,))
+            conn.commit()
+            return cursor.rowcount
+
+    def get_thread_summary(self, thread_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT summary, last_message_id, message_count, pending FROM thread_summaries WHERE thread_id = ?",
+                (thread_id,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return {
+                'summary': row[0],
+                'last_message_id': row[1],
+                'message_count': row[2],
+                'pending': json.loads(row[3]) if row[3] else []
+            }
+
+    def set_thread_summary(
+        self,
+        thread_id: str,
+        summary: str,
+        last_message_id: Optional[str],
+        message_count: int,
+        pending: Optional[List[Dict]] = None
+    ):
+        """Store a thread's summary; pending messages are not in the summary yet"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO thread_summaries (thread_id, summary, last_message_id, message_count, pending, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (thread_id, summary, last_message_id, message_count, json.dumps(pending) if pending else None, time.time())
+            )
+            conn.commit()
+
+    def add_job(self, gmail_id: str, state: str, payload: str) -> bool:
+        """Queue a message; returns False if it is already queued"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO jobs (gmail_id, state, payload, updated_at) VALUES (?, ?, ?, ?)",
+                (gmail_id, state, payload, time.time())
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+
+    def claim_jobs(self, states: Iterable[str], owner: str, lease_seconds: float, limit: int) -> List[dict]:
+        """Lease up to limit unleased (or expired) jobs in states to owner, oldest first"""
+        states = list(states)
+        now = time.time()
+        with self._connect() as conn:
+            # Take the write lock before selecting so two workers never lease the same job
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                SELECT gmail_id, state, payload, reply, image_path, action, attempts FROM jobs
+                WHERE state IN ({','.join('?' * len(states))})
+                AND (lease_expires IS NULL OR lease_expires < ?)
+                ORDER BY updated_at LIMIT ?
+                """,
+                (*states, now, limit)
+            )
+            rows = cursor.fetchall()
+            cursor.executemany(
+                "UPDATE jobs SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE gmail_id = ?",
+                [(owner, now + lease_seconds, row[0]) for row in rows]
+            )
+            return [
+                {
+                    'gmail_id': row[0],
+                    'state': row[1],
+                    'payload': row[2],
+                    'reply': row[3],
+                    'image_path': row[4],
+                    'action': row[5],
+                    'attempts': row[6] + 1
+                }
+                for row in rows
+            ]
+
+    def update_job(
+        self,
+        gmail_id: str,
+        owner: str,
+        state: str,
+        release: bool = True,
+        lease_seconds: Optional[float] = None,
+        retry_at: Optional[float] = None,
+        **fields
+    ) -> bool:
+        """Move a leased job to state, releasing or renewing the lease; False if owner no longer holds it
+
+        A released job with retry_at can't be claimed again before that time.
+        """
+        columns = [name for name in JOB_FIELDS if name in fields]
+        values = [fields[name] for name in columns]
+        assignments = "".join(f", {name} = ?" for name in columns)
+        if release:
+            assignments += ", lease_owner = NULL, lease_expires = ?"
+            values.append(retry_at)
+        elif lease_seconds is not None:
+            assignments += ", lease_expires = ?"
+            values.append(time.time() + lease_seconds)
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                UPDATE jobs SET state = ?, updated_at = ?{assignments}
+                WHERE gmail_id = ? AND lease_owner = ?
+                """,
+                (state, time.time(), *values, gmail_id, owner)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+
+    def renew_leases(self, owner: str, lease_seconds: float) -> int:
+        """Extend every lease owner holds; returns how many jobs it still holds"""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE lease_owner = ?",
+                (time.time() + lease_seconds, owner)
+            )
+            conn.commit()
+            return cursor.rowcount
+
+    def count_jobs(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")
+            return dict(cursor.fetchall())
+
+    def purge_jobs(self, states: Iterable[str], older_than: float) -> int:
+        """Drop jobs in states last updated before the older_than epoch timestamp"""
+        states = list(states)
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"DELETE FROM jobs WHERE state IN ({','.join('?' * len(states))}) AND updated_at < ?",
+                (*states, older_than)
+            )
+            conn.commit()
+            return cursor.rowcount
+
+    def set_worker_status(self, worker_id: str, role: str, pid: int, state: str, processed: int, started_at: float):
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO worker_status (worker_id, role, pid, state, processed, started_at, heartbeat_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (worker_id, role, pid, state, processed, started_at, time.time())
+            )
+            conn.commit()
+
+    def get_worker_statuses(self) -> List[dict]:
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT worker_id, role, pid, state, processed, started_at, heartbeat_at FROM worker_status ORDER BY worker_id"
+            )
+            return [
+                {
+                    'worker_id': row[0],
+                    'role': row[1],
+                    'pid': row[2],
+                    'state': row[3],
+                    'processed': row[4],
+                    'started_at': row[5],
+                    'heartbeat_at': row[6]
+                }
+                for row in cursor.fetchall()
+            ]
@@ -1,121 +1,467 @@
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 import base64
 from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
+from email.header import Header
+from email.message import Message
 import os
-from typing import List, Dict
+from typing import BinaryIO, List, Dict, Optional, Sequence, Tuple, Union
 import time
 import mimetypes
+import tempfile
+import threading
+import uuid
+from functools import lru_cache
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from src.ledger import ProcessedLedger
+from src.mime_parser import parse_payload
+from src.token_store import TokenStore
+
+@lru_cache(maxsize=None)
+def _discovery_document() -> Optional[str]:
+    """Gmail discovery document bundled with google-api-python-client, read once per process"""
+    return discovery_cache.get_static_doc('gmail', 'v1')
 
 class GmailClient:
-    def __init__(self):
+    # Gmail accepts at most 100 calls per batch; 50 keeps us clear of rate limits
+    MAX_BATCH_SIZE = 100
+    # Headers the metadata pass needs to filter messages before their bodies are downloaded
+    METADATA_HEADERS = ['From', 'Subject']
+    # Outgoing messages larger than this are spooled to disk while they upload
+    SPOOL_SIZE = 1024 * 1024
+    # Resumable upload chunk; Google requires a multiple of 256 KiB
+    UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+    # batchModify accepts at most 1000 message IDs per call
+    MAX_MODIFY_IDS = 1000
+    # Parent label for the triage labels that mirror EmailAction
+    ACTION_LABEL_PREFIX = 'Sponsorship'
+
+    def __init__(
+        self,
+        batch_size: int = 50,
+        incremental_sync: bool = True,
+        ledger: Optional[ProcessedLedger] = None,
+        metadata_first: bool = True,
+        modify_batch_size: int = 50,
+        modify_flush_interval: float = 10.0,
+        action_labels: bool = True,
+        account: str = 'default',
+        credentials_path: str = 'config/credentials.json',
+        token_path: str = 'config/token.json',
+        interactive: bool = True
+    ):
         self.SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
         self.creds = None
         self.service = None
-        self.processed_ids = set()  # Keep track of processed email IDs
+        self.ledger = ledger or ProcessedLedger()  # Keep track of processed email IDs
+        self.batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+        self.incremental_sync = incremental_sync
+        self.account = account  # Name of the Gmail account, tagged onto every fetched email
+        self.credentials_path = credentials_path
+        self.token_path = token_path
+        self.interactive = interactive  # Whether a missing or revoked token may open a browser consent
+        self.metadata_first = metadata_first
+        self.modify_batch_size = modify_batch_size
+        self.modify_flush_interval = modify_flush_interval
+        self.action_labels = action_labels
+        self._pending_modify: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], List[str]] = {}  # Label change -> message IDs
+        self._pending_since = None
+        self._modify_lock = threading.Lock()
+        self._label_ids: Dict[str, str] = {}
+        self._label_lock = threading.Lock()
+        self.history_id = None  # Mailbox historyId the next incremental sync starts from
+        self.retry_ids = set()  # IDs whose fetch failed and must be picked up next poll
+        self._local = threading.local()
 
     def authenticate(self):
-        """Authenticate with Gmail API using OAuth 2.0"""
+        """Authenticate with Gmail API using the cached token, asking for OAuth consent only when it is unusable"""
+        store = TokenStore(self.token_path, self.SCOPES)
+        self.creds = store.get_credentials(self._authorize if self.interactive else None)
+        document = _discovery_document()
+        if document is None:
+            self.service = build('gmail', 'v1', credentials=self.creds)
+        else:
+            self.service = build_from_document(document, credentials=self.creds)
+
+    def _authorize(self) -> Credentials:
         flow = InstalledAppFlow.from_client_secrets_file(
-            'config/credentials.json', self.SCOPES)
-        self.creds = flow.run_local_server(port=0)
-        self.service = build('gmail', 'v1', credentials=self.creds)
+            self.credentials_path, self.SCOPES)
+        return flow.run_local_server(port=0)
+
+    def _http(self):
+        """Per-thread authorized transport; httplib2 connections are not thread-safe"""
+        if self.creds is None:
+            return None
+        if not hasattr(self._local, 'http'):
+            self._local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return self._local.http
 
-    def get_new_emails(self, target_email: str = None) -> List[Dict]:
-        """Fetch new unread emails, optionally filtering by sender"""
+    def get_new_emails(self, target_email: Union[str, Sequence[str], None] = None) -> List[Dict]:
+        """Fetch new unread emails, optionally filtering by one or more senders"""
+        previous_history_id = self.history_id
         try:
-            results = self.service.users().messages().list(
-                userId='me',
-                labelIds=['INBOX', 'UNREAD'],
-                q=f"from:{target_email}" if target_email else None
-            ).execute()
+            targets = [target_email] if isinstance(target_email, str) else list(target_email or [])
+            message_ids = None
+            if self.incremental_sync and self.history_id:
+                message_ids = self._list_history_message_ids()
+            if message_ids is None:
+                message_ids = self._list_unread_message_ids(targets)
             
-            messages = results.get('messages', [])
+            candidates = list(self.retry_ids) + message_ids
+            new_ids = self.ledger.filter_new(dict.fromkeys(candidates))
+            failed = set()
+            if self.metadata_first and targets:
+                # Filter on headers alone so mail from other senders never downloads its body
+                metadata = self._fetch_messages(new_ids, format='metadata', metadata_headers=self.METADATA_HEADERS)
+                failed = set(new_ids) - set(metadata)
+                new_ids = [
+                    message_id for message_id in new_ids
+                    if message_id in metadata and self._match_sender(self._header(metadata[message_id], 'From'), targets)
+                ]
+            fetched = self._fetch_messages(new_ids)
+            self.retry_ids = failed | (set(new_ids) - set(fetched))
             new_emails = []
             
-            for message in messages:
-                if message['id'] not in self.processed_ids:
-                    email = self.service.users().messages().get(
-                        userId='me',
-                        id=message['id'],
-                        format='full'
-                    ).execute()
-                    
-                    headers = email['payload']['headers']
-                    email_data = {
-                        'id': message['id'],
-                        'from': next(h['value'] for h in headers if h['name'] == 'From'),
-                        'subject': next(h['value'] for h in headers if h['name'] == 'Subject'),
-                        'body': self._get_email_body(email),
-                        'thread_id': email['threadId']
-                    }
+            for message_id in new_ids:
+                email = fetched.get(message_id)
+                if email is None:
+                    continue
                     
-                    # Only include emails from target_email if specified
-                    if not target_email or target_email in email_data['from']:
-                        new_emails.append(email_data)
-                        self.processed_ids.add(message['id'])
+                body, attachments = parse_payload(email['payload'])
+                email_data = {
+                    'id': message_id,
+                    'from': self._header(email, 'From'),
+                    'subject': self._header(email, 'Subject'),
+                    'body': body,
+                    'attachments': attachments,
+                    'thread_id': email['threadId'],
+                    'account': self.account
+                }
+                
+                # Only include emails from the target senders if specified
+                matched = self._match_sender(email_data['from'], targets)
+                if not targets or matched:
+                    # Routes the email to that sender's instruction set
+                    email_data['monitored_sender'] = matched
+                    new_emails.append(email_data)
             
             return new_emails
         except Exception as e:
             print(f"Error fetching emails: {str(e)}")
+            # Listing moved the cursor past messages that were never fetched; list them again next poll
+            self.history_id = previous_history_id
             return []
 
-    def send_email(self, to: str, subject: str, body: str, image_path: str = None) -> bool:
-        """Send an email response with optional image attachment"""
-        try:
-            message = MIMEMultipart()
-            message['to'] = to
-            message['subject'] = subject
-            
-            # Add text body
-            msg_text = MIMEText(body)
-            message.attach(msg_text)
-            
-            # Add image attachment if provided
-            if image_path and os.path.exists(image_path):
-                with open(image_path, 'rb') as f:
-                    img_data = f.read()
-                    
-                image = MIMEImage(img_data)
-                image.add_header('Content-Disposition', 'attachment', filename=os.path.basename(image_path))
-                message.attach(image)
-            
-            # Encode and send
-            raw = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-            self.service.users().messages().send(
+    def watch(self, topic_name: str) -> Dict:
+        """Ask Gmail to publish inbox changes to a Cloud Pub/Sub topic"""
+        return self.service.users().watch(
+            userId='me',
+            body={'topicName': topic_name, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'include'}
+        ).execute(http=self._http())
+
+    @staticmethod
+    def _match_sender(from_header: str, targets: List[str]) -> Optional[str]:
+        """The target sender that from_header belongs to, if any"""
+        lowered = from_header.lower()
+        return next((target for target in targets if target.lower() in lowered), None)
+
+    @staticmethod
+    def _sender_query(targets: List[str]) -> Optional[str]:
+        """One Gmail search covering every target sender"""
+        if not targets:
+            return None
+        if len(targets) == 1:
+            return f"from:{targets[0]}"
+        return "from:{" + " ".join(targets) + "}"
+
+    def _list_unread_message_ids(self, targets: List[str] = ()) -> List[str]:
+        """List all unread inbox messages and reset the incremental sync cursor"""
+        if self.incremental_sync:
+            # Read the cursor before listing so nothing that arrives in between is missed
+            profile = self.service.users().getProfile(userId='me').execute()
+            self.history_id = profile['historyId']
+        
+        message_ids = []
+        page_token = None
+        while True:
+            results = self.service.users().messages().list(
                 userId='me',
-                body={'raw': raw}
+                labelIds=['INBOX', 'UNREAD'],
+                q=self._sender_query(list(targets)),
+                pageToken=page_token
             ).execute()
+            message_ids.extend(m['id'] for m in results.get('messages', []))
+            
+            # A backlog after an outage can span many pages
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return message_ids
+
+    def _list_history_message_ids(self) -> Optional[List[str]]:
+        """List unread inbox messages added since history_id, or None if the history expired"""
+        message_ids = []
+        page_token = None
+        try:
+            while True:
+                results = self.service.users().history().list(
+                    userId='me',
+                    startHistoryId=self.history_id,
+                    historyTypes=['messageAdded'],
+                    labelId='INBOX',
+                    pageToken=page_token
+                ).execute()
+                
+                for record in results.get('history', []):
+                    for added in record.get('messagesAdded', []):
+                        if 'UNREAD' in added['message'].get('labelIds', []):
+                            message_ids.append(added['message']['id'])
+                
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+        except HttpError as e:
+            # Gmail answers 404 once startHistoryId is older than the retained history
+            if e.resp.status == 404:
+                print("Mailbox history expired, falling back to a full resync")
+                return None
+            raise
+        
+        self.history_id = results.get('historyId', self.history_id)
+        return message_ids
+
+    @staticmethod
+    def _header(message: Dict, name: str) -> str:
+        return next((h['value'] for h in message['payload'].get('headers', []) if h['name'] == name), '')
+
+    def _fetch_messages(
+        self,
+        message_ids: List[str],
+        format: str = 'full',
+        metadata_headers: Optional[List[str]] = None
+    ) -> Dict[str, Dict]:
+        """Fetch messages with batched Gmail requests, keyed by message ID"""
+        fetched = {}
+
+        def on_response(request_id, response, exception):
+            # A failed item only drops that message; the rest of the batch still lands
+            if exception is not None:
+                print(f"Error fetching email {request_id}: {str(exception)}")
+                return
+            fetched[request_id] = response
+
+        for start in range(0, len(message_ids), self.batch_size):
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for message_id in message_ids[start:start + self.batch_size]:
+                batch.add(
+                    self.service.users().messages().get(
+                        userId='me',
+                        id=message_id,
+                        format=format,
+                        metadataHeaders=metadata_headers
+                    ),
+                    request_id=message_id
+                )
+            batch.execute()
+
+        return fetched
+
+    def get_thread_messages(self, thread_id: str) -> List[Dict]:
+        """Fetch every message in a thread, oldest first"""
+        thread = self.service.users().threads().get(
+            userId='me',
+            id=thread_id,
+            format='full'
+        ).execute(http=self._http())
+        
+        messages = []
+        for message in thread.get('messages', []):
+            messages.append({
+                'id': message['id'],
+                'from': self._header(message, 'From'),
+                'body': self._get_email_body(message)
+            })
+        return messages
+
+    def send_email(self, to: str, subject: str, body: str, image_path: str = None, message_id: str = None) -> bool:
+        """Send an email response with optional image attachment"""
+        try:
+            # Small messages stay in memory; large attachments spill to a temp file
+            with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE) as raw:
+                self._write_mime(raw, to, subject, body, image_path, message_id)
+                raw.seek(0)
+                media = MediaIoBaseUpload(
+                    raw,
+                    mimetype='message/rfc822',
+                    chunksize=self.UPLOAD_CHUNK_SIZE,
+                    resumable=True
+                )
+                self.service.users().messages().send(
+                    userId='me',
+                    body={},
+                    media_body=media
+                ).execute(http=self._http())
             return True
             
         except Exception as e:
             print(f"Error sending email: {str(e)}")
             return False
 
+    def _write_mime(
+        self,
+        out: BinaryIO,
+        to: str,
+        subject: str,
+        body: str,
+        image_path: str = None,
+        message_id: str = None
+    ):
+        """Write a multipart/mixed message to out, base64-encoding the attachment from disk in chunks"""
+        boundary = f"==============={uuid.uuid4().hex}=="
+        headers = Message()
+        headers['To'] = to
+        headers['Subject'] = Header(subject, 'utf-8')
+        if message_id:
+            headers['Message-ID'] = f"<{message_id}>"
+        headers['MIME-Version'] = '1.0'
+        headers['Content-Type'] = f'multipart/mixed; boundary="{boundary}"'
+        out.write(self._header_block(headers))
+        
+        # Add text body
+        out.write(f"--{boundary}\n".encode())
+        out.write(MIMEText(body).as_bytes())
+        out.write(b"\n")
+        
+        # Add image attachment if provided
+        if image_path and os.path.exists(image_path):
+            filename = os.path.basename(image_path)
+            part = Message()
+            part['Content-Type'] = mimetypes.guess_type(image_path)[0] or 'application/octet-stream'
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=filename)
+            out.write(f"--{boundary}\n".encode())
+            out.write(self._header_block(part))
+            with open(image_path, 'rb') as f:
+                # Multiples of 57 bytes encode to whole 76-character lines
+                for chunk in iter(lambda: f.read(57 * 1024), b''):
+                    out.write(base64.encodebytes(chunk))
+        
+        out.write(f"--{boundary}--\n".encode())
+
+    def has_sent(self, message_id: str) -> bool:
+        """Check whether a message with this Message-ID is already in the Sent folder"""
+        results = self.service.users().messages().list(
+            userId='me',
+            q=f"in:sent rfc822msgid:{message_id}",
+            maxResults=1
+        ).execute(http=self._http())
+        return bool(results.get('messages'))
+
+    @staticmethod
+    def _header_block(message: Message) -> bytes:
+        """Serialize only the headers; as_bytes() would also render an (empty) payload"""
+        return b"".join(message.policy.fold_binary(name, value) for name, value in message.items()) + b"\n"
+
     def _get_email_body(self, email: Dict) -> str:
         """Extract email body from the email message"""
-        if 'parts' in email['payload']:
-            for part in email['payload']['parts']:
-                if part['mimeType'] == 'text/plain':
-                    return base64.urlsafe_b64decode(
-                        part['body']['data']
-                    ).decode('utf-8')
-        elif 'body' in email['payload']:
-            return base64.urlsafe_b64decode(
-                email['payload']['body']['data']
-            ).decode('utf-8')
-        return ""
-
-    def mark_as_read(self, email_id: str):
-        """Mark an email as read by removing UNREAD label"""
+        return parse_payload(email['payload'])[0]
+
+    def get_attachment(self, message_id: str, attachment_id: str) -> bytes:
+        """Download an attachment's bytes; only call this when a stage actually needs them"""
+        attachment = self.service.users().messages().attachments().get(
+            userId='me',
+            messageId=message_id,
+            id=attachment_id
+        ).execute(http=self._http())
+        data = attachment['data']
+        return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+    def mark_as_read(self, email_id: str, action: Optional[str] = None):
+        """Queue removing the UNREAD label, plus the action label if given; applied by flush_modifications"""
+        add_labels = []
+        if action and self.action_labels:
+            try:
+                add_labels.append(self._label_id(f"{self.ACTION_LABEL_PREFIX}/{action}"))
+            except Exception as e:
+                # Still mark the email read; a missing action label is only cosmetic
+                print(f"Error looking up action label for {email_id}: {str(e)}")
         try:
-            self.service.users().messages().modify(
-                userId='me',
-                id=email_id,
-                body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+            self.queue_modify(email_id, add_labels=add_labels, remove_labels=['UNREAD'])
         except Exception as e:
             print(f"Error marking email as read: {str(e)}")
+
+    def queue_modify(self, message_id: str, add_labels: List[str] = (), remove_labels: List[str] = ()):
+        """Buffer a label change; flushes once the size or age threshold is reached"""
+        # batchModify applies one label change to many messages, so group by the change
+        change = (tuple(sorted(add_labels)), tuple(sorted(remove_labels)))
+        with self._modify_lock:
+            self._pending_modify.setdefault(change, []).append(message_id)
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+        self.flush_modifications(force=False)
+
+    def _modify_due(self) -> bool:
+        if self._pending_since is None:
+            return False
+        pending = sum(len(ids) for ids in self._pending_modify.values())
+        return (
+            pending >= self.modify_batch_size
+            or time.monotonic() - self._pending_since >= self.modify_flush_interval
+        )
+
+    def flush_modifications(self, force: bool = True):
+        """Apply buffered label changes with one batchModify per distinct change"""
+        with self._modify_lock:
+            if not self._pending_modify or not (force or self._modify_due()):
+                return
+            pending, self._pending_modify = self._pending_modify, {}
+            self._pending_since = None
+
+        for (add_labels, remove_labels), message_ids in pending.items():
+            for start in range(0, len(message_ids), self.MAX_MODIFY_IDS):
+                chunk = message_ids[start:start + self.MAX_MODIFY_IDS]
+                try:
+                    self.service.users().messages().batchModify(
+                        userId='me',
+                        body={
+                            'ids': chunk,
+                            'addLabelIds': list(add_labels),
+                            'removeLabelIds': list(remove_labels)
+                        }
+                    ).execute(http=self._http())
+                except HttpError as e:
+                    # 400/404 mean the request itself is bad (e.g. a deleted message); retrying won't help
+                    if e.resp.status in (400, 404):
+                        print(f"Dropping label update for {len(chunk)} emails: {str(e)}")
+                    else:
+                        print(f"Error updating labels for {len(chunk)} emails, will retry: {str(e)}")
+                        self._requeue_modify((add_labels, remove_labels), chunk)
+                except Exception as e:
+                    print(f"Error updating labels for {len(chunk)} emails, will retry: {str(e)}")
+                    self._requeue_modify((add_labels, remove_labels), chunk)
+
+    def _requeue_modify(self, change: Tuple[Tuple[str, ...], Tuple[str, ...]], message_ids: List[str]):
+        """Put a failed label change back so the next flush retries it"""
+        with self._modify_lock:
+            self._pending_modify.setdefault(change, []).extend(message_ids)
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+
+    def _label_id(self, name: str) -> str:
+        """Look up a user label by name, creating it the first time it is needed"""
+        with self._label_lock:
+            if name not in self._label_ids:
+                labels = self.service.users().labels().list(userId='me').execute(http=self._http())
+                for label in labels.get('labels', []):
+                    self._label_ids[label['name']] = label['id']
+            if name not in self._label_ids:
+                label = self.service.users().labels().create(
+                    userId='me',
+                    body={'name': name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+                ).execute(http=self._http())
+                self._label_ids[name] = label['id']
+            return self._label_ids[name]
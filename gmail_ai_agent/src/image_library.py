@@ -0,0 +1,96 @@
+import hashlib
+import os
+import re
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class ImageLibrary:
+    """On-disk store of generated images keyed by car description and image instructions"""
+
+    def __init__(self, directory: str = "generated_images/library", max_images: int = 200):
+        self.directory = directory
+        self.max_images = max_images
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def normalize(car_details: Optional[str]) -> str:
+        """Reduce a car description to a canonical form, e.g. 'Red  Tesla Model-3!' -> 'red tesla model 3'"""
+        text = re.sub(r"[^a-z0-9]+", " ", (car_details or "luxury car").lower())
+        return " ".join(text.split())
+
+    def make_key(self, car_details: Optional[str], instructions: str) -> str:
+        digest = hashlib.sha256()
+        digest.update(self.normalize(car_details).encode('utf-8'))
+        digest.update(b"\0")
+        digest.update(hashlib.sha256(instructions.encode('utf-8')).digest())
+        return digest.hexdigest()[:32]
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, f"car_image_{key}.png")
+
+    def contains(self, image_path: Optional[str]) -> bool:
+        """Whether image_path is owned by the library and must not be deleted by callers"""
+        if not image_path:
+            return False
+        return os.path.dirname(os.path.abspath(image_path)) == os.path.abspath(self.directory)
+
+    def get_or_create(self, key: str, generate: Callable[[str], bool]) -> Optional[str]:
+        """Return the stored image for key, generating it at most once across threads"""
+        path = self.path_for(key)
+        with self._lock:
+            if os.path.exists(path):
+                # Touch so eviction treats the image as recently used
+                os.utime(path)
+                logger.info(f"Reusing library image: {path}")
+                metrics.inc('cache_requests_total', cache='image_library', result='hit')
+                return path
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not owner:
+            metrics.inc('cache_requests_total', cache='image_library', result='shared')
+            return future.result()
+
+        metrics.inc('cache_requests_total', cache='image_library', result='miss')
+
+        try:
+            result = path if generate(path) else None
+            future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+        if result:
+            self._evict()
+        return result
+
+    def _evict(self):
+        """Delete the least recently used images beyond max_images"""
+        with self._lock:
+            entries = [
+                entry for entry in os.scandir(self.directory)
+                if entry.is_file() and entry.name.endswith('.png')
+            ]
+            if len(entries) <= self.max_images:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_images]:
+                try:
+                    os.remove(entry.path)
+                    logger.info(f"Evicted library image: {entry.path}")
+                except OSError:
+                    pass
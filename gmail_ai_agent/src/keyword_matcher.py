@@ -0,0 +1,44 @@
+import os
+import re
+from typing import Iterable, List, NamedTuple
+
+# Used when no keyword file is configured
+DEFAULT_CAR_KEYWORDS = [
+    'car', 'automotive', 'vehicle', 'auto', 'motors', 'toyota', 'honda', 'ford', 'bmw',
+    'mercedes', 'tesla', 'porsche', 'audi', 'lexus', 'mustang', 'sponsorship car'
+]
+
+class KeywordMatch(NamedTuple):
+    keyword: str
+    field: str
+    start: int
+    end: int
+
+class KeywordMatcher:
+    """Whole-word, case-insensitive matcher for a fixed keyword list compiled into one regex"""
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = sorted({" ".join(k.lower().split()) for k in keywords if k.strip()}, key=len, reverse=True)
+        self._keyword_set = set(self.keywords)
+        # Longest keywords first so "sponsorship car" wins over "car"; a trailing "s" covers plurals
+        alternatives = "|".join(r"\s+".join(map(re.escape, k.split())) for k in self.keywords)
+        self._pattern = re.compile(rf"\b(?:{alternatives})s?\b", re.IGNORECASE) if self.keywords else None
+
+    @classmethod
+    def from_file(cls, path: str, default: Iterable[str] = DEFAULT_CAR_KEYWORDS) -> 'KeywordMatcher':
+        """Load one keyword per line ('#' starts a comment), falling back to default if the file is missing"""
+        if not os.path.exists(path):
+            return cls(default)
+        with open(path, 'r') as f:
+            return cls(line.split('#', 1)[0] for line in f)
+
+    def find(self, text: str, field: str = 'text') -> List[KeywordMatch]:
+        """Return every keyword occurrence in text with its position"""
+        if self._pattern is None or not text:
+            return []
+        matches = []
+        for m in self._pattern.finditer(text):
+            found = " ".join(m.group(0).lower().split())
+            keyword = found if found in self._keyword_set else found[:-1]
+            matches.append(KeywordMatch(keyword, field, m.start(), m.end()))
+        return matches
@@ -0,0 +1,75 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+from src.database import EmailDatabase
+
+logger = logging.getLogger(__name__)
+
+class ProcessedLedger:
+    """Processed Gmail message IDs, persisted in EmailDatabase behind a bounded in-memory LRU"""
+
+    FETCHED = "fetched"
+    REPLIED = "replied"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+    def __init__(
+        self,
+        db: Optional[EmailDatabase] = None,
+        cache_size: int = 10000,
+        retention_days: float = 30,
+        compact_interval: float = 3600
+    ):
+        self.db = db
+        self.cache_size = cache_size
+        self.retention = retention_days * 24 * 3600
+        self.compact_interval = compact_interval
+        self._recent = OrderedDict()  # gmail_id -> state for recently seen IDs
+        self._lock = threading.Lock()
+        self._last_compact = time.monotonic()
+
+    def __contains__(self, gmail_id: str) -> bool:
+        return not self.filter_new([gmail_id])
+
+    def filter_new(self, gmail_ids: Iterable[str]) -> List[str]:
+        """Return the IDs that have not been processed yet, preserving order"""
+        gmail_ids = list(gmail_ids)
+        with self._lock:
+            unknown = [i for i in gmail_ids if i not in self._recent]
+            for gmail_id in gmail_ids:
+                if gmail_id in self._recent:
+                    self._recent.move_to_end(gmail_id)
+        if not unknown:
+            return []
+
+        # Only IDs missing from the LRU cost a (single, indexed) database lookup
+        stored = self.db.get_processed_ids(unknown) if self.db is not None else set()
+        with self._lock:
+            for gmail_id in stored:
+                self._remember(gmail_id, None)
+        return [i for i in unknown if i not in stored]
+
+    def mark(self, gmail_id: str, state: str):
+        """Record the processing state of a message"""
+        if self.db is not None:
+            self.db.set_processed_state(gmail_id, state)
+        with self._lock:
+            self._remember(gmail_id, state)
+        self._maybe_compact()
+
+    def _remember(self, gmail_id: str, state: Optional[str]):
+        self._recent[gmail_id] = state
+        self._recent.move_to_end(gmail_id)
+        while len(self._recent) > self.cache_size:
+            self._recent.popitem(last=False)
+
+    def _maybe_compact(self):
+        if self.db is None or time.monotonic() - self._last_compact < self.compact_interval:
+            return
+        self._last_compact = time.monotonic()
+        removed = self.db.compact_processed(time.time() - self.retention)
+        if removed:
+            logger.info(f"Compacted {removed} processed-message ledger entries")
@@ -1,12 +1,26 @@
+import json
 import os
+import signal
+import threading
 import time
 from dotenv import load_dotenv
 from src.gmail_client import GmailClient
-from src.ai_engine import AIEngine
+from src.ai_engine import AIEngine, AIEngineError
+from src.openai_client import RateLimitedOpenAI
+from src.ai_cache import AICache
+from src.image_library import ImageLibrary
 from src.database import EmailDatabase, EmailAction
+from src.pipeline import EmailPipeline, SendRateLimiter
+from src.ledger import ProcessedLedger
+from src.thread_context import ThreadContextStore
+from src.notifications import AdaptiveBackoff, HttpPushSubscriber, InboxWatcher
+from src.metrics import DEFAULT_SNAPSHOT_PATH, metrics, snapshot_path
+from src.work_queue import WorkQueue
+from src.workers import WorkerHeartbeat
+from src.monitor_config import AccountConfig, load_monitor_config, sender_instructions
 import logging
 from datetime import datetime
-from typing import Dict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
 # Configure logging
 logging.basicConfig(
@@ -15,9 +29,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Target email to monitor
+# Target email to monitor when no monitor config exists
 TARGET_EMAIL = "chengyuan1215@gmail.com"
 
+class Account(NamedTuple):
+    """A monitored Gmail account with its authorized client, shared by every stage in the process"""
+    name: str
+    gmail_client: GmailClient
+    senders: List[str]
+    thread_context: Optional[ThreadContextStore] = None
+
 def setup():
     """Initialize the application"""
     # Load .env file from the config directory
@@ -50,95 +71,484 @@ def display_emails(emails):
     else:
         logger.info("No new emails to process")
 
-def process_email(gmail_client: GmailClient, ai_engine: AIEngine, email: Dict, db: EmailDatabase):
-    """Process a single email"""
-    try:
-        logger.info(f"Processing email: {email['subject']}")
-        
-        # Generate AI response and possibly an image
+def draft_reply(
+    ai_engine: AIEngine,
+    email: Dict,
+    db: EmailDatabase,
+    thread_context: Optional[ThreadContextStore] = None
+) -> Optional[Tuple[str, Optional[str]]]:
+    """Run the AI stage for an email and return the reply and optional image
+
+    Returns None when the generated reply is rejected; model failures raise AIEngineError so the job is retried.
+    """
+    logger.info(f"Processing email: {email['subject']}")
+    started = time.monotonic()
+    
+    # Give the model the earlier negotiation in this thread
+    if thread_context is not None:
+        email['thread_summary'] = thread_context.get_summary(email)
+    
+    # Generate AI response and possibly an image
+    with metrics.timer('draft'):
         response, image_path, action = ai_engine.generate_response(email)
+    email['action'] = action
+    
+    # Save to database with initial action
+    db.add_email(
+        email['subject'],
+        action or EmailAction.PENDING,
+        gmail_id=email['id'],
+        thread_id=email.get('thread_id'),
+        sender=email['from'],
+        latency_ms=(time.monotonic() - started) * 1000
+    )
+    
+    # Validate response
+    if not ai_engine.validate_response(response):
+        logger.warning(f"Invalid response generated for email {email['id']}")
+        return None
+    return response, image_path
+
+def acknowledge_reply(
+    gmail_client: GmailClient,
+    ai_engine: AIEngine,
+    email: Dict,
+    response: str,
+    image_path: Optional[str],
+    thread_context: Optional[ThreadContextStore] = None
+):
+    """Record a sent reply: ledger, read/label state, thread summary and image cleanup"""
+    gmail_client.ledger.mark(email['id'], ProcessedLedger.REPLIED)
+    # Mark email as read and label it with the triage result after successful response
+    action = email.get('action')
+    gmail_client.mark_as_read(email['id'], action.value if action else None)
+    
+    if thread_context is not None:
+        thread_context.record_exchange(email, response)
+    
+    # Clean up image file unless the image library keeps it for reuse
+    ai_engine.release_image(image_path)
+
+def reply_message_id(email: Dict) -> str:
+    """Deterministic Message-ID for our reply, so a resumed send can tell whether it already went out"""
+    return f"reply-{email['id']}@gmail-ai-agent.local"
+
+def draft_job(
+    gmail_client: GmailClient,
+    ai_engine: AIEngine,
+    db: EmailDatabase,
+    work_queue: WorkQueue,
+    email: Dict,
+    thread_context: Optional[ThreadContextStore] = None
+) -> Optional[Tuple[str, Optional[str]]]:
+    """Draft stage for a claimed job; resumes from whatever an earlier run already completed"""
+    job = email['job']
+    try:
+        if job['action']:
+            email['action'] = EmailAction.from_str(job['action'])
         
-        # Save to database with initial action
-        db.add_email(email['subject'], action or EmailAction.PENDING)
-        
-        # Validate response
-        if not ai_engine.validate_response(response):
-            logger.warning(f"Invalid response generated for email {email['id']}")
-            return
+        if job['state'] == WorkQueue.FETCHED:
+            drafted = draft_reply(ai_engine, email, db, thread_context)
+            if drafted is None:
+                gmail_client.ledger.mark(email['id'], ProcessedLedger.SKIPPED)
+                work_queue.advance(email, WorkQueue.SKIPPED)
+                return None
+            response, image_path = drafted
+            action = email.get('action')
+            work_queue.advance(
+                email,
+                WorkQueue.DRAFTED,
+                reply=response,
+                image_path=image_path,
+                action=action.value if action else None
+            )
+            return drafted
         
-        # Send response with optional image
-        success = gmail_client.send_email(
-            to=email['from'],
-            subject=f"Re: {email['subject']}",
-            body=response,
-            image_path=image_path
-        )
+        if job['state'] == WorkQueue.DRAFTED:
+            # The completion was paid for before a crash; send it instead of generating again
+            return job['reply'], job['image_path']
         
-        if success:
-            logger.info(f"Successfully responded to email {email['id']}")
-            # Mark email as read after successful response
-            gmail_client.mark_as_read(email['id'])
-            
-            # Clean up image file if it exists
-            if image_path and os.path.exists(image_path):
-                os.remove(image_path)
-                logger.info(f"Cleaned up generated image: {image_path}")
-        else:
-            logger.error(f"Failed to send response for email {email['id']}")
+        # Sent before a crash but never acknowledged
+        acknowledge_reply(gmail_client, ai_engine, email, job['reply'], job['image_path'], thread_context)
+        work_queue.advance(email, WorkQueue.ACKNOWLEDGED)
+        return None
+    except AIEngineError as e:
+        # An AI outage says nothing about the email; keep retrying until the service is back
+        work_queue.fail(email, str(e), transient=True)
+        return None
+    except Exception as e:
+        work_queue.fail(email, str(e))
+        return None
 
+def send_job(
+    gmail_client: GmailClient,
+    ai_engine: AIEngine,
+    work_queue: WorkQueue,
+    email: Dict,
+    response: str,
+    image_path: Optional[str],
+    thread_context: Optional[ThreadContextStore] = None
+):
+    """Send and acknowledge stages for a drafted job"""
+    job = email['job']
+    message_id = reply_message_id(email)
+    try:
+        # A retried job may have been sent just before the previous worker died
+        if job['attempts'] > 1 and gmail_client.has_sent(message_id):
+            logger.info(f"Reply to email {email['id']} was already sent, skipping the resend")
+        else:
+            with metrics.timer('send'):
+                success = gmail_client.send_email(
+                    to=email['from'],
+                    subject=f"Re: {email['subject']}",
+                    body=response,
+                    image_path=image_path,
+                    message_id=message_id
+                )
+            if not success:
+                work_queue.fail(email, "send failed")
+                return
+        work_queue.advance(email, WorkQueue.SENT)
+        
+        logger.info(f"Successfully responded to email {email['id']}")
+        acknowledge_reply(gmail_client, ai_engine, email, response, image_path, thread_context)
+        work_queue.advance(email, WorkQueue.ACKNOWLEDGED)
     except Exception as e:
-        logger.error(f"Error processing email {email['id']}: {str(e)}")
+        work_queue.fail(email, str(e))
+
+def create_pipeline(
+    accounts: Dict[str, Account],
+    ai_engine: AIEngine,
+    db: EmailDatabase,
+    work_queue: WorkQueue
+) -> EmailPipeline:
+    """Build the concurrent processing pipeline from the stage limits in .env"""
+    response_delay = float(os.getenv('RESPONSE_DELAY', 5))
+    rate_limiter = SendRateLimiter(
+        global_interval=float(os.getenv('GLOBAL_SEND_INTERVAL', 1)),
+        recipient_interval=float(os.getenv('RECIPIENT_SEND_INTERVAL', response_delay))
+    )
+    
+    def draft(email: Dict):
+        account = accounts[email.get('account', 'default')]
+        return draft_job(account.gmail_client, ai_engine, db, work_queue, email, account.thread_context)
+    
+    def send(email: Dict, response: str, image_path: Optional[str]):
+        # Replies go out from the account the email arrived in
+        account = accounts[email.get('account', 'default')]
+        send_job(account.gmail_client, ai_engine, work_queue, email, response, image_path, account.thread_context)
+    
+    return EmailPipeline(
+        draft=draft,
+        send=send,
+        rate_limiter=rate_limiter,
+        ai_workers=int(os.getenv('AI_WORKERS', 4)),
+        send_workers=int(os.getenv('SEND_WORKERS', 2))
+    )
+
+def history_key(account_name: str) -> str:
+    """sync_state key for an account's history cursor; the default account keeps the original key"""
+    return 'history_id' if account_name == 'default' else f'history_id:{account_name}'
+
+def retry_key(account_name: str) -> str:
+    """sync_state key for an account's messages that failed to fetch and must be retried"""
+    return f'retry_ids:{account_name}'
+
+def fetch_emails(account: Account, db: EmailDatabase, work_queue: WorkQueue) -> List[Dict]:
+    """Fetch new emails and persist them as jobs before any work starts on them"""
+    gmail_client = account.gmail_client
+    # One combined query covers every monitored sender in the account
+    with metrics.timer('fetch'):
+        emails = gmail_client.get_new_emails(target_email=account.senders)
+    metrics.inc('emails_fetched_total', len(emails))
+    
+    # Display emails in console
+    display_emails(emails)
+    
+    # Persist every email before working on it so a crash resumes from the last finished stage.
+    # The ledger is only marked once the job exists; a crash in between just re-enqueues (a no-op).
+    for email in emails:
+        work_queue.enqueue(email)
+        gmail_client.ledger.mark(email['id'], ProcessedLedger.FETCHED)
+    
+    # The cursor may already be past messages whose fetch failed; store them first so a restart still retries them
+    db.set_sync_state(retry_key(account.name), json.dumps(sorted(gmail_client.retry_ids)))
+    # Persist the incremental sync cursor so a restart resumes from it
+    if gmail_client.history_id:
+        db.set_sync_state(history_key(account.name), str(gmail_client.history_id))
+    return emails
+
+def fetch_all(accounts: Dict[str, Account], db: EmailDatabase, work_queue: WorkQueue) -> List[Dict]:
+    """Fetch every account into the shared job queue; one failing account does not hold up the rest"""
+    emails = []
+    for account in accounts.values():
+        try:
+            emails.extend(fetch_emails(account, db, work_queue))
+        except Exception as e:
+            logger.error(f"Error fetching emails for account {account.name}: {str(e)}")
+    return emails
 
-def process_emails(gmail_client: GmailClient, ai_engine: AIEngine, db: EmailDatabase):
-    """Process emails and generate responses"""
+def flush_all(accounts: Dict[str, Account], force: bool = True):
+    for account in accounts.values():
+        account.gmail_client.flush_modifications(force=force)
+
+def process_emails(accounts: Dict[str, Account], db: EmailDatabase, work_queue: WorkQueue, pipeline: EmailPipeline) -> int:
+    """Process emails and generate responses, returning how many were fetched"""
     try:
-        # Get new emails from target sender
-        emails = gmail_client.get_new_emails(target_email=TARGET_EMAIL)
+        emails = fetch_all(accounts, db, work_queue)
         
-        # Display emails in console
-        display_emails(emails)
+        # Draft and send concurrently; spacing comes from the pipeline's rate limiter.
+        # Claiming also picks up jobs a crashed run left behind once their lease expires.
+        with work_queue.leases_held():
+            pipeline.run(work_queue.claim())
         
-        for email in emails:
-            process_email(gmail_client, ai_engine, email, db)
-            # Add delay between processing emails
-            time.sleep(int(os.getenv('RESPONSE_DELAY', 5)))
+        # Label changes are buffered; push them out once enough have piled up or aged
+        flush_all(accounts, force=False)
+        return len(emails)
                 
     except Exception as e:
         logger.error(f"Error in process_emails: {str(e)}")
+        return 0
+
+def create_subscriber() -> Optional[HttpPushSubscriber]:
+    """Start the push endpoint when PUBSUB_TOPIC is configured, otherwise poll only"""
+    if not os.getenv('PUBSUB_TOPIC'):
+        return None
+    return HttpPushSubscriber(
+        host=os.getenv('PUSH_HOST', '0.0.0.0'),
+        port=int(os.getenv('PUSH_PORT', 8085)),
+        path=os.getenv('PUSH_PATH', '/gmail/push'),
+        token=os.getenv('PUSH_TOKEN') or None
+    )
+
+def load_accounts() -> List[AccountConfig]:
+    return load_monitor_config(os.getenv('MONITOR_CONFIG', 'config/monitors.json'), TARGET_EMAIL)
+
+def create_gmail_client(db: EmailDatabase, config: AccountConfig) -> GmailClient:
+    gmail_client = GmailClient(
+        account=config.name,
+        credentials_path=config.credentials_path,
+        token_path=config.token_path,
+        interactive=os.getenv('GMAIL_INTERACTIVE_AUTH', 'true').lower() == 'true',
+        batch_size=int(os.getenv('GMAIL_BATCH_SIZE', 50)),
+        incremental_sync=os.getenv('INCREMENTAL_SYNC', 'true').lower() == 'true',
+        metadata_first=os.getenv('METADATA_FIRST_FETCH', 'true').lower() == 'true',
+        modify_batch_size=int(os.getenv('MODIFY_BATCH_SIZE', 50)),
+        modify_flush_interval=float(os.getenv('MODIFY_FLUSH_INTERVAL', 10)),
+        action_labels=os.getenv('ACTION_LABELS', 'true').lower() == 'true',
+        ledger=ProcessedLedger(
+            db=db,
+            retention_days=float(os.getenv('LEDGER_RETENTION_DAYS', 30))
+        )
+    )
+    gmail_client.history_id = db.get_sync_state(history_key(config.name))
+    gmail_client.retry_ids = set(json.loads(db.get_sync_state(retry_key(config.name)) or '[]'))
+    
+    # Authenticate Gmail
+    logger.info(f"Authenticating with Gmail account {config.name}...")
+    gmail_client.authenticate()
+    logger.info("Authentication successful")
+    return gmail_client
+
+def create_accounts(
+    db: EmailDatabase,
+    configs: List[AccountConfig],
+    ai_engine: Optional[AIEngine] = None
+) -> Dict[str, Account]:
+    """Authorize each account once; thread context is only built for processes that draft replies"""
+    accounts = {}
+    for config in configs:
+        gmail_client = create_gmail_client(db, config)
+        thread_context = create_thread_context(db, gmail_client, ai_engine) if ai_engine else None
+        accounts[config.name] = Account(
+            config.name, gmail_client, [sender.email for sender in config.senders], thread_context
+        )
+    return accounts
+
+def create_ai_engine(configs: List[AccountConfig]) -> AIEngine:
+    ai_engine = AIEngine(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        instructions_path=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'instructions.txt'),
+        sender_instructions=sender_instructions(configs),
+        single_call=os.getenv('SINGLE_CALL_ANALYSIS', 'true').lower() == 'true',
+        stream_replies=os.getenv('STREAM_REPLIES', 'true').lower() == 'true',
+        body_token_budget=int(os.getenv('BODY_TOKEN_BUDGET', 2000)),
+        cache=AICache(
+            ttl=float(os.getenv('AI_CACHE_TTL', 7 * 24 * 3600)),
+            max_entries=int(os.getenv('AI_CACHE_MAX_ENTRIES', 10000))
+        ),
+        image_library=ImageLibrary(max_images=int(os.getenv('IMAGE_LIBRARY_MAX_IMAGES', 200))),
+        # Retries with backoff under one set of rate limits shared by every AI worker thread
+        client=RateLimitedOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_concurrency=int(os.getenv('AI_MAX_CONCURRENCY', 8)),
+            requests_per_minute=float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 500)),
+            tokens_per_minute=float(os.getenv('OPENAI_TOKENS_PER_MINUTE', 30000)),
+            max_retries=int(os.getenv('OPENAI_MAX_RETRIES', 5))
+        )
+    )
+    
+    # Create generated_images directory
+    os.makedirs("generated_images", exist_ok=True)
+    return ai_engine
+
+def create_work_queue(db: EmailDatabase) -> WorkQueue:
+    return WorkQueue(
+        db,
+        lease_seconds=float(os.getenv('JOB_LEASE_SECONDS', 300)),
+        max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', 3)),
+        retry_delay=float(os.getenv('JOB_RETRY_DELAY', 30)),
+        max_retry_delay=float(os.getenv('JOB_MAX_RETRY_DELAY', 3600))
+    )
+
+def create_thread_context(db: EmailDatabase, gmail_client: GmailClient, ai_engine: AIEngine) -> Optional[ThreadContextStore]:
+    if os.getenv('THREAD_CONTEXT', 'true').lower() == 'true':
+        return ThreadContextStore(db, gmail_client, ai_engine)
+    return None
+
+def create_watchers(accounts: Dict[str, Account], subscriber: Optional[HttpPushSubscriber]) -> List[InboxWatcher]:
+    """Point every account's push notifications at the one subscriber; empty when polling only"""
+    if subscriber is None:
+        return []
+    return [InboxWatcher(account.gmail_client, os.getenv('PUBSUB_TOPIC')) for account in accounts.values()]
+
+def install_stop_handler(stop: threading.Event, on_stop: Optional[Callable[[], None]] = None):
+    """Turn SIGINT/SIGTERM into a graceful drain: finish the current batch, then exit"""
+    def handle(signum, frame):
+        if not stop.is_set():
+            logger.info("Stop requested, finishing in-flight emails...")
+        stop.set()
+        if on_stop is not None:
+            on_stop()
+    signal.signal(signal.SIGINT, handle)
+    signal.signal(signal.SIGTERM, handle)
+
+def wait_for_mail(stop: threading.Event, subscriber: Optional[HttpPushSubscriber], delay: float):
+    """Sleep until the next poll, a push notification, or a stop request"""
+    if subscriber is None:
+        stop.wait(delay)
+    elif subscriber.wait(delay) is not None and not stop.is_set():
+        logger.info("Inbox change notification received")
 
 def main():
+    """Fetch and process emails in this process"""
     try:
         # Setup application
         max_emails, response_delay, db = setup()
         
         # Initialize clients
-        gmail_client = GmailClient()
-        ai_engine = AIEngine(
-            api_key=os.getenv('OPENAI_API_KEY'),
-            instructions_path=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config', 'instructions.txt')
-        )
+        configs = load_accounts()
+        ai_engine = create_ai_engine(configs)
+        accounts = create_accounts(db, configs, ai_engine)
         
-        # Create generated_images directory
-        os.makedirs("generated_images", exist_ok=True)
-        
-        # Authenticate Gmail
-        logger.info("Authenticating with Gmail...")
-        gmail_client.authenticate()
-        logger.info("Authentication successful")
-        
-        logger.info(f"Starting email monitoring for: {TARGET_EMAIL}")
+        for account in accounts.values():
+            logger.info(f"Starting email monitoring in {account.name} for: {', '.join(account.senders)}")
         logger.info("Press Ctrl+C to stop")
         
         logger.info("Starting email monitoring...")
         
-        while True:
-            process_emails(gmail_client, ai_engine, db)
-            time.sleep(response_delay)
+        work_queue = create_work_queue(db)
+        pipeline = create_pipeline(accounts, ai_engine, db, work_queue)
+        
+        # Push notifications wake the loop immediately; polling backs off while the inbox is idle
+        subscriber = create_subscriber()
+        stop = threading.Event()
+        install_stop_handler(stop, lambda: subscriber and subscriber.push({}))
+        watchers = create_watchers(accounts, subscriber)
+        metrics_path = os.getenv('METRICS_PATH', DEFAULT_SNAPSHOT_PATH)
+        backoff = AdaptiveBackoff(response_delay, float(os.getenv('MAX_POLL_INTERVAL', 300 if subscriber else 60)))
+        try:
+            while not stop.is_set():
+                for watcher in watchers:
+                    watcher.ensure()
+                fetched = process_emails(accounts, db, work_queue, pipeline)
+                # Snapshot for the web interface's /metrics route, which runs in another process
+                metrics.write(metrics_path)
+                wait_for_mail(stop, subscriber, backoff.next_delay(fetched > 0))
+        finally:
+            if subscriber is not None:
+                subscriber.close()
+            pipeline.shutdown()
+            flush_all(accounts)
+            db.close()
+        logger.info("Shutting down...")
             
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
         logger.error(f"Error in main: {str(e)}")
 
+def run_coordinator():
+    """Fetch emails into the shared job queue; worker processes do the AI and send stages"""
+    try:
+        _, response_delay, db = setup()
+        accounts = create_accounts(db, load_accounts())
+        work_queue = create_work_queue(db)
+        heartbeat = WorkerHeartbeat(db, 'coordinator', 'coordinator')
+        
+        subscriber = create_subscriber()
+        stop = threading.Event()
+        install_stop_handler(stop, lambda: subscriber and subscriber.push({}))
+        watchers = create_watchers(accounts, subscriber)
+        metrics_path = snapshot_path(os.getenv('METRICS_PATH', DEFAULT_SNAPSHOT_PATH), 'coordinator')
+        backoff = AdaptiveBackoff(response_delay, float(os.getenv('MAX_POLL_INTERVAL', 300 if subscriber else 60)))
+        try:
+            while not stop.is_set():
+                heartbeat.beat('fetching')
+                for watcher in watchers:
+                    watcher.ensure()
+                emails = fetch_all(accounts, db, work_queue)
+                heartbeat.processed += len(emails)
+                heartbeat.beat('idle')
+                for state, count in work_queue.counts().items():
+                    metrics.set_gauge('work_queue_jobs', count, state=state)
+                metrics.write(metrics_path)
+                wait_for_mail(stop, subscriber, backoff.next_delay(bool(emails)))
+        finally:
+            if subscriber is not None:
+                subscriber.close()
+            heartbeat.beat('stopped')
+            db.close()
+    except Exception as e:
+        logger.error(f"Error in coordinator: {str(e)}")
+
+def run_worker(worker_id: str):
+    """Claim jobs from the shared queue and run their AI and send stages until asked to stop"""
+    try:
+        _, response_delay, db = setup()
+        configs = load_accounts()
+        ai_engine = create_ai_engine(configs)
+        accounts = create_accounts(db, configs, ai_engine)
+        work_queue = create_work_queue(db)
+        pipeline = create_pipeline(accounts, ai_engine, db, work_queue)
+        heartbeat = WorkerHeartbeat(db, worker_id, 'worker')
+        
+        stop = threading.Event()
+        install_stop_handler(stop)
+        claim_batch = int(os.getenv('WORKER_CLAIM_BATCH', 10))
+        metrics_path = snapshot_path(os.getenv('METRICS_PATH', DEFAULT_SNAPSHOT_PATH), worker_id)
+        # Idle workers poll the queue quickly at first, then settle at the fetch interval
+        backoff = AdaptiveBackoff(0.5, response_delay)
+        try:
+            while not stop.is_set():
+                jobs = work_queue.claim(limit=claim_batch)
+                if jobs:
+                    heartbeat.beat('busy')
+                    with work_queue.leases_held():
+                        pipeline.run(jobs)
+                    heartbeat.processed += len(jobs)
+                heartbeat.beat('idle')
+                flush_all(accounts, force=False)
+                metrics.write(metrics_path)
+                stop.wait(backoff.next_delay(bool(jobs)))
+        finally:
+            heartbeat.beat('draining')
+            pipeline.shutdown()
+            flush_all(accounts)
+            heartbeat.beat('stopped')
+            db.close()
+    except Exception as e:
+        logger.error(f"Error in {worker_id}: {str(e)}")
+
 if __name__ == "__main__":
     main()
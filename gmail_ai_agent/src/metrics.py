@@ -0,0 +1,199 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# Where the processor writes its snapshot for the web interface
+DEFAULT_SNAPSHOT_PATH = 'metrics.json'
+
+# Upper bounds in seconds; covers a fast cache hit up to a slow DALL-E render
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# USD per 1K prompt/completion tokens, and per image
+MODEL_PRICES = {
+    'gpt-4-0125-preview': (0.01, 0.03),
+}
+IMAGE_PRICES = {
+    ('dall-e-3', '1024x1024', 'standard'): 0.04,
+}
+
+HELP = {
+    'stage_seconds': 'Time spent in each pipeline stage',
+    'openai_tokens_total': 'OpenAI tokens used',
+    'openai_images_total': 'DALL-E images generated',
+    'openai_cost_usd_total': 'Estimated OpenAI spend in USD',
+    'cache_requests_total': 'Cache lookups by result',
+    'pipeline_queue_depth': 'Emails waiting in or running through each pipeline stage',
+    'emails_fetched_total': 'Emails fetched from Gmail',
+    'work_queue_jobs': 'Jobs in the durable work queue by state',
+}
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+def _key(name: str, labels: Dict[str, str]) -> LabelKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Metrics:
+    """Process-wide counters, gauges and histograms; every update is one dict write under a lock"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[LabelKey, float] = {}
+        self._gauges: Dict[LabelKey, float] = {}
+        self._histograms: Dict[LabelKey, list] = {}  # [bucket counts..., +Inf count, sum]
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def add_gauge(self, name: str, amount: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Record the duration of the with-block in stage_seconds, even if it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=stage)
+
+    def record_usage(self, model: str, usage):
+        """Count tokens and cost from an OpenAI response's usage block"""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        self.inc('openai_tokens_total', prompt_tokens, model=model, type='prompt')
+        self.inc('openai_tokens_total', completion_tokens, model=model, type='completion')
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        if cost:
+            self.inc('openai_cost_usd_total', cost, model=model)
+
+    def record_image(self, model: str, size: str, quality: str):
+        self.inc('openai_images_total', model=model)
+        cost = IMAGE_PRICES.get((model, size, quality), 0.0)
+        if cost:
+            self.inc('openai_cost_usd_total', cost, model=model)
+
+    def snapshot(self) -> Dict:
+        """JSON-serializable copy of every metric"""
+        with self._lock:
+            return {
+                'buckets': list(self.buckets),
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, dict(labels), value] for (name, labels), value in self._gauges.items()],
+                'histograms': [[name, dict(labels), list(h)] for (name, labels), h in self._histograms.items()],
+            }
+
+    def write(self, path: str):
+        """Atomically replace path with the current snapshot, for the web interface to serve"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+def snapshot_path(base: str, process_name: Optional[str] = None) -> str:
+    """Per-process snapshot file next to base, e.g. metrics.worker-1.json"""
+    if not process_name:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.{process_name}{ext}"
+
+def _snapshot_paths(base: str) -> List[str]:
+    root, ext = os.path.splitext(base)
+    return [base] + sorted(glob.glob(f"{glob.escape(root)}.*{ext}"))
+
+def clear_snapshots(base: str):
+    """Remove per-process snapshots left over from an earlier run"""
+    for path in _snapshot_paths(base)[1:]:
+        os.remove(path)
+
+def read_snapshot(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def read_snapshots(base: str) -> Optional[Dict]:
+    """Read base and every per-process snapshot next to it, summed into one"""
+    snapshots = [s for s in map(read_snapshot, _snapshot_paths(base)) if s is not None]
+    if not snapshots:
+        return None
+    merged = {'buckets': snapshots[0]['buckets']}
+    for section in ('counters', 'gauges', 'histograms'):
+        combined = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot[section]:
+                key = _key(name, labels)
+                if key not in combined:
+                    combined[key] = value
+                elif section == 'histograms':
+                    combined[key] = [a + b for a, b in zip(combined[key], value)]
+                else:
+                    combined[key] = combined[key] + value
+        merged[section] = [[name, dict(labels), value] for (name, labels), value in combined.items()]
+    return merged
+
+def _labels(labels: Dict[str, str], **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+def render_prometheus(snapshot: Dict) -> str:
+    """Render a snapshot in the Prometheus text exposition format"""
+    lines = []
+    typed = set()
+
+    def header(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for name, labels, value in sorted(snapshot['counters'], key=lambda m: m[0]):
+        header(name, 'counter')
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for name, labels, value in sorted(snapshot['gauges'], key=lambda m: m[0]):
+        header(name, 'gauge')
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for name, labels, histogram in sorted(snapshot['histograms'], key=lambda m: m[0]):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(snapshot['buckets'], histogram):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+        cumulative += histogram[-2]
+        lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {histogram[-1]}")
+        lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+# Shared by every stage in the processor
+metrics = Metrics()
@@ -0,0 +1,82 @@
+import base64
+import html
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Tags whose content is never visible text
+_INVISIBLE = re.compile(r"<(script|style|head)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+# Tags that end a visual line
+_LINE_BREAK = re.compile(r"<(br|/p|/div|/tr|/h[1-6]|/li)\b[^>]*>", re.IGNORECASE)
+_TAG = re.compile(r"<[^>]+>")
+_BLANK_LINES = re.compile(r"\n\s*\n\s*\n+")
+_SPACES = re.compile(r"[ \t\r\f\v]+")
+
+def html_to_text(markup: str) -> str:
+    """Cheap HTML to plain text: drop invisible blocks and tags, keep line structure"""
+    text = _INVISIBLE.sub("", markup)
+    text = _LINE_BREAK.sub("\n", text)
+    text = html.unescape(_TAG.sub("", text))
+    text = "\n".join(_SPACES.sub(" ", line).strip() for line in text.split("\n"))
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+def _headers(part: Dict) -> Dict[str, str]:
+    return {h['name'].lower(): h['value'] for h in part.get('headers', [])}
+
+def _charset(headers: Dict[str, str]) -> str:
+    match = re.search(r'charset="?([\w.:-]+)"?', headers.get('content-type', ''), re.IGNORECASE)
+    return match.group(1) if match else 'utf-8'
+
+def _decode_text(part: Dict, headers: Dict[str, str]) -> str:
+    data = part.get('body', {}).get('data')
+    if not data:
+        return ""
+    raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    try:
+        return raw.decode(_charset(headers), errors='replace')
+    except LookupError:  # Unknown charset name
+        return raw.decode('utf-8', errors='replace')
+
+def parse_payload(payload: Dict) -> Tuple[str, List[Dict]]:
+    """Walk a Gmail message payload and return (best text body, attachment metadata)
+
+    Plain text is preferred over HTML; attachment bytes are never decoded here.
+    """
+    plain: Optional[str] = None
+    markup: Optional[str] = None
+    attachments = []
+
+    # Iterative depth-first walk keeps document order without recursion limits
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('parts'):
+            stack.extend(reversed(part['parts']))
+            continue
+
+        headers = _headers(part)
+        mime_type = part.get('mimeType', '').lower()
+        filename = part.get('filename', '')
+        disposition = headers.get('content-disposition', '').lower()
+
+        if filename or disposition.startswith('attachment'):
+            # Inline parts (signature logos, embedded images) are not assets the sender provided
+            if not disposition.startswith('inline'):
+                attachments.append({
+                    'filename': filename,
+                    'mime_type': mime_type,
+                    'size': part.get('body', {}).get('size', 0),
+                    'attachment_id': part.get('body', {}).get('attachmentId'),
+                    'part_id': part.get('partId')
+                })
+            continue
+
+        if mime_type == 'text/plain' and plain is None:
+            plain = _decode_text(part, headers)
+        elif mime_type == 'text/html' and markup is None:
+            markup = _decode_text(part, headers)
+
+    if plain and plain.strip():
+        return plain, attachments
+    if markup:
+        return html_to_text(markup), attachments
+    return plain or "", attachments
@@ -0,0 +1,58 @@
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+class SenderRule(NamedTuple):
+    email: str
+    instructions_path: Optional[str] = None  # None uses the default instructions.txt
+
+class AccountConfig(NamedTuple):
+    name: str
+    credentials_path: str
+    senders: List[SenderRule]
+    token_path: str = 'config/token.json'
+
+def load_monitor_config(path: str, default_sender: str) -> List[AccountConfig]:
+    """Read the accounts and senders to monitor; without a config file, watch default_sender only
+
+    Relative instruction and credential paths are resolved against the config file's directory.
+    """
+    if not os.path.exists(path):
+        return [AccountConfig('default', 'config/credentials.json', [SenderRule(default_sender)], 'config/token.json')]
+    config_dir = os.path.dirname(path)
+
+    def resolve(value: Optional[str]) -> Optional[str]:
+        if value is None or os.path.isabs(value):
+            return value
+        return os.path.join(config_dir, value)
+
+    with open(path, 'r') as f:
+        config = json.load(f)
+
+    accounts = []
+    for account in config['accounts']:
+        senders = [
+            SenderRule(sender['email'], resolve(sender.get('instructions')))
+            for sender in account['senders']
+        ]
+        if not senders:
+            raise ValueError(f"Account {account['name']!r} has no senders to monitor")
+        accounts.append(AccountConfig(
+            name=account['name'],
+            credentials_path=resolve(account.get('credentials', 'credentials.json')),
+            senders=senders,
+            # Each account needs its own token; the default one keeps the standalone file name
+            token_path=resolve(account.get('token', 'token.json' if account['name'] == 'default' else f"token_{account['name']}.json"))
+        ))
+    if len({a.name for a in accounts}) != len(accounts):
+        raise ValueError("Account names in the monitor config must be unique")
+    return accounts
+
+def sender_instructions(accounts: List[AccountConfig]) -> Dict[str, str]:
+    """Sender address -> instructions path for every sender with its own instruction set"""
+    return {
+        sender.email: sender.instructions_path
+        for account in accounts
+        for sender in account.senders
+        if sender.instructions_path
+    }
@@ -0,0 +1,124 @@
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+class QueueSubscriber:
+    """Inbox notifications delivered through an in-process queue; also the stand-in used by tests"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def push(self, notification: Dict):
+        self._queue.put(notification)
+
+    def wait(self, timeout: float) -> Optional[Dict]:
+        """Block until a notification arrives or timeout passes, returning the newest one
+
+        A burst of notifications is drained at once so it triggers a single incremental fetch.
+        """
+        try:
+            notification = self._queue.get(timeout=max(0.0, timeout))
+        except queue.Empty:
+            return None
+        while True:
+            try:
+                notification = self._queue.get_nowait()
+            except queue.Empty:
+                return notification
+
+    def close(self):
+        pass
+
+class HttpPushSubscriber(QueueSubscriber):
+    """Receives Cloud Pub/Sub push deliveries for a Gmail watch on a local HTTP endpoint"""
+
+    def __init__(self, host: str = '0.0.0.0', port: int = 8085, path: str = '/gmail/push', token: Optional[str] = None):
+        super().__init__()
+        self.path = path
+        self.token = token
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Listening for Gmail push notifications on {host}:{self.port}{path}")
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler(self):
+        subscriber = self
+
+        class PushHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != subscriber.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if subscriber.token and parse_qs(url.query).get('token', [None])[0] != subscriber.token:
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                try:
+                    envelope = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    data = base64.b64decode(envelope['message']['data'])
+                    subscriber.push(json.loads(data))
+                except Exception as e:
+                    # Acknowledge anyway; Pub/Sub would otherwise redeliver a malformed message forever
+                    logger.error(f"Ignoring malformed push notification: {str(e)}")
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return PushHandler
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class AdaptiveBackoff:
+    """Poll interval that grows while the inbox is idle and snaps back when mail arrives"""
+
+    def __init__(self, min_interval: float, max_interval: float, factor: float = 2.0):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.factor = factor
+        self.interval = min_interval
+
+    def next_delay(self, found_mail: bool) -> float:
+        if found_mail:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+        return self.interval
+
+class InboxWatcher:
+    """Keeps a Gmail users.watch registration alive; Gmail drops it after 7 days"""
+
+    def __init__(self, gmail_client, topic_name: str, renew_interval: float = 24 * 3600):
+        self.gmail_client = gmail_client
+        self.topic_name = topic_name
+        self.renew_interval = renew_interval
+        self._renew_at = 0.0
+
+    def ensure(self):
+        """Register or renew the watch when it is due; failures are retried on the next call"""
+        if time.monotonic() < self._renew_at:
+            return
+        try:
+            response = self.gmail_client.watch(self.topic_name)
+            self._renew_at = time.monotonic() + self.renew_interval
+            logger.info(f"Watching inbox via {self.topic_name} (historyId {response.get('historyId')})")
+        except Exception as e:
+            logger.error(f"Error registering Gmail watch: {str(e)}")
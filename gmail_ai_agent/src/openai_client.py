@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, Optional
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Async token bucket refilled continuously at capacity units per minute"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        # Oversized requests would otherwise wait forever; let them drain the bucket instead
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class RateLimitedOpenAI:
+    """Drop-in for the openai.OpenAI calls AIEngine makes, with bounded concurrency, rate limiting and retries
+
+    Requests run on openai.AsyncOpenAI in one background event loop, so every thread using the client
+    shares the same limits; callers still get the blocking interface of the sync client.
+    """
+
+    # Status codes worth retrying; everything else is a caller error
+    RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        api_key: str,
+        max_concurrency: int = 8,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 30000,
+        max_retries: int = 5,
+        base_url: Optional[str] = None
+    ):
+        # Retries are handled here so they share the rate limiters and honour Retry-After
+        self._client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self._limits = None
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+        self.images = SimpleNamespace(generate=self._generate_image)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='openai-event-loop', daemon=True)
+        self._thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def close(self):
+        self._run(self._loop.shutdown_asyncgens())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _get_limits(self):
+        # asyncio primitives bind to the running loop, so create them lazily
+        if self._limits is None:
+            self._limits = (
+                asyncio.Semaphore(self.max_concurrency),
+                TokenBucket(self.requests_per_minute),
+                TokenBucket(self.tokens_per_minute)
+            )
+        return self._limits
+
+    @staticmethod
+    def _estimate_tokens(request: Dict) -> int:
+        # Roughly four characters per token for the prompt, plus the completion budget
+        prompt_chars = sum(len(m['content']) for m in request.get('messages', []))
+        return prompt_chars // 4 + request.get('max_tokens', 0)
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        response = getattr(error, 'response', None)
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+            if retry_after:
+                try:
+                    return max(0.0, float(retry_after))
+                except ValueError:
+                    pass
+        # Exponential backoff with jitter: ~1s, 2s, 4s, ... capped at 60s
+        return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+    def _is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, openai.APIConnectionError):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code in self.RETRY_STATUS
+
+    async def _call(self, create, tokens: int, hold: bool = False, **request):
+        """Run an OpenAI call under the concurrency and rate limits, retrying transient failures
+
+        With hold, a successful call keeps its concurrency slot and the caller must release the semaphore.
+        """
+        semaphore, request_bucket, token_bucket = self._get_limits()
+        for attempt in range(self.max_retries + 1):
+            await request_bucket.acquire(1)
+            await token_bucket.acquire(tokens)
+            await semaphore.acquire()
+            try:
+                result = await create(**request)
+            except Exception as e:
+                semaphore.release()
+                if attempt == self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._retry_delay(attempt, e)
+                logger.warning(f"OpenAI call failed ({str(e)}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            if not hold:
+                semaphore.release()
+            return result
+
+    def _create_completion(self, **request):
+        tokens = self._estimate_tokens(request)
+        if request.get('stream'):
+            # A stream occupies its slot until it has been read to the end or closed
+            return _BlockingStream(self, self._run(self._call(self._client.chat.completions.create, tokens, hold=True, **request)))
+        return self._run(self._call(self._client.chat.completions.create, tokens, **request))
+
+    def _generate_image(self, **request):
+        return self._run(self._call(self._client.images.generate, 0, **request))
+
+class _BlockingStream:
+    """Blocking iterator over a streamed completion that holds a concurrency slot until closed"""
+
+    def __init__(self, client: RateLimitedOpenAI, stream):
+        self._client = client
+        self._stream = stream
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self._client._run(self._stream.__anext__())
+        except StopAsyncIteration:
+            self.close()
+            raise StopIteration
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._client._run(self._stream.close())
+        finally:
+            semaphore = self._client._get_limits()[0]
+            self._client._loop.call_soon_threadsafe(semaphore.release)
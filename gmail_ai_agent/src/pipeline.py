@@ -0,0 +1,94 @@
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class SendRateLimiter:
+    """Spaces outgoing emails by a global interval and a per-recipient interval"""
+
+    def __init__(self, global_interval: float = 1.0, recipient_interval: float = 5.0):
+        self.global_interval = global_interval
+        self.recipient_interval = recipient_interval
+        self._lock = threading.Lock()
+        self._next_global = 0.0
+        self._next_recipient: Dict[str, float] = {}
+
+    def reserve(self, recipient: str) -> float:
+        """Reserve the next send slot for recipient and return the seconds to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_global, self._next_recipient.get(recipient, 0.0))
+            self._next_global = slot + self.global_interval
+            self._next_recipient[recipient] = slot + self.recipient_interval
+
+            # Forget recipients whose spacing window has already passed
+            if len(self._next_recipient) > 1000:
+                self._next_recipient = {r: t for r, t in self._next_recipient.items() if t > now}
+            return slot - now
+
+    def acquire(self, recipient: str):
+        """Block until recipient may be sent another email"""
+        delay = self.reserve(recipient)
+        if delay > 0:
+            time.sleep(delay)
+
+class EmailPipeline:
+    """Runs the AI and send stages for a batch of emails on bounded thread pools"""
+
+    def __init__(
+        self,
+        draft: Callable[[Dict], Optional[Tuple[str, Optional[str]]]],
+        send: Callable[[Dict, str, Optional[str]], None],
+        rate_limiter: SendRateLimiter,
+        ai_workers: int = 4,
+        send_workers: int = 2
+    ):
+        self.draft = draft
+        self.send = send
+        self.rate_limiter = rate_limiter
+        self._ai_pool = ThreadPoolExecutor(max_workers=ai_workers, thread_name_prefix="ai")
+        self._send_pool = ThreadPoolExecutor(max_workers=send_workers, thread_name_prefix="send")
+
+    def run(self, emails: List[Dict]):
+        """Process emails concurrently and wait until every reply has been sent or dropped"""
+        metrics.add_gauge('pipeline_queue_depth', len(emails), stage='draft')
+        draft_futures = [self._ai_pool.submit(self._draft, email) for email in emails]
+        for draft_future in draft_futures:
+            send_future = draft_future.result()
+            if send_future is not None:
+                send_future.result()
+
+    def _draft(self, email: Dict) -> Optional[Future]:
+        # Hand the reply to the send stage as soon as it is drafted
+        try:
+            drafted = self.draft(email)
+        except Exception as e:
+            logger.error(f"Error drafting reply for email {email['id']}: {str(e)}")
+            return None
+        finally:
+            metrics.add_gauge('pipeline_queue_depth', -1, stage='draft')
+        if drafted is None:
+            return None
+        response, image_path = drafted
+        metrics.add_gauge('pipeline_queue_depth', 1, stage='send')
+        return self._send_pool.submit(self._send, email, response, image_path)
+
+    def _send(self, email: Dict, response: str, image_path: Optional[str]):
+        try:
+            with metrics.timer('send_wait'):
+                self.rate_limiter.acquire(email['from'])
+            self.send(email, response, image_path)
+        except Exception as e:
+            logger.error(f"Error sending reply for email {email['id']}: {str(e)}")
+        finally:
+            metrics.add_gauge('pipeline_queue_depth', -1, stage='send')
+
+    def shutdown(self):
+        """Stop both pools once in-flight work has finished"""
+        self._ai_pool.shutdown(wait=True)
+        self._send_pool.shutdown(wait=True)
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # Optional; fall back to a character-based estimate
+    tiktoken = None
+
+class InstructionFile:
+    """An instruction file that is re-read only when its mtime changes"""
+
+    def __init__(self, path: str, default: Optional[str] = None):
+        self.path = path
+        self.default = default
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._text = default
+        self._hash = None
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if self.default is None:
+                raise
+            mtime = None
+        with self._lock:
+            if mtime == self._mtime and self._hash is not None:
+                return
+            if mtime is None:
+                text = self.default
+            else:
+                with open(self.path, 'r') as f:
+                    text = f.read()
+                if self._mtime is not None:
+                    logger.info(f"Reloaded instructions from {self.path}")
+            self._text = text
+            self._hash = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+            self._mtime = mtime
+
+    @property
+    def text(self) -> str:
+        self._refresh()
+        return self._text
+
+    @property
+    def hash(self) -> str:
+        """Short content hash, used to key caches on the instruction version"""
+        self._refresh()
+        return self._hash
+
+class _EncodingLoad:
+    """Background load of one tiktoken encoding
+
+    tiktoken downloads the encoding file on first use (then caches it under TIKTOKEN_CACHE_DIR), with no
+    timeout of its own, so it runs off the caller's thread.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.encoding = None
+        self.started = time.monotonic()
+        self._done = threading.Event()
+        threading.Thread(target=self._load, name=f"tiktoken-{name}", daemon=True).start()
+
+    def _load(self):
+        try:
+            self.encoding = tiktoken.get_encoding(self.name)
+        except Exception as e:
+            logger.warning(f"Falling back to estimated token counts: {str(e)}")
+        finally:
+            self._done.set()
+
+    def result(self, timeout: float):
+        """The encoding, waiting until timeout seconds after the load started; None if not ready"""
+        if not self._done.wait(max(0.0, self.started + timeout - time.monotonic())):
+            return None
+        return self.encoding
+
+_encoding_loads = {}
+_encoding_loads_lock = threading.Lock()
+
+def _load_encoding(name: str, timeout: float):
+    """The tiktoken encoding once it has loaded, or None if tiktoken is unavailable or still loading"""
+    if tiktoken is None:
+        return None
+    with _encoding_loads_lock:
+        load = _encoding_loads.get(name)
+        if load is None:
+            load = _encoding_loads[name] = _EncodingLoad(name)
+    return load.result(timeout)
+
+class TokenCounter:
+    """Counts and truncates text in model tokens, using tiktoken when it is installed
+
+    The encoding loads lazily on first use. Callers wait at most load_timeout seconds for it; until it
+    is available (offline, slow download, tiktoken missing) counts are estimated at four characters per
+    token, which is close enough for trimming email bodies to a budget.
+    """
+
+    def __init__(self, encoding: str = "cl100k_base", load_timeout: float = 5.0):
+        self.encoding_name = encoding
+        self.load_timeout = load_timeout
+
+    @property
+    def _encoding(self):
+        return _load_encoding(self.encoding_name, self.load_timeout)
+
+    def count(self, text: str) -> int:
+        encoding = self._encoding
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        # About four characters per token for English text
+        return (len(text) + 3) // 4
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut text to at most max_tokens, marking the cut"""
+        if self.count(text) <= max_tokens:
+            return text
+        encoding = self._encoding
+        if encoding is not None:
+            tokens = encoding.encode(text, disallowed_special=())
+            return encoding.decode(tokens[:max_tokens]) + "\n[...truncated]"
+        return text[:max_tokens * 4] + "\n[...truncated]"
+
+# Start of the quoted history most mail clients append to replies
+QUOTE_HEADER = re.compile(
+    r"^(On .{0,200}wrote:|-{2,}\s*Original Message\s*-{2,}|From: .+)\s*$",
+    re.MULTILINE | re.IGNORECASE
+)
+
+def strip_quoted_history(body: str) -> str:
+    """Drop quoted replies ('> ...' lines and everything after an 'On ... wrote:' header)"""
+    match = QUOTE_HEADER.search(body)
+    if match and match.start() > 0:
+        body = body[:match.start()]
+    lines = [line for line in body.splitlines() if not line.lstrip().startswith('>')]
+    return "\n".join(lines).strip()
+
+def fit_body(body: str, counter: TokenCounter, max_tokens: int) -> str:
+    """Shrink an email body to max_tokens: quoted history goes first, then the tail is cut"""
+    if counter.count(body) <= max_tokens:
+        return body
+    return counter.truncate(strip_quoted_history(body) or body, max_tokens)
@@ -0,0 +1,128 @@
+import os
+import re
+from typing import Iterable, Optional
+
+# Used when no banned phrase file is configured
+DEFAULT_BANNED_PHRASES = [
+    'as an ai language model',
+    'as an ai assistant',
+    "i'm sorry, but i can't",
+    'i cannot assist with',
+    '[your name]',
+    '[brand name]',
+]
+
+class ResponseGuard:
+    """Checks generated replies for banned phrases, incrementally as text streams in"""
+
+    def __init__(self, banned_phrases: Iterable[str] = DEFAULT_BANNED_PHRASES, min_length: int = 10):
+        self.banned_phrases = [p.strip().lower() for p in banned_phrases if p.strip()]
+        self.min_length = min_length
+        self._overlap = max((len(p) for p in self.banned_phrases), default=1) - 1
+
+    @classmethod
+    def from_file(cls, path: str) -> 'ResponseGuard':
+        """Load one phrase per line ('#' starts a comment), falling back to the defaults if missing"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as f:
+            return cls(line.split('#', 1)[0] for line in f)
+
+    def check(self, text: str) -> Optional[str]:
+        """Return why text must not be sent, or None if it passes"""
+        if not text or len(text.strip()) < self.min_length:
+            return "response too short"
+        return self._find_banned(text.lower())
+
+    def _find_banned(self, lowered: str) -> Optional[str]:
+        for phrase in self.banned_phrases:
+            if phrase in lowered:
+                return f"banned phrase: {phrase!r}"
+        return None
+
+    def stream(self) -> 'StreamCheck':
+        return StreamCheck(self)
+
+    def stream_json_field(self, field: str) -> 'JsonFieldCheck':
+        return JsonFieldCheck(self, field)
+
+class StreamCheck:
+    """Per-generation state for ResponseGuard; only rescans the new text plus a phrase-length overlap"""
+
+    def __init__(self, guard: ResponseGuard):
+        self.guard = guard
+        self.parts = []
+        self._tail = ""
+
+    def feed(self, delta: str) -> Optional[str]:
+        """Add a streamed chunk and return a reason to abort, or None to keep going"""
+        self.parts.append(delta)
+        window = self._tail + delta.lower()
+        reason = self.guard._find_banned(window)
+        self._tail = window[-self.guard._overlap:] if self.guard._overlap else ""
+        return reason
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+class JsonFieldCheck:
+    """StreamCheck over one string field of a streamed JSON object, decoded as it arrives
+
+    Lets a single-call JSON completion be cut off as soon as its reply goes wrong. text is the raw JSON.
+    """
+
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, guard: ResponseGuard, field: str):
+        self.check = StreamCheck(guard)
+        self._start = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._raw = ""
+        self._pos = None  # Index of the next undecoded character of the field's value
+        self._done = False
+
+    def feed(self, delta: str) -> Optional[str]:
+        """Add a streamed chunk of JSON and return a reason to abort, or None to keep going"""
+        self._raw += delta
+        if self._done:
+            return None
+        if self._pos is None:
+            match = self._start.search(self._raw)
+            if not match:
+                return None
+            self._pos = match.end()
+        decoded = self._decode()
+        return self.check.feed(decoded) if decoded else None
+
+    def _decode(self) -> str:
+        raw, pos, out = self._raw, self._pos, []
+        while pos < len(raw):
+            char = raw[pos]
+            if char == '"':
+                self._done = True
+                break
+            if char != '\\':
+                out.append(char)
+                pos += 1
+                continue
+            # Wait for the rest of an escape sequence split across chunks
+            if pos + 1 >= len(raw):
+                break
+            code = raw[pos + 1]
+            if code == 'u':
+                if pos + 6 > len(raw):
+                    break
+                try:
+                    out.append(chr(int(raw[pos + 2:pos + 6], 16)))
+                except ValueError:  # Malformed; the final JSON parse rejects it anyway
+                    pass
+                pos += 6
+            else:
+                out.append(self.ESCAPES.get(code, code))
+                pos += 2
+        self._pos = pos
+        return "".join(out)
+
+    @property
+    def text(self) -> str:
+        return self._raw
@@ -0,0 +1,450 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import requests
+
+from src.ai_cache import AICache
+from src.ai_engine import PNG_SIGNATURE, AIEngine, EmailAction
+from src.database import EmailDatabase
+from src.image_library import ImageLibrary
+from src.keyword_matcher import KeywordMatcher
+from src.main import draft_reply
+from src import prompt_templates
+from src.prompt_templates import TokenCounter, fit_body, strip_quoted_history
+from src.response_guard import ResponseGuard
+from src.thread_context import ThreadContextStore
+
+class FakeCompletions:
+    """Stand-in for client.chat.completions that replays canned replies"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = []
+        self.streams = []
+
+    def create(self, stream=False, **kwargs):
+        self.calls.append(kwargs)
+        content = self.replies.pop(0)
+        if stream:
+            self.streams.append(FakeStream(content))
+            return self.streams[-1]
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+class FakeStream:
+    """Streams a canned reply a few characters at a time"""
+
+    def __init__(self, content, chunk_size=4):
+        self.chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.consumed += 1
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))])
+
+    def close(self):
+        self.closed = True
+
+def make_engine(tmp_path, replies, **kwargs):
+    instructions = tmp_path / 'instructions.txt'
+    instructions.write_text('Be polite.')
+    (tmp_path / 'instruction_image.txt').write_text('A photo of a [car]')
+    engine = AIEngine(api_key='test', instructions_path=str(instructions), **kwargs)
+    completions = FakeCompletions(replies)
+    engine.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return engine, completions
+
+EMAIL = {
+    'id': 'm1',
+    'from': 'brand@example.com',
+    'subject': 'Paid collaboration',
+    'body': 'We would like to pay you for a video about our product.'
+}
+
+def test_generate_response_uses_single_call(tmp_path):
+    engine, completions = make_engine(tmp_path, [json.dumps({
+        'is_car': False,
+        'action': 'NEGOTIATION',
+        'car_details': None,
+        'reply': 'Thanks for reaching out, my rate is $500.'
+    })])
+
+    reply, image_path, action = engine.generate_response(EMAIL)
+
+    assert reply == 'Thanks for reaching out, my rate is $500.'
+    assert image_path is None
+    assert action == EmailAction.NEGOTIATION
+    assert len(completions.calls) == 1
+
+def test_generate_response_falls_back_on_invalid_json(tmp_path):
+    engine, completions = make_engine(tmp_path, [
+        'not json',
+        'REJECTED',
+        'Thanks, but I will pass on this one.'
+    ])
+
+    reply, image_path, action = engine.generate_response(EMAIL)
+
+    assert reply == 'Thanks, but I will pass on this one.'
+    assert action == EmailAction.REJECTED
+    # Failed analysis, action classifier, reply generator (no car keywords)
+    assert len(completions.calls) == 3
+
+def test_cache_serves_repeated_email(tmp_path):
+    analysis = json.dumps({
+        'is_car': False,
+        'action': 'NEGOTIATION',
+        'car_details': None,
+        'reply': 'Thanks for reaching out, my rate is $500.'
+    })
+    cache = AICache(db_path=str(tmp_path / 'cache.db'))
+    engine, completions = make_engine(tmp_path, [analysis], cache=cache)
+
+    first = engine.generate_response(EMAIL)
+    # Whitespace-only differences hit the same entry
+    second = engine.generate_response(dict(EMAIL, body=EMAIL['body'] + '\n  '))
+
+    assert first == second
+    assert len(completions.calls) == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+class BrokenCache(AICache):
+    def get(self, key):
+        raise sqlite3.OperationalError('database is locked')
+
+    def set(self, key, value):
+        raise sqlite3.OperationalError('database is locked')
+
+def test_cache_errors_count_as_a_miss(tmp_path):
+    engine, completions = make_engine(tmp_path, [json.dumps({
+        'is_car': False,
+        'action': 'NEGOTIATION',
+        'car_details': None,
+        'reply': 'Thanks for reaching out, my rate is $500.'
+    })], cache=BrokenCache(db_path=str(tmp_path / 'cache.db')))
+
+    reply, _, action = engine.generate_response(EMAIL)
+
+    assert reply == 'Thanks for reaching out, my rate is $500.'
+    assert action == EmailAction.NEGOTIATION
+    assert len(completions.calls) == 1
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = AICache(db_path=str(tmp_path / 'cache.db'), max_entries=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.set('c', '3')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == '1'
+    assert cache.get('c') == '3'
+
+def test_cache_expires_entries(tmp_path):
+    cache = AICache(db_path=str(tmp_path / 'cache.db'), ttl=-1)
+    cache.set('a', '1')
+
+    assert cache.get('a') is None
+
+def test_image_library_shares_one_generation(tmp_path):
+    library = ImageLibrary(directory=str(tmp_path / 'library'))
+    calls = []
+
+    def generate(image_path):
+        calls.append(image_path)
+        time.sleep(0.05)
+        with open(image_path, 'wb') as f:
+            f.write(b'png')
+        return True
+
+    key = library.make_key('Red Tesla Model 3', 'A photo of a [car]')
+    assert key == library.make_key('  red tesla model-3 ', 'A photo of a [car]')
+    assert key != library.make_key('Red Tesla Model 3', 'A drawing of a [car]')
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(library.get_or_create(key, generate))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert set(results) == {library.path_for(key)}
+    assert library.get_or_create(key, generate) == library.path_for(key)
+    assert len(calls) == 1
+
+def test_image_library_evicts_oldest(tmp_path):
+    library = ImageLibrary(directory=str(tmp_path / 'library'), max_images=2)
+
+    def generate(image_path):
+        with open(image_path, 'wb') as f:
+            f.write(b'png')
+        return True
+
+    paths = []
+    for i, car in enumerate(['Audi A4', 'BMW M3', 'Ford Mustang']):
+        paths.append(library.get_or_create(library.make_key(car, ''), generate))
+        time.sleep(0.01)
+
+    assert not os.path.exists(paths[0])
+    assert all(library.contains(path) for path in paths[1:])
+
+PNG = PNG_SIGNATURE + os.urandom(200 * 1024)
+
+def test_store_image_decodes_inline_base64(tmp_path):
+    image_path = str(tmp_path / 'image.png')
+    image = SimpleNamespace(b64_json=base64.b64encode(PNG).decode(), url=None)
+
+    assert AIEngine._store_image(image, image_path)
+    assert open(image_path, 'rb').read() == PNG
+
+    bad = SimpleNamespace(b64_json=base64.b64encode(b'<html>error</html>').decode(), url=None)
+    assert not AIEngine._store_image(bad, str(tmp_path / 'bad.png'))
+    assert sorted(os.listdir(tmp_path)) == ['image.png']
+
+def test_concurrent_saves_use_separate_temp_files(tmp_path):
+    image_path = str(tmp_path / 'car_image_key.png')
+    started = threading.Barrier(2)
+
+    def chunks():
+        yield PNG[:1024]
+        started.wait()
+        yield PNG[1024:]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(AIEngine._save_image(chunks(), image_path, len(PNG))))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True, True]
+    assert open(image_path, 'rb').read() == PNG
+    assert os.listdir(tmp_path) == ['car_image_key.png']
+
+    # _new_image_path creates generated_images/ in the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        assert AIEngine._new_image_path() != AIEngine._new_image_path()
+    finally:
+        os.chdir(cwd)
+
+def test_download_image_streams_and_checks_length(tmp_path):
+    bodies = [(PNG, len(PNG)), (PNG[:1000], len(PNG))]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            body, length = bodies.pop(0)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            self.wfile.write(body)
+            if len(body) < length:
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/image.png"
+    try:
+        assert AIEngine._download_image(url, str(tmp_path / 'image.png'))
+        assert open(tmp_path / 'image.png', 'rb').read() == PNG
+
+        # A connection dropped mid-body must not leave a partial image behind
+        try:
+            saved = AIEngine._download_image(url, str(tmp_path / 'short.png'))
+        except requests.RequestException:
+            saved = False
+        assert not saved
+        assert sorted(os.listdir(tmp_path)) == ['image.png']
+    finally:
+        server.shutdown()
+
+def test_keyword_matcher_matches_whole_words():
+    matcher = KeywordMatcher(['car', 'auto', 'sponsorship car'])
+
+    assert matcher.find('Automatic payouts for your autograph') == []
+    matches = matcher.find('Our new cars need a Sponsorship  Car video', 'body')
+    assert [(m.keyword, m.start) for m in matches] == [('car', 8), ('sponsorship car', 20)]
+    assert matches[0].field == 'body'
+
+def test_keyword_matcher_reads_keyword_file(tmp_path):
+    path = tmp_path / 'car_keywords.txt'
+    path.write_text('# comment\nRivian\n\nford  # brand\n')
+    matcher = KeywordMatcher.from_file(str(path))
+
+    assert [m.keyword for m in matcher.find('A Rivian or a Ford?')] == ['rivian', 'ford']
+    assert KeywordMatcher.from_file(str(tmp_path / 'missing.txt')).find('a car') != []
+
+def test_streamed_reply_aborts_on_banned_phrase(tmp_path):
+    engine, completions = make_engine(tmp_path, [
+        'REJECTED',
+        'As an AI language model, I cannot negotiate. ' + 'Padding text. ' * 50
+    ], single_call=False)
+
+    reply, _, _ = engine.generate_response(EMAIL)
+
+    assert reply == ''
+    assert not engine.validate_response(reply)
+    stream = completions.streams[-1]
+    assert stream.closed
+    assert stream.consumed < len(stream.chunks) // 10
+
+def test_single_call_analysis_streams_and_aborts_on_banned_phrase(tmp_path):
+    engine, completions = make_engine(tmp_path, [json.dumps({
+        'is_car': False,
+        'action': 'NEGOTIATION',
+        'car_details': None,
+        'reply': 'As an AI language model, I cannot negotiate. ' + 'Padding text. ' * 50
+    })])
+
+    reply, image_path, action = engine.generate_response(EMAIL)
+
+    # Cut off inside the JSON reply, with no fallback to the per-question calls
+    assert (reply, image_path, action) == ('', None, None)
+    assert len(completions.calls) == 1
+    stream = completions.streams[-1]
+    assert stream.closed
+    assert stream.consumed < len(stream.chunks) // 5
+
+def test_json_field_check_decodes_split_escapes():
+    check = ResponseGuard(['[your name]']).stream_json_field('reply')
+    # Three-character chunks split the escape sequences across feeds
+    raw = r'{"action": "NEGOTIATION", "reply": "Hi \"team\",\nCaf\u00e9 soon. Best, [your name]"}'
+    reasons = [check.feed(raw[i:i + 3]) for i in range(0, len(raw), 3)]
+
+    assert [r for r in reasons if r] == ["banned phrase: '[your name]'"]
+    assert check.check.text == 'Hi "team",\nCafé soon. Best, [your name]'
+    assert check.text == raw
+
+def test_validate_response_rejects_banned_phrases(tmp_path):
+    engine, _ = make_engine(tmp_path, [])
+
+    assert engine.validate_response('Hi, thanks for the offer. Best, Alex')
+    assert not engine.validate_response('Hi, thanks for the offer. Best, [Your Name]')
+    assert not engine.validate_response('Short')
+
+def test_instructions_reload_when_file_changes(tmp_path):
+    engine, _ = make_engine(tmp_path, [])
+    first_hash = engine.instructions_hash
+
+    path = tmp_path / 'instructions.txt'
+    path.write_text('Be brief.')
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000))
+
+    assert engine.instructions == 'Be brief.'
+    assert engine.instructions_hash != first_hash
+
+def test_sender_instructions_route_by_monitored_sender(tmp_path):
+    brand_instructions = tmp_path / 'brand.txt'
+    brand_instructions.write_text('Brand rate is $900.')
+    engine, _ = make_engine(tmp_path, [], sender_instructions={'Brand@Example.com': str(brand_instructions)})
+
+    routed = dict(EMAIL, monitored_sender='brand@example.com')
+    other = dict(EMAIL, monitored_sender='other@example.com')
+
+    assert 'Brand rate is $900.' in engine._create_prompt(routed)
+    assert 'Be polite.' in engine._create_prompt(other)
+    assert 'Be polite.' in engine._create_prompt(EMAIL)
+    # Different instructions must never share a cached reply
+    assert engine._cache_key('reply', routed, 'gpt') != engine._cache_key('reply', other, 'gpt')
+
+class NewThreadGmail:
+    def get_thread_messages(self, thread_id):
+        return [{'id': 'm1', 'from': 'brand@example.com', 'body': EMAIL['body']}]
+
+def test_draft_reply_with_cache_on_new_thread(tmp_path):
+    engine, completions = make_engine(tmp_path, [json.dumps({
+        'is_car': False,
+        'action': 'NEGOTIATION',
+        'car_details': None,
+        'reply': 'Thanks for reaching out, my rate is $500.'
+    })], cache=AICache(db_path=str(tmp_path / 'cache.db')))
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    email = dict(EMAIL, thread_id='t1')
+
+    drafted = draft_reply(engine, email, db, ThreadContextStore(db, NewThreadGmail(), engine))
+
+    # The first message of a thread has no summary; that must not break the cache key
+    assert email['thread_summary'] is None
+    assert drafted == ('Thanks for reaching out, my rate is $500.', None)
+    assert len(completions.calls) == 1
+
+def test_long_body_fits_token_budget():
+    counter = TokenCounter()
+    body = "Can we talk about a sponsorship?\n\nOn Mon, Jan 1, 2024 Brand wrote:\n" + "> old quoted text\n" * 2000
+
+    assert strip_quoted_history(body) == 'Can we talk about a sponsorship?'
+    assert fit_body(body, counter, 100) == 'Can we talk about a sponsorship?'
+    assert counter.count(fit_body('word ' * 5000, counter, 100)) <= 110
+    assert fit_body('Short body', counter, 100) == 'Short body'
+
+def test_token_counter_does_not_wait_for_a_stalled_download():
+    release = threading.Event()
+
+    class StalledTiktoken:
+        @staticmethod
+        def get_encoding(name):
+            release.wait()  # An encoding download that never finishes
+            raise OSError("offline")
+
+    real_tiktoken = prompt_templates.tiktoken
+    prompt_templates.tiktoken = StalledTiktoken
+    try:
+        started = time.monotonic()
+        counter = TokenCounter(encoding='stalled_test_encoding', load_timeout=0.2)
+        assert time.monotonic() - started < 0.1  # Construction never loads the encoding
+
+        assert counter.count('word ' * 100) == 125
+        assert counter.count('word ' * 100) == 125
+        assert time.monotonic() - started < 1.0
+    finally:
+        prompt_templates.tiktoken = real_tiktoken
+        release.set()
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        test_generate_response_uses_single_call(pathlib.Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_generate_response_falls_back_on_invalid_json(pathlib.Path(tmp))
+    for test in (test_cache_serves_repeated_email, test_cache_errors_count_as_a_miss,
+                 test_cache_evicts_least_recently_used, test_cache_expires_entries,
+                 test_image_library_shares_one_generation, test_image_library_evicts_oldest):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    for test in (test_streamed_reply_aborts_on_banned_phrase, test_single_call_analysis_streams_and_aborts_on_banned_phrase,
+                 test_validate_response_rejects_banned_phrases,
+                 test_store_image_decodes_inline_base64, test_concurrent_saves_use_separate_temp_files,
+                 test_download_image_streams_and_checks_length):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_instructions_reload_when_file_changes(pathlib.Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_sender_instructions_route_by_monitored_sender(pathlib.Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_draft_reply_with_cache_on_new_thread(pathlib.Path(tmp))
+    test_json_field_check_decodes_split_escapes()
+    test_long_body_fits_token_budget()
+    test_token_counter_does_not_wait_for_a_stalled_download()
+    test_keyword_matcher_matches_whole_words()
+    with tempfile.TemporaryDirectory() as tmp:
+        test_keyword_matcher_reads_keyword_file(pathlib.Path(tmp))
+    print("All tests passed")
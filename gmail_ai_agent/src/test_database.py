@@ -0,0 +1,144 @@
+import sqlite3
+import threading
+
+from src.database import EmailDatabase, EmailAction, MIGRATIONS
+from src.ledger import ProcessedLedger
+from src.thread_context import ThreadContextStore
+
+def test_migrates_legacy_database(tmp_path):
+    path = str(tmp_path / 'emails.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE emails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                timestamp DATETIME NOT NULL,
+                action TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("INSERT INTO emails (title, timestamp, action) VALUES ('Old', '2024-01-01T00:00:00', 'Rejected')")
+
+    db = EmailDatabase(path)
+
+    with db._connect() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(emails)")}
+        plan = " ".join(row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM emails WHERE action = ? ORDER BY timestamp DESC", ('Rejected',)
+        ))
+    assert {'idx_emails_timestamp', 'idx_emails_action_timestamp', 'idx_emails_gmail_id'} <= indexes
+    assert 'idx_emails_action_timestamp' in plan
+    assert db.get_latest_emails(1)[0]['title'] == 'Old'
+
+    # Reopening is a no-op
+    EmailDatabase(path).close()
+    db.close()
+
+def test_add_email_deduplicates_by_gmail_id(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+
+    db.add_email('Subject', EmailAction.NEGOTIATION, gmail_id='m1', thread_id='t1', sender='a@example.com', latency_ms=12.5)
+    db.add_email('Subject', EmailAction.REJECTED, gmail_id='m1', thread_id='t1', sender='a@example.com', latency_ms=8.0)
+    db.add_email('No Gmail ID', EmailAction.NEGOTIATION)
+    db.add_email('No Gmail ID', EmailAction.NEGOTIATION)
+
+    assert db.has_email('m1')
+    assert not db.has_email('m2')
+    assert len(db.get_all_emails()) == 3
+    assert [row[1] for row in db.get_emails_by_action(EmailAction.REJECTED)] == ['Subject']
+    db.close()
+
+def test_ledger_survives_restart(tmp_path):
+    path = str(tmp_path / 'emails.db')
+    ledger = ProcessedLedger(EmailDatabase(path), cache_size=2)
+    for gmail_id in ('m1', 'm2', 'm3'):
+        ledger.mark(gmail_id, ProcessedLedger.FETCHED)
+    ledger.mark('m1', ProcessedLedger.REPLIED)
+
+    restarted = ProcessedLedger(EmailDatabase(path), cache_size=2)
+
+    assert restarted.filter_new(['m0', 'm1', 'm2', 'm3', 'm4']) == ['m0', 'm4']
+    assert 'm3' in restarted
+    assert restarted.db.get_processed_state('m1') == ProcessedLedger.REPLIED
+
+def test_ledger_compacts_old_entries(tmp_path):
+    ledger = ProcessedLedger(EmailDatabase(str(tmp_path / 'emails.db')), retention_days=-1, compact_interval=0)
+    ledger.mark('m1', ProcessedLedger.REPLIED)
+    ledger.mark('m2', ProcessedLedger.REPLIED)
+
+    assert ledger.db.get_processed_ids(['m1', 'm2']) == set()
+
+def test_connections_close_when_threads_exit(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+
+    def read():
+        db.get_latest_emails(3)
+
+    for _ in range(50):
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+
+    # Only the creating thread's connection is left
+    assert len(db._connections) == 1
+    db.close()
+
+class FakeThreadGmail:
+    def __init__(self, messages):
+        self.messages = messages
+        self.fetches = 0
+
+    def get_thread_messages(self, thread_id):
+        self.fetches += 1
+        return self.messages
+
+class FakeSummarizer:
+    def __init__(self):
+        self.calls = []
+
+    def summarize_thread(self, previous_summary, messages):
+        self.calls.append((previous_summary, [m['body'] for m in messages]))
+        return (previous_summary + " | " if previous_summary else "") + " / ".join(m['body'] for m in messages)
+
+def test_thread_context_fetches_history_once(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    gmail = FakeThreadGmail([
+        {'id': 'm1', 'from': 'brand@example.com', 'body': 'Offer $100'},
+        {'id': 'm2', 'from': 'me', 'body': 'Counter $300'},
+        {'id': 'm3', 'from': 'brand@example.com', 'body': 'Meet at $200?'},
+    ])
+    summarizer = FakeSummarizer()
+    store = ThreadContextStore(db, gmail, summarizer)
+    email = {'id': 'm3', 'thread_id': 't1', 'from': 'brand@example.com', 'body': 'Meet at $200?'}
+
+    assert store.get_summary(email) == 'Offer $100 / Counter $300'
+    store.record_exchange(email, 'Deal at $250')
+    # Sending the reply costs no summarization call; it waits for the thread to continue
+    assert len(summarizer.calls) == 1
+    follow_up = {'id': 'm5', 'thread_id': 't1', 'from': 'brand@example.com', 'body': 'Agreed'}
+
+    assert store.get_summary(follow_up) == 'Offer $100 / Counter $300 | Meet at $200? / Deal at $250'
+    assert gmail.fetches == 1
+    # The second summary only folded in the new exchange
+    assert summarizer.calls[-1] == ('Offer $100 / Counter $300', ['Meet at $200?', 'Deal at $250'])
+
+def test_thread_context_skips_summary_for_new_threads(tmp_path):
+    store = ThreadContextStore(
+        EmailDatabase(str(tmp_path / 'emails.db')),
+        FakeThreadGmail([{'id': 'm1', 'from': 'brand@example.com', 'body': 'Hello'}]),
+        FakeSummarizer()
+    )
+
+    assert store.get_summary({'id': 'm1', 'thread_id': 't1'}) is None
+    assert store.ai_engine.calls == []
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    for test in (test_migrates_legacy_database, test_add_email_deduplicates_by_gmail_id,
+                 test_ledger_survives_restart, test_ledger_compacts_old_entries, test_connections_close_when_threads_exit,
+                 test_thread_context_fetches_history_once, test_thread_context_skips_summary_for_new_threads):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("All tests passed")
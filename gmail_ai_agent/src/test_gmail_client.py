@@ -0,0 +1,366 @@
+import base64
+import email
+import io
+import json
+import os
+from urllib.parse import parse_qs, urlparse
+
+import googleapiclient
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import HttpMockSequence
+
+from src.gmail_client import GmailClient
+from src.mime_parser import parse_payload
+
+# Gmail discovery document bundled with google-api-python-client
+DISCOVERY_DOC = os.path.join(
+    os.path.dirname(googleapiclient.__file__),
+    'discovery_cache', 'documents', 'gmail.v1.json'
+)
+
+def make_client(responses, batch_size=50, incremental_sync=False, metadata_first=False):
+    """Build a GmailClient backed by a local stand-in for the Gmail API"""
+    with open(DISCOVERY_DOC) as f:
+        document = f.read()
+    http = HttpMockSequence(responses)
+    client = GmailClient(batch_size=batch_size, incremental_sync=incremental_sync, metadata_first=metadata_first)
+    client.service = build_from_document(document, http=http)
+    return client, http
+
+def make_message(message_id, sender, subject, body):
+    return {
+        'id': message_id,
+        'threadId': f"thread-{message_id}",
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [
+                {'name': 'From', 'value': sender},
+                {'name': 'Subject', 'value': subject}
+            ],
+            'body': {'data': base64.urlsafe_b64encode(body.encode()).decode()}
+        }
+    }
+
+def batch_response(items):
+    """Encode (request_id, status, payload) tuples as a multipart batch response"""
+    boundary = 'batch_boundary'
+    parts = []
+    for request_id, status, payload in items:
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <response-base + {request_id}>\r\n\r\n"
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            f"{json.dumps(payload)}\r\n"
+        )
+    body = ''.join(parts) + f"--{boundary}--"
+    return ({'status': '200', 'content-type': f'multipart/mixed; boundary={boundary}'}, body)
+
+def test_get_new_emails_batches_message_gets():
+    messages = [make_message(f"m{i}", 'brand@example.com', f"Subject {i}", f"Body {i}") for i in range(5)]
+    client, _ = make_client([
+        ({'status': '200'}, json.dumps({'messages': [{'id': m['id']} for m in messages]})),
+        batch_response([(m['id'], 200, m) for m in messages[:2]]),
+        batch_response([(m['id'], 200, m) for m in messages[2:4]]),
+        batch_response([(m['id'], 200, m) for m in messages[4:]]),
+    ], batch_size=2)
+
+    emails = client.get_new_emails(target_email='brand@example.com')
+
+    assert [e['id'] for e in emails] == ['m0', 'm1', 'm2', 'm3', 'm4']
+    assert emails[3]['body'] == 'Body 3'
+    assert emails[3]['thread_id'] == 'thread-m3'
+    # The caller marks the ledger once each email is safely queued
+    assert not any(f"m{i}" in client.ledger for i in range(5))
+
+def test_get_new_emails_skips_failed_items():
+    messages = [make_message(f"m{i}", 'brand@example.com', f"Subject {i}", f"Body {i}") for i in range(3)]
+    client, _ = make_client([
+        ({'status': '200'}, json.dumps({'messages': [{'id': m['id']} for m in messages]})),
+        batch_response([
+            ('m0', 200, messages[0]),
+            ('m1', 404, {'error': {'code': 404, 'message': 'Not Found'}}),
+            ('m2', 200, messages[2]),
+        ]),
+    ])
+
+    emails = client.get_new_emails(target_email='brand@example.com')
+
+    assert [e['id'] for e in emails] == ['m0', 'm2']
+    # The failed message is retried on the next poll
+    assert 'm1' not in client.ledger
+
+def test_incremental_sync_lists_only_history():
+    first = make_message('m0', 'brand@example.com', 'Subject 0', 'Body 0')
+    second = make_message('m1', 'brand@example.com', 'Subject 1', 'Body 1')
+    client, _ = make_client([
+        ({'status': '200'}, json.dumps({'emailAddress': 'me@example.com', 'historyId': '100'})),
+        ({'status': '200'}, json.dumps({'messages': [{'id': 'm0'}]})),
+        batch_response([('m0', 200, first)]),
+        ({'status': '200'}, json.dumps({
+            'history': [{'id': '101', 'messagesAdded': [
+                {'message': {'id': 'm1', 'labelIds': ['INBOX', 'UNREAD']}},
+                {'message': {'id': 'm2', 'labelIds': ['INBOX']}}
+            ]}],
+            'historyId': '102'
+        })),
+        batch_response([('m1', 200, second)]),
+    ], incremental_sync=True)
+
+    assert [e['id'] for e in client.get_new_emails()] == ['m0']
+    assert client.history_id == '100'
+    assert [e['id'] for e in client.get_new_emails()] == ['m1']
+    assert client.history_id == '102'
+
+def test_incremental_sync_falls_back_when_history_expired():
+    message = make_message('m0', 'brand@example.com', 'Subject 0', 'Body 0')
+    client, _ = make_client([
+        ({'status': '404'}, json.dumps({'error': {'code': 404, 'message': 'Requested entity was not found.'}})),
+        ({'status': '200'}, json.dumps({'emailAddress': 'me@example.com', 'historyId': '500'})),
+        ({'status': '200'}, json.dumps({'messages': [{'id': 'm0'}]})),
+        batch_response([('m0', 200, message)]),
+    ], incremental_sync=True)
+    client.history_id = '1'
+
+    assert [e['id'] for e in client.get_new_emails()] == ['m0']
+    assert client.history_id == '500'
+
+def test_failed_fetch_keeps_history_cursor():
+    message = make_message('m1', 'brand@example.com', 'Subject 1', 'Body 1')
+    history = ({'status': '200'}, json.dumps({
+        'history': [{'id': '101', 'messagesAdded': [{'message': {'id': 'm1', 'labelIds': ['INBOX', 'UNREAD']}}]}],
+        'historyId': '102'
+    }))
+    client, _ = make_client([
+        history,
+        ({'status': '503'}, json.dumps({'error': {'code': 503, 'message': 'Backend Error'}})),
+        history,
+        batch_response([('m1', 200, message)]),
+    ], incremental_sync=True)
+    client.history_id = '100'
+
+    assert client.get_new_emails() == []
+    assert client.history_id == '100'
+    assert [e['id'] for e in client.get_new_emails()] == ['m1']
+    assert client.history_id == '102'
+
+def test_full_resync_follows_pagination():
+    messages = [make_message(f"m{i}", 'brand@example.com', f"Subject {i}", f"Body {i}") for i in range(3)]
+    client, _ = make_client([
+        ({'status': '200'}, json.dumps({'messages': [{'id': 'm0'}, {'id': 'm1'}], 'nextPageToken': 'page-2'})),
+        ({'status': '200'}, json.dumps({'messages': [{'id': 'm2'}]})),
+        batch_response([(m['id'], 200, m) for m in messages]),
+    ])
+
+    assert [e['id'] for e in client.get_new_emails(target_email='brand@example.com')] == ['m0', 'm1', 'm2']
+
+def test_metadata_first_fetches_bodies_only_for_target():
+    messages = [
+        make_message('m0', 'brand@example.com', 'Subject 0', 'Body 0'),
+        make_message('m1', 'other@example.com', 'Subject 1', 'Body 1'),
+        make_message('m2', 'brand@example.com', 'Subject 2', 'Body 2'),
+    ]
+    metadata = [{'id': m['id'], 'threadId': m['threadId'], 'payload': {'headers': m['payload']['headers']}} for m in messages]
+    client, _ = make_client([
+        ({'status': '200'}, json.dumps({'messages': [{'id': m['id']} for m in messages]})),
+        batch_response([
+            ('m0', 200, metadata[0]),
+            ('m1', 200, metadata[1]),
+            ('m2', 500, {'error': {'code': 500, 'message': 'Backend Error'}}),
+        ]),
+        batch_response([('m0', 200, messages[0])]),
+    ], metadata_first=True)
+
+    emails = client.get_new_emails(target_email='brand@example.com')
+
+    assert [e['id'] for e in emails] == ['m0']
+    assert emails[0]['body'] == 'Body 0'
+    assert client.retry_ids == {'m2'}
+
+def test_write_mime_streams_attachment(tmp_path):
+    image_path = tmp_path / "car.png"
+    image_bytes = os.urandom(200 * 1024)
+    image_path.write_bytes(image_bytes)
+    client = GmailClient()
+    out = io.BytesIO()
+
+    client._write_mime(out, 'brand@example.com', 'Re: Caf\u00e9 collab', 'Thanks for reaching out', str(image_path))
+
+    message = email.message_from_bytes(out.getvalue())
+    assert message['To'] == 'brand@example.com'
+    assert str(email.header.make_header(email.header.decode_header(message['Subject']))) == 'Re: Caf\u00e9 collab'
+    text, image = message.get_payload()
+    assert text.get_payload(decode=True) == b'Thanks for reaching out'
+    assert image.get_content_type() == 'image/png'
+    assert image.get_filename() == 'car.png'
+    assert image.get_payload(decode=True) == image_bytes
+
+def test_send_email_uses_resumable_upload(tmp_path):
+    image_path = tmp_path / "car.png"
+    image_path.write_bytes(b'png-bytes')
+    client, _ = make_client([
+        ({'status': '200', 'location': 'https://gmail.googleapis.com/upload/session'}, ''),
+        ({'status': '200'}, json.dumps({'id': 'sent-1', 'threadId': 'thread-1'})),
+    ])
+
+    assert client.send_email('brand@example.com', 'Re: Hello', 'Thanks', str(image_path))
+
+def record_requests(http):
+    """Wrap an HttpMockSequence so tests can inspect (method, uri, body) of each request"""
+    requests = []
+    request = http.request
+
+    def recording(uri, method='GET', body=None, headers=None, **kwargs):
+        json_body = body and (headers or {}).get('content-type', '').startswith('application/json')
+        requests.append((method, uri, json.loads(body) if json_body else body))
+        return request(uri, method=method, body=body, headers=headers, **kwargs)
+
+    http.request = recording
+    return requests
+
+def test_mark_as_read_batches_label_changes():
+    client, http = make_client([
+        ({'status': '200'}, json.dumps({'labels': [{'id': 'INBOX', 'name': 'INBOX'}]})),
+        ({'status': '200'}, json.dumps({'id': 'Label_1', 'name': 'Sponsorship/Negotiation'})),
+        ({'status': '204'}, ''),
+        ({'status': '204'}, ''),
+    ])
+    client.modify_batch_size = 2
+    requests = record_requests(http)
+
+    client.mark_as_read('m0', 'Negotiation')
+    client.mark_as_read('m1', 'Negotiation')
+    client.mark_as_read('m2')
+    client.flush_modifications()
+
+    modifies = [body for method, uri, body in requests if uri.split('?')[0].endswith('batchModify')]
+    assert modifies == [
+        {'ids': ['m0', 'm1'], 'addLabelIds': ['Label_1'], 'removeLabelIds': ['UNREAD']},
+        {'ids': ['m2'], 'addLabelIds': [], 'removeLabelIds': ['UNREAD']},
+    ]
+    # The label is created once and then served from the cache
+    assert sum(1 for _, uri, _ in requests if '/labels' in uri) == 2
+
+def test_label_failures_still_mark_read_and_retry():
+    client, http = make_client([
+        ({'status': '500'}, json.dumps({'error': {'code': 500, 'message': 'Backend Error'}})),
+        ({'status': '503'}, json.dumps({'error': {'code': 503, 'message': 'Unavailable'}})),
+        ({'status': '204'}, ''),
+    ])
+    requests = record_requests(http)
+
+    # The label lookup fails, but the UNREAD removal is still queued
+    client.mark_as_read('m0', 'Negotiation')
+    client.flush_modifications()  # batchModify fails and the change goes back in the queue
+    client.flush_modifications()
+    client.flush_modifications()  # Nothing left to send
+
+    modifies = [body for method, uri, body in requests if uri.split('?')[0].endswith('batchModify')]
+    assert modifies == [{'ids': ['m0'], 'addLabelIds': [], 'removeLabelIds': ['UNREAD']}] * 2
+    assert not client._pending_modify
+
+def test_multiple_senders_share_one_query():
+    messages = [
+        make_message('m0', 'Brand <brand@example.com>', 'Subject 0', 'Body 0'),
+        make_message('m1', 'partners@other.com', 'Subject 1', 'Body 1'),
+    ]
+    client, http = make_client([
+        ({'status': '200'}, json.dumps({'messages': [{'id': m['id']} for m in messages]})),
+        batch_response([(m['id'], 200, m) for m in messages]),
+    ])
+    client.account = 'business'
+    requests = record_requests(http)
+
+    emails = client.get_new_emails(target_email=['brand@example.com', 'Partners@Other.com'])
+
+    assert len(requests) == 2
+    query = parse_qs(urlparse(requests[0][1]).query)['q'][0]
+    assert query == 'from:{brand@example.com Partners@Other.com}'
+    assert [(e['monitored_sender'], e['account']) for e in emails] == [
+        ('brand@example.com', 'business'),
+        ('Partners@Other.com', 'business'),
+    ]
+
+def encode(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode().rstrip('=')
+
+def test_parse_payload_walks_nested_multipart():
+    payload = {
+        'mimeType': 'multipart/mixed',
+        'parts': [
+            {
+                'mimeType': 'multipart/alternative',
+                'parts': [
+                    {
+                        'mimeType': 'text/plain',
+                        'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="iso-8859-1"'}],
+                        'body': {'data': encode('Caf\u00e9 sponsorship', 'iso-8859-1')}
+                    },
+                    {'mimeType': 'text/html', 'body': {'data': encode('<p>ignored</p>')}}
+                ]
+            },
+            {
+                'partId': '1',
+                'mimeType': 'application/pdf',
+                'filename': 'media_kit.pdf',
+                'headers': [{'name': 'Content-Disposition', 'value': 'attachment; filename="media_kit.pdf"'}],
+                'body': {'attachmentId': 'att-1', 'size': 2048}
+            },
+            {
+                'partId': '2',
+                'mimeType': 'image/png',
+                'filename': 'logo.png',
+                'headers': [{'name': 'Content-Disposition', 'value': 'inline; filename="logo.png"'}],
+                'body': {'attachmentId': 'att-2', 'size': 10}
+            }
+        ]
+    }
+
+    body, attachments = parse_payload(payload)
+
+    assert body == 'Caf\u00e9 sponsorship'
+    assert attachments == [{
+        'filename': 'media_kit.pdf',
+        'mime_type': 'application/pdf',
+        'size': 2048,
+        'attachment_id': 'att-1',
+        'part_id': '1'
+    }]
+
+def test_parse_payload_falls_back_to_html():
+    payload = {
+        'mimeType': 'multipart/alternative',
+        'parts': [
+            {'mimeType': 'text/plain', 'body': {'size': 0}},
+            {'mimeType': 'text/html', 'body': {'data': encode(
+                '<html><head><style>p {color: red}</style></head>'
+                '<body><p>Hi&nbsp;there,</p><p>Rate: <b>$500</b><br>Thanks</p></body></html>'
+            )}}
+        ]
+    }
+
+    body, attachments = parse_payload(payload)
+
+    assert body == 'Hi\xa0there,\nRate: $500\nThanks'
+    assert attachments == []
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    test_get_new_emails_batches_message_gets()
+    test_get_new_emails_skips_failed_items()
+    test_incremental_sync_lists_only_history()
+    test_incremental_sync_falls_back_when_history_expired()
+    test_failed_fetch_keeps_history_cursor()
+    test_full_resync_follows_pagination()
+    test_metadata_first_fetches_bodies_only_for_target()
+    test_mark_as_read_batches_label_changes()
+    test_label_failures_still_mark_read_and_retry()
+    test_multiple_senders_share_one_query()
+    test_parse_payload_walks_nested_multipart()
+    test_parse_payload_falls_back_to_html()
+    for test in (test_write_mime_streams_attachment, test_send_email_uses_resumable_upload):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("All tests passed")
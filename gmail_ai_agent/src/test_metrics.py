@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+from src.metrics import Metrics, read_snapshot, render_prometheus
+
+def test_histogram_renders_cumulative_buckets():
+    metrics = Metrics(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        metrics.observe('stage_seconds', value, stage='fetch')
+
+    text = render_prometheus(metrics.snapshot())
+
+    assert '# TYPE stage_seconds histogram' in text
+    assert 'stage_seconds_bucket{le="0.1",stage="fetch"} 2' in text
+    assert 'stage_seconds_bucket{le="1.0",stage="fetch"} 3' in text
+    assert 'stage_seconds_bucket{le="+Inf",stage="fetch"} 4' in text
+    assert 'stage_seconds_count{stage="fetch"} 4' in text
+    assert 'stage_seconds_sum{stage="fetch"} 3.65' in text
+
+def test_usage_counts_tokens_and_cost():
+    metrics = Metrics()
+
+    metrics.record_usage('gpt-4-0125-preview', SimpleNamespace(prompt_tokens=1000, completion_tokens=500))
+    metrics.record_usage('gpt-4-0125-preview', None)
+    metrics.record_image('dall-e-3', '1024x1024', 'standard')
+
+    counters = {(name, tuple(sorted(labels.items()))): value for name, labels, value in metrics.snapshot()['counters']}
+    assert counters[('openai_tokens_total', (('model', 'gpt-4-0125-preview'), ('type', 'prompt')))] == 1000
+    assert counters[('openai_tokens_total', (('model', 'gpt-4-0125-preview'), ('type', 'completion')))] == 500
+    assert abs(counters[('openai_cost_usd_total', (('model', 'gpt-4-0125-preview'),))] - 0.025) < 1e-9
+    assert counters[('openai_cost_usd_total', (('model', 'dall-e-3'),))] == 0.04
+
+def test_snapshot_round_trips_through_file(tmp_path):
+    metrics = Metrics()
+    metrics.inc('cache_requests_total', cache='ai', kind='analysis', result='hit')
+    metrics.add_gauge('pipeline_queue_depth', 3, stage='draft')
+    metrics.add_gauge('pipeline_queue_depth', -1, stage='draft')
+    path = str(tmp_path / 'metrics.json')
+
+    assert read_snapshot(path) is None
+    metrics.write(path)
+    text = render_prometheus(read_snapshot(path))
+
+    assert 'cache_requests_total{cache="ai",kind="analysis",result="hit"} 1' in text
+    assert 'pipeline_queue_depth{stage="draft"} 2' in text
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    test_histogram_renders_cumulative_buckets()
+    test_usage_counts_tokens_and_cost()
+    with tempfile.TemporaryDirectory() as tmp:
+        test_snapshot_round_trips_through_file(pathlib.Path(tmp))
+    print("All tests passed")
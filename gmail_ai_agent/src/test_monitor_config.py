@@ -0,0 +1,35 @@
+import json
+
+from src.monitor_config import AccountConfig, SenderRule, load_monitor_config, sender_instructions
+
+def test_missing_config_watches_default_sender(tmp_path):
+    accounts = load_monitor_config(str(tmp_path / 'monitors.json'), 'brand@example.com')
+
+    assert accounts == [AccountConfig('default', 'config/credentials.json', [SenderRule('brand@example.com')])]
+    assert sender_instructions(accounts) == {}
+
+def test_config_resolves_paths_against_its_directory(tmp_path):
+    path = tmp_path / 'monitors.json'
+    path.write_text(json.dumps({'accounts': [
+        {'name': 'default', 'senders': [
+            {'email': 'one@brand.com'},
+            {'email': 'two@brand.com', 'instructions': 'two.txt'}
+        ]},
+        {'name': 'business', 'credentials': '/secrets/business.json', 'senders': [{'email': 'three@brand.com'}]}
+    ]}))
+
+    accounts = load_monitor_config(str(path), 'ignored@example.com')
+
+    assert [a.name for a in accounts] == ['default', 'business']
+    assert accounts[0].credentials_path == str(tmp_path / 'credentials.json')
+    assert accounts[1].credentials_path == '/secrets/business.json'
+    assert [a.token_path for a in accounts] == [str(tmp_path / 'token.json'), str(tmp_path / 'token_business.json')]
+    assert sender_instructions(accounts) == {'two@brand.com': str(tmp_path / 'two.txt')}
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    for test in (test_missing_config_watches_default_sender, test_config_resolves_paths_against_its_directory):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("All tests passed")
@@ -0,0 +1,75 @@
+import base64
+import json
+import threading
+import urllib.request
+
+from src.notifications import AdaptiveBackoff, HttpPushSubscriber, InboxWatcher, QueueSubscriber
+
+def test_backoff_grows_while_idle_and_resets_on_mail():
+    backoff = AdaptiveBackoff(5, 30)
+
+    assert [backoff.next_delay(False) for _ in range(4)] == [10, 20, 30, 30]
+    assert backoff.next_delay(True) == 5
+
+def test_queue_subscriber_coalesces_bursts():
+    subscriber = QueueSubscriber()
+    assert subscriber.wait(0) is None
+
+    for history_id in ('1', '2', '3'):
+        subscriber.push({'historyId': history_id})
+
+    assert subscriber.wait(1) == {'historyId': '3'}
+    assert subscriber.wait(0) is None
+
+def test_queue_subscriber_wakes_waiter():
+    subscriber = QueueSubscriber()
+    threading.Timer(0.05, subscriber.push, args=({'historyId': '7'},)).start()
+
+    assert subscriber.wait(5) == {'historyId': '7'}
+
+def test_http_subscriber_decodes_pubsub_push():
+    subscriber = HttpPushSubscriber(host='127.0.0.1', port=0, token='secret')
+    try:
+        data = base64.b64encode(json.dumps({'emailAddress': 'me@example.com', 'historyId': '42'}).encode()).decode()
+        envelope = json.dumps({'message': {'data': data, 'messageId': '1'}, 'subscription': 'sub'}).encode()
+
+        def post(query):
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{subscriber.port}/gmail/push{query}",
+                data=envelope,
+                headers={'Content-Type': 'application/json'}
+            )
+            try:
+                return urllib.request.urlopen(request).status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        assert post('') == 403
+        assert post('?token=secret') == 204
+        assert subscriber.wait(5) == {'emailAddress': 'me@example.com', 'historyId': '42'}
+    finally:
+        subscriber.close()
+
+def test_watcher_renews_only_when_due():
+    class FakeGmail:
+        calls = 0
+
+        def watch(self, topic_name):
+            self.calls += 1
+            return {'historyId': '1', 'expiration': '0'}
+
+    gmail = FakeGmail()
+    watcher = InboxWatcher(gmail, 'projects/p/topics/gmail', renew_interval=3600)
+
+    watcher.ensure()
+    watcher.ensure()
+
+    assert gmail.calls == 1
+
+if __name__ == "__main__":
+    test_backoff_grows_while_idle_and_resets_on_mail()
+    test_queue_subscriber_coalesces_bursts()
+    test_queue_subscriber_wakes_waiter()
+    test_http_subscriber_decodes_pubsub_push()
+    test_watcher_renews_only_when_due()
+    print("All tests passed")
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.ai_engine import AIEngine, EmailAction
+from src.openai_client import RateLimitedOpenAI, TokenBucket
+
+class MockOpenAI:
+    """Local HTTP server that answers /v1/chat/completions from a queue of (status, headers, content)"""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+        lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with lock:
+                    mock.requests.append(body)
+                    mock.active += 1
+                    mock.peak = max(mock.peak, mock.active)
+                    status, headers, content = mock.replies.pop(0)
+                time.sleep(0.05)
+                if status == 200 and body.get('stream'):
+                    self.send_stream(body, content)
+                    return
+                if status == 200:
+                    payload = {
+                        'id': 'chatcmpl-test',
+                        'object': 'chat.completion',
+                        'created': 0,
+                        'model': body['model'],
+                        'choices': [{
+                            'index': 0,
+                            'message': {'role': 'assistant', 'content': content},
+                            'finish_reason': 'stop'
+                        }]
+                    }
+                else:
+                    payload = {'error': {'message': content, 'type': 'rate_limit_exceeded'}}
+                data = json.dumps(payload).encode()
+                with lock:
+                    mock.active -= 1
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_stream(self, body, content):
+                # Server-sent events, one word per chunk, then a usage chunk without choices
+                chunks = [
+                    {'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}]}
+                    for word in re.findall(r'\S+\s*', content)
+                ] + [{'choices': [], 'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}}]
+                data = b''.join(
+                    b'data: ' + json.dumps(dict(
+                        chunk, id='chatcmpl-test', object='chat.completion.chunk', created=0, model=body['model']
+                    )).encode() + b'\n\n'
+                    for chunk in chunks
+                ) + b'data: [DONE]\n\n'
+                with lock:
+                    mock.active -= 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def make_engine(tmp_path, server, **kwargs):
+    instructions = tmp_path / 'instructions.txt'
+    instructions.write_text('Be polite.')
+    (tmp_path / 'instruction_image.txt').write_text('A photo of a [car]')
+    client = RateLimitedOpenAI(api_key='test', base_url=server.base_url, **kwargs)
+    return AIEngine(api_key='test', instructions_path=str(instructions), client=client)
+
+ANALYSIS = json.dumps({
+    'is_car': False,
+    'action': 'NEGOTIATION',
+    'car_details': None,
+    'reply': 'Thanks for reaching out, my rate is $500.'
+})
+
+EMAIL = {
+    'id': 'm1',
+    'from': 'brand@example.com',
+    'subject': 'Paid collaboration',
+    'body': 'We would like to pay you for a video about our product.'
+}
+
+def test_retries_after_rate_limit(tmp_path):
+    server = MockOpenAI([
+        (429, {'Retry-After': '0'}, 'Rate limit reached'),
+        (503, {'Retry-After': '0'}, 'Overloaded'),
+        (200, {}, ANALYSIS),
+    ])
+    engine = make_engine(tmp_path, server)
+    try:
+        reply, image_path, action = engine.generate_response(EMAIL)
+    finally:
+        engine.client.close()
+        server.close()
+
+    assert reply == 'Thanks for reaching out, my rate is $500.'
+    assert action == EmailAction.NEGOTIATION
+    assert len(server.requests) == 3
+
+def test_bounds_concurrent_requests(tmp_path):
+    server = MockOpenAI([(200, {}, ANALYSIS)] * 6)
+    engine = make_engine(tmp_path, server, max_concurrency=2)
+    try:
+        # Worker threads share the client's limits
+        results = []
+        workers = [
+            threading.Thread(target=lambda i=i: results.append(engine.generate_response(dict(EMAIL, id=f"m{i}"))))
+            for i in range(6)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        engine.client.close()
+        server.close()
+
+    assert [action for _, _, action in results] == [EmailAction.NEGOTIATION] * 6
+    assert server.peak == 2
+
+def test_stream_holds_its_slot_until_read(tmp_path):
+    server = MockOpenAI([(200, {}, 'Thanks for reaching out'), (200, {}, 'Second reply')])
+    client = RateLimitedOpenAI(api_key='test', base_url=server.base_url, max_concurrency=1)
+    request = dict(model='gpt-4-0125-preview', messages=[{'role': 'user', 'content': 'Hi'}], max_tokens=20)
+    try:
+        stream = client.chat.completions.create(stream=True, **request)
+        second = []
+        waiting = threading.Thread(target=lambda: second.append(client.chat.completions.create(**request)))
+        waiting.start()
+        time.sleep(0.3)
+        # The open stream still counts against max_concurrency
+        assert len(server.requests) == 1
+
+        words = [chunk.choices[0].delta.content for chunk in stream if chunk.choices]
+        waiting.join(timeout=5)
+    finally:
+        client.close()
+        server.close()
+
+    assert words == ['Thanks ', 'for ', 'reaching ', 'out']
+    assert second[0].choices[0].message.content == 'Second reply'
+
+def test_token_bucket_waits_for_refill():
+    async def run():
+        bucket = TokenBucket(per_minute=600)  # 10 per second
+        await bucket.acquire(600)
+        started = time.monotonic()
+        await bucket.acquire(2)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) >= 0.15
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    for test in (test_retries_after_rate_limit, test_bounds_concurrent_requests, test_stream_holds_its_slot_until_read):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    test_token_bucket_waits_for_refill()
+    print("All tests passed")
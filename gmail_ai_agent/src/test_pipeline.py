@@ -0,0 +1,51 @@
+import threading
+import time
+
+from src.pipeline import EmailPipeline, SendRateLimiter
+
+def test_rate_limiter_spaces_same_recipient():
+    limiter = SendRateLimiter(global_interval=0.0, recipient_interval=10.0)
+
+    assert limiter.reserve('a@example.com') == 0
+    assert limiter.reserve('b@example.com') == 0
+    assert limiter.reserve('a@example.com') > 9
+
+def test_rate_limiter_spaces_all_sends_globally():
+    limiter = SendRateLimiter(global_interval=10.0, recipient_interval=0.0)
+
+    assert limiter.reserve('a@example.com') == 0
+    assert limiter.reserve('b@example.com') > 9
+
+def test_pipeline_drafts_concurrently_and_sends_every_reply():
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+    sent = []
+
+    def draft(email):
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+        # Email 3 fails validation and must not be sent
+        return None if email['id'] == '3' else (f"Reply {email['id']}", None)
+
+    def send(email, response, image_path):
+        with lock:
+            sent.append(response)
+
+    pipeline = EmailPipeline(draft, send, SendRateLimiter(0.0, 0.0), ai_workers=4, send_workers=2)
+    pipeline.run([{'id': str(i), 'from': f"{i}@example.com"} for i in range(6)])
+    pipeline.shutdown()
+
+    assert peak > 1
+    assert sorted(sent) == ['Reply 0', 'Reply 1', 'Reply 2', 'Reply 4', 'Reply 5']
+
+if __name__ == "__main__":
+    test_rate_limiter_spaces_same_recipient()
+    test_rate_limiter_spaces_all_sends_globally()
+    test_pipeline_drafts_concurrently_and_sends_every_reply()
+    print("All tests passed")
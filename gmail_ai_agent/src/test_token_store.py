@@ -0,0 +1,79 @@
+import json
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from google.oauth2.credentials import Credentials
+
+from src import token_store
+from src.token_store import TokenStore
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+def make_credentials(token, expiry=None):
+    return Credentials(
+        token=token,
+        refresh_token='refresh',
+        token_uri='https://oauth2.googleapis.com/token',
+        client_id='client',
+        client_secret='secret',
+        scopes=SCOPES,
+        expiry=expiry
+    )
+
+def test_valid_token_skips_consent(tmp_path):
+    store = TokenStore(str(tmp_path / 'token.json'), SCOPES)
+    store.save(make_credentials('cached', datetime.utcnow() + timedelta(hours=1)))
+
+    creds = store.get_credentials(authorize=None)
+
+    assert creds.token == 'cached'
+    assert os.stat(store.path).st_mode & 0o777 == 0o600
+
+def test_expired_token_is_refreshed_and_saved(tmp_path):
+    store = TokenStore(str(tmp_path / 'token.json'), SCOPES)
+    store.save(make_credentials('stale', datetime.utcnow() - timedelta(minutes=5)))
+    calls = []
+
+    def fake_request(url, method='GET', body=None, headers=None, **kwargs):
+        calls.append(url)
+        data = json.dumps({'access_token': 'fresh', 'expires_in': 3600}).encode()
+        return SimpleNamespace(status=200, data=data, headers={})
+
+    original = token_store.Request
+    token_store.Request = lambda: fake_request
+    try:
+        creds = store.get_credentials(authorize=None)
+    finally:
+        token_store.Request = original
+
+    assert creds.token == 'fresh'
+    assert calls == ['https://oauth2.googleapis.com/token']
+    # Other processes pick up the refreshed token instead of refreshing again
+    assert store.load().token == 'fresh'
+
+def test_missing_token_runs_consent_once(tmp_path):
+    store = TokenStore(str(tmp_path / 'token.json'), SCOPES)
+    consents = []
+
+    def authorize():
+        consents.append(1)
+        return make_credentials('granted', datetime.utcnow() + timedelta(hours=1))
+
+    assert store.get_credentials(authorize).token == 'granted'
+    assert store.get_credentials(authorize).token == 'granted'
+    assert len(consents) == 1
+
+    try:
+        TokenStore(str(tmp_path / 'other.json'), SCOPES).get_credentials(authorize=None)
+        assert False, "expected a missing token to fail without consent"
+    except RuntimeError:
+        pass
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    for test in (test_valid_token_skips_consent, test_expired_token_is_refreshed_and_saved, test_missing_token_runs_consent_once):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("All tests passed")
@@ -0,0 +1,242 @@
+import time
+from types import SimpleNamespace
+
+from src.ai_engine import AIEngine
+from src.database import EmailAction, EmailDatabase
+from src.ledger import ProcessedLedger
+from src.gmail_client import GmailClient
+from src.main import Account, create_gmail_client, draft_job, fetch_emails, send_job
+from src.monitor_config import AccountConfig
+from src.work_queue import WorkQueue
+
+EMAIL = {'id': 'm1', 'from': 'brand@example.com', 'subject': 'Paid collaboration', 'body': 'Hi', 'thread_id': 't1'}
+
+class FakeGmail:
+    def __init__(self, already_sent=False):
+        self.ledger = ProcessedLedger()
+        self.retry_ids = set()
+        self.already_sent = already_sent
+        self.sent = []
+        self.read = []
+
+    def has_sent(self, message_id):
+        return self.already_sent
+
+    def send_email(self, **kwargs):
+        self.sent.append(kwargs)
+        return True
+
+    def mark_as_read(self, email_id, action=None):
+        self.read.append((email_id, action))
+
+class FakeEngine:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_response(self, email):
+        self.calls += 1
+        return 'Thanks, my rate is $500.', None, EmailAction.NEGOTIATION
+
+    def validate_response(self, response):
+        return True
+
+    def release_image(self, image_path):
+        pass
+
+def test_claim_leases_jobs_once(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    first = WorkQueue(db, owner='worker-1', retry_delay=0)
+    second = WorkQueue(db, owner='worker-2', retry_delay=0)
+
+    assert first.enqueue(EMAIL)
+    assert not first.enqueue(EMAIL)
+    [claimed] = first.claim()
+
+    assert claimed['subject'] == 'Paid collaboration'
+    assert claimed['job']['state'] == WorkQueue.FETCHED
+    assert second.claim() == []
+
+    # Intermediate states keep the lease; a failure hands the job back
+    assert first.advance(claimed, WorkQueue.DRAFTED, reply='Thanks')
+    assert second.claim() == []
+    first.fail(claimed, 'send failed')
+    [reclaimed] = second.claim()
+    assert reclaimed['job']['state'] == WorkQueue.DRAFTED
+    assert reclaimed['job']['reply'] == 'Thanks'
+    assert reclaimed['job']['attempts'] == 2
+    assert not first.advance(claimed, WorkQueue.SENT)
+
+def test_expired_lease_is_reclaimed_and_failures_park_the_job(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    crashed = WorkQueue(db, owner='crashed', lease_seconds=-1, max_attempts=2)
+    survivor = WorkQueue(db, owner='survivor', max_attempts=2)
+    crashed.enqueue(EMAIL)
+    crashed.claim()
+
+    [email] = survivor.claim()
+    survivor.fail(email, 'boom')
+
+    assert email['job']['state'] == WorkQueue.FAILED
+    assert survivor.claim() == []
+    assert survivor.counts() == {WorkQueue.FAILED: 1}
+
+def test_drafted_job_resumes_without_regenerating(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    # Leases expire immediately, as if every claim came from a worker that then crashed
+    work_queue = WorkQueue(db, lease_seconds=-1)
+    gmail, engine = FakeGmail(), FakeEngine()
+    work_queue.enqueue(EMAIL)
+
+    [email] = work_queue.claim()
+    assert draft_job(gmail, engine, db, work_queue, email) == ('Thanks, my rate is $500.', None)
+    # Crash before sending: the next run reuses the stored reply
+    [email] = work_queue.claim()
+    assert draft_job(gmail, engine, db, work_queue, email) == ('Thanks, my rate is $500.', None)
+    assert engine.calls == 1
+
+    send_job(gmail, engine, work_queue, email, 'Thanks, my rate is $500.', None)
+
+    assert len(gmail.sent) == 1
+    assert gmail.sent[0]['message_id'] == 'reply-m1@gmail-ai-agent.local'
+    assert gmail.read == [('m1', 'Negotiation')]
+    assert work_queue.counts() == {WorkQueue.ACKNOWLEDGED: 1}
+
+def test_retried_send_is_not_duplicated(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    work_queue = WorkQueue(db, lease_seconds=-1)
+    gmail, engine = FakeGmail(already_sent=True), FakeEngine()
+    work_queue.enqueue(EMAIL)
+    [email] = work_queue.claim()
+    work_queue.advance(email, WorkQueue.DRAFTED, reply='Thanks, my rate is $500.')
+
+    [email] = work_queue.claim()
+    send_job(gmail, engine, work_queue, email, email['job']['reply'], None)
+
+    assert gmail.sent == []
+    assert 'm1' in gmail.ledger
+    assert work_queue.counts() == {WorkQueue.ACKNOWLEDGED: 1}
+
+def test_engine_outage_retries_instead_of_skipping(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    work_queue = WorkQueue(db, retry_delay=0)
+    instructions = tmp_path / 'instructions.txt'
+    instructions.write_text('Be polite.')
+    engine = AIEngine(api_key='test', instructions_path=str(instructions))
+
+    def unreachable(**kwargs):
+        raise ConnectionError('OpenAI is down')
+
+    engine.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=unreachable)))
+    gmail = FakeGmail()
+    work_queue.enqueue(EMAIL)
+
+    [email] = work_queue.claim()
+    assert draft_job(gmail, engine, db, work_queue, email) is None
+
+    # The job is handed back for another attempt and nothing was recorded as handled
+    [retry] = work_queue.claim()
+    assert retry['job']['state'] == WorkQueue.FETCHED
+    assert retry['job']['attempts'] == 2
+    assert 'm1' not in gmail.ledger
+    assert db.get_latest_emails(3) == []
+
+def test_failed_jobs_back_off_and_outages_never_park(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    work_queue = WorkQueue(db, max_attempts=3, retry_delay=0.2, max_retry_delay=0.4)
+    work_queue.enqueue(EMAIL)
+
+    assert [work_queue.backoff(n) for n in (1, 2, 3, 4)] == [0.2, 0.4, 0.4, 0.4]
+
+    [email] = work_queue.claim()
+    work_queue.fail(email, 'OpenAI is down', transient=True)
+    # Not claimable again until the backoff has passed
+    assert work_queue.claim() == []
+    time.sleep(0.25)
+
+    # Outages keep the job alive well past max_attempts
+    for attempt in range(2, 6):
+        [email] = work_queue.claim()
+        assert email['job']['attempts'] == attempt
+        work_queue.fail(email, 'OpenAI is down', transient=True)
+        assert work_queue.claim() == []
+        time.sleep(0.45)
+    assert work_queue.counts() == {WorkQueue.FETCHED: 1}
+
+    # Any other failure gives up once attempts run out
+    [email] = work_queue.claim()
+    work_queue.fail(email, 'send failed')
+    assert work_queue.counts() == {WorkQueue.FAILED: 1}
+
+def test_advance_renews_the_lease(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    first = WorkQueue(db, owner='worker-1', lease_seconds=0.3)
+    second = WorkQueue(db, owner='worker-2', lease_seconds=0.3)
+    first.enqueue(EMAIL)
+    [email] = first.claim()
+
+    time.sleep(0.2)
+    assert first.advance(email, WorkQueue.DRAFTED, reply='Thanks')
+    time.sleep(0.2)
+    # Past the original lease, but the advance extended it
+    assert second.claim() == []
+
+    with first.leases_held():
+        time.sleep(0.5)
+        assert second.claim() == []
+
+class FailingQueue(WorkQueue):
+    def enqueue(self, email):
+        raise RuntimeError('database is locked')
+
+def test_ledger_is_marked_only_after_the_job_is_queued(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    gmail = FakeGmail()
+    gmail.history_id = '200'
+    gmail.get_new_emails = lambda target_email=None: [dict(EMAIL)]
+    account = Account('default', gmail, ['brand@example.com'])
+
+    try:
+        fetch_emails(account, db, FailingQueue(db))
+        assert False, "expected the enqueue failure to propagate"
+    except RuntimeError:
+        pass
+    # Nothing blocks the refetch, and the cursor still points before the message
+    assert 'm1' not in gmail.ledger
+    assert db.get_sync_state('history_id') is None
+
+    work_queue = WorkQueue(db)
+    fetch_emails(account, db, work_queue)
+    assert 'm1' in gmail.ledger
+    assert work_queue.counts() == {WorkQueue.FETCHED: 1}
+    assert db.get_sync_state('history_id') == '200'
+
+def test_failed_fetches_survive_a_restart(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    gmail = FakeGmail()
+    gmail.history_id = '300'
+    gmail.retry_ids = {'m2'}  # Its fetch failed during this poll
+    gmail.get_new_emails = lambda target_email=None: [dict(EMAIL)]
+    fetch_emails(Account('default', gmail, ['brand@example.com']), db, WorkQueue(db))
+
+    # The cursor moved past m2, so only the stored retry list brings it back after a restart
+    assert db.get_sync_state('history_id') == '300'
+    authenticate = GmailClient.authenticate
+    GmailClient.authenticate = lambda self: None
+    try:
+        restarted = create_gmail_client(db, AccountConfig('default', 'credentials.json', []))
+    finally:
+        GmailClient.authenticate = authenticate
+    assert restarted.history_id == '300'
+    assert restarted.retry_ids == {'m2'}
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    for test in (test_claim_leases_jobs_once, test_expired_lease_is_reclaimed_and_failures_park_the_job,
+                 test_drafted_job_resumes_without_regenerating, test_retried_send_is_not_duplicated,
+                 test_engine_outage_retries_instead_of_skipping, test_failed_jobs_back_off_and_outages_never_park,
+                 test_advance_renews_the_lease,
+                 test_ledger_is_marked_only_after_the_job_is_queued, test_failed_fetches_survive_a_restart):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("All tests passed")
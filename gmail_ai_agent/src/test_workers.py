@@ -0,0 +1,86 @@
+import os
+import signal
+import time
+
+from src.database import EmailDatabase
+from src.metrics import Metrics, clear_snapshots, read_snapshots, snapshot_path
+from src.workers import Supervisor, WorkerHeartbeat
+
+def crash():
+    os._exit(3)
+
+def drain_on_sigterm(marker):
+    # Mirrors the processor: SIGTERM asks for a drain, and the drain finishes the current work
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    while not stopping:
+        time.sleep(0.01)
+    with open(marker, 'w') as f:
+        f.write('drained')
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+def test_supervisor_restarts_crashed_process():
+    supervisor = Supervisor({'crasher': (crash, ())}, max_restart_delay=0)
+    supervisor.start()
+    first_pid = supervisor.processes['crasher'].pid
+
+    wait_for(lambda: not supervisor.processes['crasher'].is_alive())
+    supervisor.poll()
+
+    assert supervisor.processes['crasher'].pid != first_pid
+    supervisor.drain(timeout=5)
+
+def test_supervisor_drains_children(tmp_path):
+    marker = str(tmp_path / 'drained')
+    supervisor = Supervisor({'worker': (drain_on_sigterm, (marker,))})
+    supervisor.start()
+    time.sleep(0.2)
+
+    supervisor.drain(timeout=5)
+    supervisor.poll()
+
+    assert open(marker).read() == 'drained'
+    assert not supervisor.processes['worker'].is_alive()
+
+def test_heartbeat_reports_worker_state(tmp_path):
+    db = EmailDatabase(str(tmp_path / 'emails.db'))
+    heartbeat = WorkerHeartbeat(db, 'worker-1', 'worker')
+
+    heartbeat.beat('busy')
+    heartbeat.processed += 4
+    heartbeat.beat('idle')
+
+    [status] = db.get_worker_statuses()
+    assert status['worker_id'] == 'worker-1'
+    assert status['state'] == 'idle'
+    assert status['processed'] == 4
+    assert status['pid'] == os.getpid()
+
+def test_per_process_snapshots_are_summed(tmp_path):
+    base = str(tmp_path / 'metrics.json')
+    for name, depth in (('worker-1', 2), ('worker-2', 3)):
+        metrics = Metrics(buckets=(1.0,))
+        metrics.inc('emails_fetched_total', depth)
+        metrics.observe('stage_seconds', 0.5, stage='send')
+        metrics.write(snapshot_path(base, name))
+
+    snapshot = read_snapshots(base)
+
+    assert snapshot['counters'] == [['emails_fetched_total', {}, 5]]
+    assert snapshot['histograms'] == [['stage_seconds', {'stage': 'send'}, [2, 0, 1.0]]]
+    clear_snapshots(base)
+    assert read_snapshots(base) is None
+
+if __name__ == "__main__":
+    import pathlib
+    import tempfile
+    test_supervisor_restarts_crashed_process()
+    for test in (test_supervisor_drains_children, test_heartbeat_reports_worker_state, test_per_process_snapshots_are_summed):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(pathlib.Path(tmp))
+    print("All tests passed")
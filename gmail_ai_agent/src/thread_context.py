@@ -0,0 +1,75 @@
+import threading
+import logging
+from typing import Dict, Optional
+
+from src.database import EmailDatabase
+
+logger = logging.getLogger(__name__)
+
+class ThreadContextStore:
+    """Rolling per-thread conversation summaries, persisted in EmailDatabase
+
+    Sent exchanges are only queued on the thread; they are summarized when the thread's next message
+    arrives, so threads that never continue cost no summarization call.
+    """
+
+    def __init__(self, db: EmailDatabase, gmail_client, ai_engine):
+        self.db = db
+        self.gmail_client = gmail_client
+        self.ai_engine = ai_engine
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, thread_id: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(thread_id, threading.Lock())
+
+    def get_summary(self, email: Dict) -> Optional[str]:
+        """Summary of the messages before email in its thread; the thread is fetched only the first time"""
+        thread_id = email.get('thread_id')
+        if not thread_id:
+            return None
+
+        with self._lock_for(thread_id):
+            stored = self.db.get_thread_summary(thread_id)
+            if stored is not None:
+                if not stored['pending']:
+                    return stored['summary'] or None
+                summary = self.ai_engine.summarize_thread(stored['summary'], stored['pending'])
+                self.db.set_thread_summary(thread_id, summary, stored['last_message_id'], stored['message_count'])
+                return summary or None
+
+            try:
+                messages = self.gmail_client.get_thread_messages(thread_id)
+            except Exception as e:
+                logger.error(f"Error fetching thread {thread_id}: {str(e)}")
+                return None
+
+            earlier = []
+            for message in messages:
+                if message['id'] == email['id']:
+                    break
+                earlier.append(message)
+
+            summary = self.ai_engine.summarize_thread("", earlier) if earlier else ""
+            self.db.set_thread_summary(
+                thread_id,
+                summary,
+                earlier[-1]['id'] if earlier else None,
+                len(earlier)
+            )
+            return summary or None
+
+    def record_exchange(self, email: Dict, reply: str):
+        """Queue the email we just answered and our reply for the thread's next summary update"""
+        thread_id = email.get('thread_id')
+        if not thread_id:
+            return
+
+        with self._lock_for(thread_id):
+            stored = self.db.get_thread_summary(thread_id) or {'summary': "", 'message_count': 0, 'pending': []}
+            pending = stored['pending'] + [
+                {'from': email['from'], 'body': email['body']},
+                {'from': 'me', 'body': reply}
+            ]
+            self.db.set_thread_summary(thread_id, stored['summary'], email['id'], stored['message_count'] + 2, pending)
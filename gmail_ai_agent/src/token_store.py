@@ -0,0 +1,76 @@
+import os
+import logging
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows; processes there simply don't serialize token writes
+    fcntl = None
+
+class TokenStore:
+    """OAuth token file shared by every process of an account
+
+    An exclusive lock around load/refresh/consent means concurrent workers refresh the token once
+    and only one of them ever asks for browser consent; the others pick up the token it saved.
+    """
+
+    def __init__(self, path: str, scopes: List[str]):
+        self.path = path
+        self.scopes = scopes
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self) -> Optional[Credentials]:
+        if not os.path.exists(self.path):
+            return None
+        try:
+            # Keep the scopes the token was granted, so a scope change forces a new consent
+            return Credentials.from_authorized_user_file(self.path)
+        except ValueError as e:
+            logger.warning(f"Ignoring unreadable token file {self.path}: {str(e)}")
+            return None
+
+    def save(self, creds: Credentials):
+        """Atomically replace the token file, readable by the owner only"""
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(creds.to_json())
+        os.replace(tmp_path, self.path)
+
+    def get_credentials(self, authorize: Optional[Callable[[], Credentials]] = None) -> Credentials:
+        """Valid credentials from the token file, refreshed if expired; authorize() runs only when neither works"""
+        with self.locked():
+            creds = self.load()
+            if creds is not None and creds.valid and creds.has_scopes(self.scopes):
+                return creds
+            if creds is not None and creds.refresh_token and creds.has_scopes(self.scopes):
+                try:
+                    creds.refresh(Request())
+                    self.save(creds)
+                    return creds
+                except RefreshError as e:
+                    # Revoked or expired refresh token; only a new consent can fix it
+                    logger.warning(f"Token refresh failed for {self.path}: {str(e)}")
+            if authorize is None:
+                raise RuntimeError(f"No usable OAuth token in {self.path}; authorize this account interactively first")
+            creds = authorize()
+            self.save(creds)
+            return creds
@@ -1,8 +1,10 @@
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 from flask_bootstrap import Bootstrap
 from src.database import EmailDatabase, EmailAction
+from src.metrics import DEFAULT_SNAPSHOT_PATH, read_snapshots, render_prometheus
 import os
 import sqlite3
+import time
 
 app = Flask(__name__)
 Bootstrap(app)
@@ -15,13 +17,29 @@ def index():
     # Get the latest 3 entries
     latest_emails = db.get_latest_emails(3)  # Get latest 3 emails
     
+    # A worker that has not reported for this long is shown as unresponsive
+    stale_after = float(os.getenv('WORKER_STALE_SECONDS', 600))
+    workers = db.get_worker_statuses()
+    for worker in workers:
+        worker['age'] = time.time() - worker['heartbeat_at']
+        worker['healthy'] = worker['state'] == 'stopped' or worker['age'] < stale_after
+    
     return render_template(
         'index.html',
         emails=latest_emails,
+        workers=workers,
         actions=EmailAction,
         format_time=lambda dt: dt.strftime("%Y-%m-%d %H:%M:%S")
     )
 
+@app.route('/metrics')
+def metrics():
+    # Processor processes snapshot their metrics after every poll; sum them into one view
+    snapshot = read_snapshots(os.getenv('METRICS_PATH', DEFAULT_SNAPSHOT_PATH))
+    if snapshot is None:
+        return Response("# No metrics yet; is the email processor running?\n", mimetype='text/plain')
+    return Response(render_prometheus(snapshot), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     # Create templates directory if it doesn't exist
     os.makedirs(os.path.join(os.path.dirname(__file__), 'templates'), exist_ok=True)
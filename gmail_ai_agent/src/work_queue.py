@@ -0,0 +1,141 @@
+import json
+import os
+import socket
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from src.database import EmailDatabase
+
+logger = logging.getLogger(__name__)
+
+class WorkQueue:
+    """Durable per-message job queue in EmailDatabase; stages resume from the last recorded state
+
+    A job moves fetched -> drafted -> sent -> acknowledged (or skipped/failed). Workers lease jobs,
+    so a job held by a crashed worker is picked up again once its lease expires. A failed stage is
+    retried after an exponential backoff.
+    """
+
+    FETCHED = "fetched"
+    DRAFTED = "drafted"  # Classified and reply generated; both come out of the same AI call
+    SENT = "sent"
+    ACKNOWLEDGED = "acknowledged"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+    ACTIVE = (FETCHED, DRAFTED, SENT)
+    FINISHED = (ACKNOWLEDGED, SKIPPED, FAILED)
+
+    def __init__(
+        self,
+        db: EmailDatabase,
+        owner: Optional[str] = None,
+        lease_seconds: float = 300,
+        max_attempts: int = 3,
+        retry_delay: float = 30,
+        max_retry_delay: float = 3600,
+        retention_days: float = 7,
+        purge_interval: float = 3600
+    ):
+        self.db = db
+        # Leases are per process; threads of one worker share them
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retention = retention_days * 24 * 3600
+        self.purge_interval = purge_interval
+        self._last_purge = time.monotonic()
+
+    def enqueue(self, email: Dict) -> bool:
+        """Persist a fetched email as a job; re-enqueuing a known message is a no-op"""
+        return self.db.add_job(email['id'], self.FETCHED, json.dumps(email))
+
+    def claim(self, limit: int = 50) -> List[Dict]:
+        """Lease runnable jobs and return their emails, each with a 'job' entry describing its progress"""
+        self._maybe_purge()
+        emails = []
+        for job in self.db.claim_jobs(self.ACTIVE, self.owner, self.lease_seconds, limit):
+            email = json.loads(job['payload'])
+            email['job'] = {
+                'state': job['state'],
+                'reply': job['reply'],
+                'image_path': job['image_path'],
+                'action': job['action'],
+                'attempts': job['attempts']
+            }
+            emails.append(email)
+        return emails
+
+    def advance(self, email: Dict, state: str, release: Optional[bool] = None, **fields) -> bool:
+        """Record that email's job reached state; the lease is renewed until the job finishes"""
+        if release is None:
+            release = state in self.FINISHED
+        if not self.db.update_job(email['id'], self.owner, state, release=release, lease_seconds=self.lease_seconds, **fields):
+            logger.warning(f"Lost the lease on job {email['id']}; another worker has taken it over")
+            return False
+        email['job'].update(fields, state=state)
+        return True
+
+    def fail(self, email: Dict, error: str, transient: bool = False):
+        """Hand a job back after a failed stage, to be retried after a backoff, or park it once attempts run out
+
+        Transient failures (e.g. the AI service being down) never park the job; they keep retrying
+        at most max_retry_delay apart until the outage is over.
+        """
+        job = email['job']
+        if not transient and job['attempts'] >= self.max_attempts:
+            logger.error(f"Job {email['id']} failed in state {job['state']} (attempt {job['attempts']}), giving up: {error}")
+            self.advance(email, self.FAILED, release=True, last_error=error)
+            return
+        delay = self.backoff(job['attempts'])
+        logger.error(
+            f"Job {email['id']} failed in state {job['state']} (attempt {job['attempts']}), "
+            f"retrying in {delay:.0f}s: {error}"
+        )
+        if self.db.update_job(email['id'], self.owner, job['state'], retry_at=time.time() + delay, last_error=error):
+            job['last_error'] = error
+        else:
+            logger.warning(f"Lost the lease on job {email['id']}; another worker has taken it over")
+
+    def backoff(self, attempts: int) -> float:
+        """Delay before retrying a job that has failed attempts times"""
+        return min(self.max_retry_delay, self.retry_delay * 2 ** max(0, attempts - 1))
+
+    @contextmanager
+    def leases_held(self):
+        """Keep renewing this owner's leases while the with-block runs, so a slow batch is not claimed twice"""
+        if self.lease_seconds <= 0:
+            yield
+            return
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    self.db.renew_leases(self.owner, self.lease_seconds)
+                except Exception as e:
+                    logger.error(f"Error renewing job leases: {str(e)}")
+
+        thread = threading.Thread(target=renew, name='lease-renewal', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def counts(self) -> Dict[str, int]:
+        return self.db.count_jobs()
+
+    def _maybe_purge(self):
+        if time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+        removed = self.db.purge_jobs(self.FINISHED, time.time() - self.retention)
+        if removed:
+            logger.info(f"Purged {removed} finished jobs")
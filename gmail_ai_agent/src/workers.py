@@ -0,0 +1,98 @@
+import multiprocessing
+import os
+import signal
+import time
+import logging
+from typing import Callable, Dict, Tuple
+
+from src.database import EmailDatabase
+
+logger = logging.getLogger(__name__)
+
+class WorkerHeartbeat:
+    """Publishes a process's state to EmailDatabase so the dashboard can show worker health"""
+
+    def __init__(self, db: EmailDatabase, worker_id: str, role: str):
+        self.db = db
+        self.worker_id = worker_id
+        self.role = role
+        self.pid = os.getpid()
+        self.started_at = time.time()
+        self.processed = 0
+
+    def beat(self, state: str):
+        try:
+            self.db.set_worker_status(self.worker_id, self.role, self.pid, state, self.processed, self.started_at)
+        except Exception as e:
+            # Health reporting must never take the worker down
+            logger.error(f"Error reporting status for {self.worker_id}: {str(e)}")
+
+def _run_child(target: Callable, args: tuple):
+    # Forked children inherit the supervisor's handlers; give them the defaults back
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(*args)
+
+class Supervisor:
+    """Starts named child processes, restarts any that die, and drains them on shutdown"""
+
+    def __init__(
+        self,
+        targets: Dict[str, Tuple[Callable, tuple]],
+        max_restart_delay: float = 60.0,
+        stable_after: float = 60.0
+    ):
+        self.targets = targets
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self._started_at: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self._restart_at: Dict[str, float] = {}
+        self.draining = False
+
+    def start(self):
+        for name in self.targets:
+            self._spawn(name)
+
+    def _spawn(self, name: str):
+        target, args = self.targets[name]
+        process = multiprocessing.Process(target=_run_child, args=(target, args), name=name)
+        process.start()
+        self.processes[name] = process
+        self._started_at[name] = time.monotonic()
+        logger.info(f"Started {name} (pid {process.pid})")
+
+    def poll(self):
+        """Restart children that exited, backing off for ones that keep crashing"""
+        if self.draining:
+            return
+        now = time.monotonic()
+        for name, process in self.processes.items():
+            if process.is_alive():
+                continue
+            if name not in self._restart_at:
+                # A process that stayed up for a while gets a fresh backoff
+                if now - self._started_at[name] >= self.stable_after:
+                    self._failures[name] = 0
+                self._failures[name] = self._failures.get(name, 0) + 1
+                delay = min(self.max_restart_delay, 2 ** (self._failures[name] - 1))
+                self._restart_at[name] = now + delay
+                logger.warning(f"{name} exited with code {process.exitcode}; restarting in {delay:.0f}s")
+            if now >= self._restart_at[name]:
+                del self._restart_at[name]
+                self._spawn(name)
+
+    def drain(self, timeout: float = 120.0):
+        """Ask every child to finish its in-flight work, then kill whatever is left after timeout"""
+        self.draining = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM; children treat it as a request to drain
+        deadline = time.monotonic() + timeout
+        for name, process in self.processes.items():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{name} did not drain within {timeout:.0f}s, killing it")
+                process.kill()
+                process.join()